@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Benchmark of the sync and async send-email views under concurrent requests.
+
+Runs --requests POST /api/send-email/ requests at each --concurrency on one
+event loop, as an ASGI server would, and compares:
+
+- sync: SendEmailView, run the way Django's ASGI handler runs a sync view,
+  i.e. in its one thread for sync code, so requests queue up behind each
+  other's Redis round trips
+- async: AsyncSendEmailView, waiting on Redis on the event loop, with the
+  commands of concurrent requests sent together (see AutoPipeline)
+
+Requests go straight to the views without an HTTP server. cpu_ms_per_request
+is the time this process spent on the CPU. Tasks are routed to a queue of
+their own, purged afterwards, so no worker sends them. Needs Redis, see
+README.
+
+Usage:
+    python -m benchmarks.async_enqueue [--requests 2000]
+        [--concurrency 1,10,100,1000] [--output results.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import uuid
+
+# Setup Django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+import django  # noqa: E402
+django.setup()
+
+from asgiref.sync import sync_to_async  # noqa: E402
+from django.test import AsyncRequestFactory  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from config.celery import app  # noqa: E402
+from email_sender.views import AsyncSendEmailView, SendEmailView  # noqa: E402
+
+factory = AsyncRequestFactory()
+sync_view = SendEmailView.as_view()
+async_view = AsyncSendEmailView.as_view()
+
+
+def build_request(recipient):
+    return factory.post('/api/send-email/', json.dumps({
+        'recipient_email': recipient,
+        'subject': "Benchmark",
+        'message': "Hello from the async enqueue benchmark",
+    }), content_type='application/json')
+
+
+def call_sync_view(request):
+    return sync_view(request).render()
+
+
+async def send_sync(request):
+    return await sync_to_async(call_sync_view)(request)
+
+
+async def send_async(request):
+    return await async_view(request)
+
+
+MODES = {
+    'sync': send_sync,
+    'async': send_async,
+}
+
+
+async def run(send, options, concurrency, run_id):
+    """Latency of each of --requests requests, at most concurrency at a time"""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(index):
+        request = build_request(f"{run_id}-{concurrency}-user{index}@example.com")
+        async with semaphore:
+            started = time.perf_counter()
+            response = await send(request)
+            latencies.append(time.perf_counter() - started)
+        assert response.status_code == 202, response.content
+
+    await asyncio.gather(*(one(index) for index in range(options.requests)))
+    return latencies
+
+
+async def benchmark(options):
+    results = {}
+    for mode, send in MODES.items():
+        results[mode] = {}
+        for concurrency in options.concurrency:
+            print(f"Sending {options.requests} requests ({mode}, concurrency {concurrency})...", file=sys.stderr)
+            run_id = uuid.uuid4().hex[:8]
+            # Warm up connections outside the measurement
+            await send(build_request(f"{run_id}-warmup@example.com"))
+            started, cpu_started = time.perf_counter(), time.process_time()
+            latencies = await run(send, options, concurrency, f"{mode}-{run_id}")
+            elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+            latencies.sort()
+            results[mode][concurrency] = {
+                'requests_per_second': round(options.requests / elapsed, 1),
+                'cpu_ms_per_request': round(cpu / options.requests * 1000, 3),
+                'latency_ms': {
+                    'p50': round(statistics.median(latencies) * 1000, 3),
+                    'p99': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3),
+                },
+            }
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sync and async send-email views")
+    parser.add_argument('--requests', type=int, default=2000, help="Requests per mode and concurrency")
+    parser.add_argument('--concurrency', default='1,10,100,1000',
+                        help="Comma separated numbers of requests in flight")
+    parser.add_argument('--output', help="Write the JSON report to this file instead of stdout")
+    options = parser.parse_args(argv)
+    options.concurrency = [int(c) for c in options.concurrency.split(',') if c.strip()]
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+
+    # Keep the tasks away from real workers
+    queue = f"benchmark-async-{uuid.uuid4().hex[:8]}"
+    app.conf.task_routes = {'send_email_task': {'queue': queue}}
+
+    report = {
+        'started_at': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'config': {'requests': options.requests, 'concurrency': options.concurrency},
+    }
+    try:
+        report['modes'] = asyncio.run(benchmark(options))
+    finally:
+        with app.connection_for_write() as connection:
+            connection.default_channel.queue_purge(queue)
+
+    output = json.dumps(report, indent=4)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+"""
+Throughput benchmark for the email tasks, run against a local SMTP sink
+instead of a real mail server.
+
+Each scenario sends --messages emails and reports throughput, task latency
+percentiles and peak RSS as JSON so runs can be compared over time:
+
+- single: one send_email_task per message
+- bulk: send_bulk_email_task with --bulk-size recipients per task
+- template: one send_template_email_task per message
+- attachment: one send_email_with_attachment_task per message
+
+Modes:
+- eager: tasks run one after another in this process, no broker needed
+- worker: tasks go through Redis to a Celery worker started for each
+  scenario (needs Redis running, see README). Use an otherwise idle
+  broker: tasks already queued would be picked up by the benchmark worker.
+
+Usage:
+    python -m benchmarks.email_throughput [--mode eager|worker]
+        [--scenarios single,bulk,template,attachment] [--messages 200]
+        [--latency 0.0] [--error-rate 0.0] [--drop-rate 0.0]
+        [--pool prefork|threads|gevent] [--concurrency 4]
+        [--output results.json]
+
+In worker mode the report also has worker_rss_bytes, the memory of the
+worker and all its pool processes together, for comparing pools at equal
+memory.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+# Setup Django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+import django  # noqa: E402
+django.setup()
+
+from celery import states  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from benchmarks.smtp_sink import SMTPSink  # noqa: E402
+from config.celery import app  # noqa: E402
+from email_sender.idempotency import reset_store  # noqa: E402
+from email_sender.rate_limit import reset_rate_limiter  # noqa: E402
+from email_sender.status import task_statuses  # noqa: E402
+from email_sender.tasks import (  # noqa: E402
+    send_email_task,
+    send_bulk_email_task,
+    send_template_email_task,
+    send_email_with_attachment_task,
+)
+
+SCENARIOS = ('single', 'bulk', 'template', 'attachment')
+FROM_EMAIL = 'benchmark@example.com'
+# Unique per run so sends aren't skipped as duplicates of an earlier run
+SUBJECT = f'Benchmark email {uuid.uuid4().hex[:8]}'
+MESSAGE = 'This is a benchmark email sent to a local SMTP sink.'
+HTML_MESSAGE = '<p>This is a <b>benchmark</b> email sent to a local SMTP sink.</p>'
+
+
+def build_jobs(scenario, messages, bulk_size, attachment_path):
+    """
+    Task signatures for one scenario
+
+    Returns:
+        list: (signature, number of emails it sends)
+    """
+    # Distinct per scenario, or the single and bulk sends of the same
+    # content would be skipped as duplicates of each other
+    recipients = [f"{scenario}-user{i}@example.com" for i in range(messages)]
+
+    if scenario == 'single':
+        return [(send_email_task.s(r, SUBJECT, MESSAGE, HTML_MESSAGE), 1) for r in recipients]
+    if scenario == 'bulk':
+        chunks = [recipients[i:i + bulk_size] for i in range(0, len(recipients), bulk_size)]
+        return [(send_bulk_email_task.s(c, SUBJECT, MESSAGE, HTML_MESSAGE), len(c)) for c in chunks]
+    if scenario == 'template':
+        return [
+            (send_template_email_task.s(r, SUBJECT, 'email/welcome.html', {'name': r}), 1)
+            for r in recipients
+        ]
+    if scenario == 'attachment':
+        return [
+            (send_email_with_attachment_task.s(r, SUBJECT, MESSAGE, attachment_path, 'report.bin'), 1)
+            for r in recipients
+        ]
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+def add_timings(totals, result):
+    """Add the per-stage timings of a task result to totals"""
+    if isinstance(result, dict):
+        for name, seconds in result.get('timings', {}).items():
+            totals[name] = totals.get(name, 0.0) + seconds
+
+
+def delivered(result):
+    """Number of emails a task result reports as sent"""
+    if not isinstance(result, dict):
+        return 0
+    if 'summary' in result:
+        return result['summary']['success']
+    return 1 if result.get('status') == 'success' else 0
+
+
+def percentiles(values):
+    """Nearest-rank latency percentiles in seconds"""
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+    return {
+        'p50': round(rank(50), 6),
+        'p90': round(rank(90), 6),
+        'p99': round(rank(99), 6),
+        'max': round(values[-1], 6),
+    }
+
+
+def run_eager(jobs):
+    """
+    Run the tasks one by one in this process
+
+    Returns:
+        tuple: (task latencies, emails delivered, stage timings, duration,
+            peak RSS bytes)
+    """
+    latencies = []
+    sent = 0
+    timings = {}
+    started = time.perf_counter()
+    for signature, _ in jobs:
+        task_started = time.perf_counter()
+        result = signature.apply()
+        latencies.append(time.perf_counter() - task_started)
+        sent += delivered(result.result)
+        add_timings(timings, result.result)
+    duration = time.perf_counter() - started
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return latencies, sent, timings, duration, peak_rss
+
+
+def start_worker(sink, options):
+    """Start a Celery worker that sends to the sink and wait until it answers"""
+    node_name = f"benchmark-{uuid.uuid4().hex[:8]}@{socket.gethostname()}"
+    env = dict(
+        os.environ,
+        EMAIL_HOST=sink.host,
+        EMAIL_PORT=str(sink.port),
+        EMAIL_USE_TLS='False',
+        EMAIL_HOST_USER='',
+        EMAIL_HOST_PASSWORD='',
+        DEFAULT_FROM_EMAIL=FROM_EMAIL,
+        EMAIL_ASYNC_ENGINE=str(options.async_engine),
+        EMAIL_TASK_TIMINGS='True',
+        EMAIL_RETRY_MAX_RETRIES='0',
+    )
+    command = [
+        sys.executable, '-m', 'celery', '-A', 'config', 'worker',
+        '-Q', 'transactional,bulk,attachments',
+        '--pool', options.pool,
+        '--concurrency', str(options.concurrency),
+        '--loglevel', 'WARNING',
+        '--without-gossip', '--without-mingle', '--without-heartbeat',
+        '-n', node_name,
+    ]
+    process = subprocess.Popen(command, env=env, cwd=settings.BASE_DIR, stdout=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Celery worker exited with code {process.returncode}")
+        if app.control.ping(destination=[node_name], timeout=1):
+            return process
+    process.kill()
+    raise RuntimeError("Celery worker did not start within 60 seconds")
+
+
+def process_tree_rss(pid):
+    """
+    Resident memory in bytes of a process and all its descendants, i.e. of
+    a worker and its pool processes, or None where /proc isn't available
+    """
+    if not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The fields after the parenthesized command name
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/statm') as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+        pending.extend(children.get(current, []))
+    return total
+
+
+def stop_worker(process):
+    """Warm shutdown of the worker, returning the peak RSS of its processes"""
+    process.send_signal(signal.SIGTERM)
+    _, _, usage = os.wait4(process.pid, 0)
+    process.returncode = 0
+    # Includes the pool processes the worker has reaped
+    return usage.ru_maxrss * 1024
+
+
+def run_worker(jobs, sink, options):
+    """
+    Send the tasks through the broker to a dedicated worker
+
+    Latency is measured from submitting a task to the result backend
+    recording it as done. Works with the database and the Redis result
+    backends.
+
+    Returns:
+        tuple: (task latencies, emails delivered, stage timings, duration,
+            peak RSS bytes, RSS of the whole worker when idle and at peak)
+    """
+    process = start_worker(sink, options)
+    worker_rss = {'idle': process_tree_rss(process.pid), 'peak': None}
+    try:
+        submitted = {}
+        started = time.perf_counter()
+        started_at = timezone.now()
+        for signature, _ in jobs:
+            submitted_at = timezone.now()
+            submitted[signature.apply_async().id] = submitted_at
+
+        deadline = time.monotonic() + options.timeout
+        while True:
+            statuses = task_statuses(list(submitted), include_results=False)
+            done = sum(status['status'] in states.READY_STATES for status in statuses.values())
+            rss = process_tree_rss(process.pid)
+            if rss is not None:
+                worker_rss['peak'] = max(worker_rss['peak'] or 0, rss)
+            if done == len(submitted):
+                break
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Only {done} of {len(submitted)} tasks finished within {options.timeout}s")
+            time.sleep(0.05)
+
+        finished = {task_id: app.AsyncResult(task_id).date_done for task_id in submitted}
+        latencies = [(date_done - submitted[task_id]).total_seconds() for task_id, date_done in finished.items()]
+        duration = max(
+            time.perf_counter() - started,
+            (max(finished.values()) - started_at).total_seconds(),
+        )
+        statuses = task_statuses(list(submitted))
+        sent = 0
+        timings = {}
+        for status in statuses.values():
+            sent += delivered(status.get('result'))
+            add_timings(timings, status.get('result'))
+    finally:
+        peak_rss = stop_worker(process)
+    return latencies, sent, timings, duration, peak_rss, worker_rss
+
+
+def run_scenario(scenario, sink, options, attachment_path):
+    """Run one scenario and return its report"""
+    jobs = build_jobs(scenario, options.messages, options.bulk_size, attachment_path)
+    messages = sum(count for _, count in jobs)
+    sink.reset()
+
+    worker_rss = None
+    if options.mode == 'eager':
+        latencies, sent, timings, duration, peak_rss = run_eager(jobs)
+    else:
+        latencies, sent, timings, duration, peak_rss, worker_rss = run_worker(jobs, sink, options)
+
+    report = {
+        'scenario': scenario,
+        'tasks': len(jobs),
+        'messages': messages,
+        'delivered': sent,
+        'failed': messages - sent,
+        'duration_seconds': round(duration, 6),
+        'messages_per_second': round(messages / duration, 2) if duration else None,
+        'task_latency_seconds': percentiles(latencies),
+        # Mean seconds per task spent in each stage
+        'stage_seconds': {name: round(total / len(jobs), 6) for name, total in sorted(timings.items())},
+        'peak_rss_bytes': peak_rss,
+        'sink': sink.stats(),
+    }
+    if worker_rss is not None:
+        # Summed over the worker and its pool processes, unlike
+        # peak_rss_bytes which is the largest single process
+        report['worker_rss_bytes'] = worker_rss
+    return report
+
+
+def configure_eager(sink, options):
+    """Point this process's mail settings at the sink"""
+    settings.EMAIL_BACKEND = 'email_sender.backends.EmailBackend'
+    settings.EMAIL_HOST = sink.host
+    settings.EMAIL_PORT = sink.port
+    settings.EMAIL_USE_TLS = False
+    settings.EMAIL_USE_SSL = False
+    settings.EMAIL_HOST_USER = ''
+    settings.EMAIL_HOST_PASSWORD = ''
+    settings.DEFAULT_FROM_EMAIL = FROM_EMAIL
+    settings.EMAIL_ASYNC_ENGINE = options.async_engine
+    # Measure sending, not the configured SMTP account's budget
+    settings.EMAIL_RATE_LIMIT_PER_SECOND = None
+    settings.EMAIL_RATE_LIMIT_PER_MINUTE = None
+    settings.EMAIL_RATE_LIMIT_PER_DAY = None
+    reset_rate_limiter()
+    # Status events, the shared histograms and the idempotency store need
+    # Redis, which eager mode doesn't; stage timings are read from the task
+    # results instead
+    settings.EMAIL_STATUS_EVENTS = False
+    settings.EMAIL_METRICS = False
+    settings.EMAIL_IDEMPOTENCY = False
+    reset_store()
+    settings.EMAIL_TASK_TIMINGS = True
+    # Count the sink's refusals as failures instead of retrying them later
+    settings.EMAIL_RETRY_MAX_RETRIES = 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the email tasks against a local SMTP sink")
+    parser.add_argument('--mode', choices=('eager', 'worker'), default='eager')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help="Comma separated subset of: " + ', '.join(SCENARIOS))
+    parser.add_argument('--messages', type=int, default=200, help="Emails sent per scenario")
+    parser.add_argument('--bulk-size', type=int, default=100, help="Recipients per bulk task")
+    parser.add_argument('--attachment-size', type=int, default=1024 * 1024, help="Attachment size in bytes")
+    parser.add_argument('--latency', type=float, default=0.0, help="SMTP sink delay per message in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of messages the sink refuses")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="Fraction of messages followed by a dropped connection")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--async-engine', action='store_true', help="Send bulk tasks with the asyncio engine")
+    parser.add_argument('--pool', default='prefork', help="Celery pool for worker mode")
+    parser.add_argument('--concurrency', type=int, default=4, help="Celery concurrency for worker mode")
+    parser.add_argument('--timeout', type=float, default=600, help="Seconds to wait for a scenario in worker mode")
+    parser.add_argument('--output', help="Write the JSON report to this file instead of stdout")
+    parser.add_argument('--verbose', action='store_true', help="Keep the per-email task logging")
+    options = parser.parse_args(argv)
+
+    options.scenarios = [s.strip() for s in options.scenarios.split(',') if s.strip()]
+    unknown = set(options.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    if not options.verbose:
+        logging.getLogger('email_sender').setLevel(logging.WARNING)
+
+    report = {
+        'mode': options.mode,
+        'started_at': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'config': {
+            'messages': options.messages,
+            'bulk_size': options.bulk_size,
+            'attachment_size': options.attachment_size,
+            'latency': options.latency,
+            'error_rate': options.error_rate,
+            'drop_rate': options.drop_rate,
+            'async_engine': options.async_engine,
+        },
+        'scenarios': [],
+    }
+    if options.mode == 'worker':
+        report['config'].update(pool=options.pool, concurrency=options.concurrency)
+
+    with tempfile.NamedTemporaryFile(suffix='.bin') as attachment, \
+            SMTPSink(latency=options.latency, error_rate=options.error_rate,
+                     drop_rate=options.drop_rate, seed=options.seed) as sink:
+        attachment.write(os.urandom(options.attachment_size))
+        attachment.flush()
+
+        if options.mode == 'eager':
+            configure_eager(sink, options)
+
+        for scenario in options.scenarios:
+            print(f"Running {scenario} ({options.mode})...", file=sys.stderr)
+            report['scenarios'].append(run_scenario(scenario, sink, options, attachment.name))
+
+    output = json.dumps(report, indent=4)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
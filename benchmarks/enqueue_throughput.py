@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Benchmark of queueing single emails through the API.
+
+Compares, for --emails emails:
+
+- single: one POST /api/send-email/ per email, each publishing its task
+- batch: POST /api/send-email/batch/ with --batch-size emails per request,
+  publishing their tasks in one pipelined round trip
+
+Requests go through the Django test client in this process, so the time
+is the view, validation, idempotency lookups and publishing, without an
+HTTP server. cpu_seconds is the time this process spent on the CPU, i.e.
+without waiting on Redis. Tasks are routed to a queue of their own,
+purged afterwards, so no worker sends them. Needs Redis, see README.
+
+Usage:
+    python -m benchmarks.enqueue_throughput [--emails 2000] [--batch-size 100]
+        [--output results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import uuid
+
+# Setup Django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+import django  # noqa: E402
+django.setup()
+
+from django.test.utils import setup_test_environment  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from django.utils import timezone  # noqa: E402
+from rest_framework.test import APIClient  # noqa: E402
+
+from config.celery import app  # noqa: E402
+
+
+def build_emails(count, run_id, mode):
+    """Distinct emails, so none of them is deduplicated"""
+    return [
+        {
+            'recipient_email': f"{mode}-{run_id}-user{i}@example.com",
+            'subject': f"Benchmark {i}",
+            'message': "Hello from the enqueue benchmark",
+        }
+        for i in range(count)
+    ]
+
+
+def run_single(client, emails, options):
+    url = reverse('email_sender:send_email')
+    for email in emails:
+        response = client.post(url, email, format='json')
+        assert response.status_code == 202, response.content
+
+
+def run_batch(client, emails, options):
+    url = reverse('email_sender:send_email_batch')
+    for start in range(0, len(emails), options.batch_size):
+        response = client.post(url, {'emails': emails[start:start + options.batch_size]}, format='json')
+        assert response.status_code == 202, response.content
+
+
+MODES = {
+    'single': run_single,
+    'batch': run_batch,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark queueing emails one by one and in batches")
+    parser.add_argument('--emails', type=int, default=2000, help="Emails queued per mode")
+    parser.add_argument('--batch-size', type=int, default=100, help="Emails per batch request")
+    parser.add_argument('--output', help="Write the JSON report to this file instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    run_id = uuid.uuid4().hex[:8]
+
+    # Keep the tasks away from real workers
+    queue = f"benchmark-enqueue-{run_id}"
+    app.conf.task_routes = {'send_email_task': {'queue': queue}}
+    setup_test_environment()
+    client = APIClient()
+
+    report = {
+        'started_at': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'config': {'emails': options.emails, 'batch_size': options.batch_size},
+        'modes': {},
+    }
+    try:
+        for mode, run in MODES.items():
+            print(f"Queueing {options.emails} emails ({mode})...", file=sys.stderr)
+            emails = build_emails(options.emails, run_id, mode)
+            started, cpu_started = time.perf_counter(), time.process_time()
+            run(client, emails, options)
+            elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+            report['modes'][mode] = {
+                'seconds': round(elapsed, 6),
+                'emails_per_second': round(options.emails / elapsed, 1),
+                'cpu_seconds': round(cpu, 6),
+            }
+    finally:
+        with app.connection_for_write() as connection:
+            connection.default_channel.queue_purge(queue)
+    if len(report['modes']) == len(MODES):
+        single, batch = report['modes']['single'], report['modes']['batch']
+        report['speedup'] = round(single['seconds'] / batch['seconds'], 2)
+        report['cpu_speedup'] = round(single['cpu_seconds'] / batch['cpu_seconds'], 2)
+
+    output = json.dumps(report, indent=4)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Benchmark of recipient list validation in the bulk email serializer.
+
+Compares, for lists of each --sizes length:
+
+- drf: the previous ListField(child=EmailField()), one field per address
+- fast: RecipientListField, one pass of validate_recipients
+
+Lists are generated with --invalid-rate invalid and --duplicate-rate
+repeated addresses, in mixed case. Each path is timed --repeat times and
+the best run is reported as JSON, along with the addresses per second and
+the speedup of the fast path.
+
+Usage:
+    python -m benchmarks.recipient_validation [--sizes 1000,10000,100000]
+        [--invalid-rate 0.001] [--duplicate-rate 0.01] [--repeat 3]
+        [--output results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+# Setup Django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+import django  # noqa: E402
+django.setup()
+
+from django.utils import timezone  # noqa: E402
+from rest_framework import serializers  # noqa: E402
+
+from email_sender.serializers import RecipientListField  # noqa: E402
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+
+class DRFRecipientListSerializer(serializers.Serializer):
+    """The bulk serializer's recipient list as it was validated before"""
+    recipient_list = serializers.ListField(child=serializers.EmailField())
+
+
+class FastRecipientListSerializer(serializers.Serializer):
+    recipient_list = RecipientListField()
+
+
+PATHS = {
+    'drf': DRFRecipientListSerializer,
+    'fast': FastRecipientListSerializer,
+}
+
+
+def build_recipients(size, invalid_rate, duplicate_rate, seed):
+    """Recipient list with some invalid, repeated and mixed case addresses"""
+    rng = random.Random(seed)
+    domains = ['example.com', 'mail.example.org', 'Example.NET', 'sub.domain.co.uk']
+    recipients = []
+    for i in range(size):
+        roll = rng.random()
+        if roll < invalid_rate:
+            recipients.append(rng.choice([f"user{i}", f"user{i}@", f"user{i}@@example.com", f"user {i}@example.com"]))
+        elif roll < invalid_rate + duplicate_rate and recipients:
+            recipients.append(rng.choice(recipients))
+        else:
+            name = f"User.{i}" if rng.random() < 0.2 else f"user{i}+tag"
+            recipients.append(f"{name}@{rng.choice(domains)}")
+    return recipients
+
+
+def time_path(serializer_class, recipients, repeat):
+    """Best time of validating the list, with the outcome of the last run"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        serializer = serializer_class(data={'recipient_list': recipients})
+        valid = serializer.is_valid()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    outcome = {'seconds': round(best, 6), 'addresses_per_second': round(len(recipients) / best, 1)}
+    if valid:
+        outcome['accepted'] = len(serializer.validated_data['recipient_list'])
+    else:
+        outcome['errors'] = len(serializer.errors['recipient_list'])
+    return outcome
+
+
+def run_size(size, options):
+    recipients = build_recipients(size, options.invalid_rate, options.duplicate_rate, options.seed)
+    report = {'size': size}
+    for name, serializer_class in PATHS.items():
+        report[name] = time_path(serializer_class, recipients, options.repeat)
+    report['speedup'] = round(report['drf']['seconds'] / report['fast']['seconds'], 2)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark bulk recipient list validation")
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help="Comma separated list lengths")
+    parser.add_argument('--invalid-rate', type=float, default=0.001, help="Fraction of invalid addresses")
+    parser.add_argument('--duplicate-rate', type=float, default=0.01, help="Fraction of repeated addresses")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per path, the best is reported")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="Write the JSON report to this file instead of stdout")
+    options = parser.parse_args(argv)
+    options.sizes = [int(s) for s in options.sizes.split(',') if s.strip()]
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    report = {
+        'started_at': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'config': {
+            'invalid_rate': options.invalid_rate,
+            'duplicate_rate': options.duplicate_rate,
+            'repeat': options.repeat,
+        },
+        'sizes': [],
+    }
+    for size in options.sizes:
+        print(f"Validating {size} addresses...", file=sys.stderr)
+        report['sizes'].append(run_size(size, options))
+
+    output = json.dumps(report, indent=4)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
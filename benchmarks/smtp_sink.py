@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+Local SMTP stand-in for benchmarks.
+
+Accepts every message without delivering it and can be made to behave like
+a slow or unreliable server:
+
+- latency: seconds to wait before acknowledging each message
+- error_rate: fraction of messages answered with a temporary 451 failure
+- drop_rate: fraction of messages after which the connection is dropped
+  without an answer
+
+Usage:
+    python -m benchmarks.smtp_sink [--port 1025] [--latency 0.01]
+                                   [--error-rate 0.0] [--drop-rate 0.0]
+"""
+import argparse
+import random
+import socket
+import socketserver
+import threading
+import time
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough SMTP for smtplib and aiosmtplib"""
+
+    def setup(self):
+        super().setup()
+        # Answer straight away instead of waiting on Nagle's algorithm, which
+        # would add tens of milliseconds per message to every measurement
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b"\r\n")
+
+    def handle(self):
+        sink = self.server.sink
+        sink.count('connections')
+        self.reply("220 smtp-sink ESMTP ready")
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip().upper()
+
+            if command.startswith('EHLO'):
+                self.reply("250-smtp-sink")
+                self.reply("250-8BITMIME")
+                self.reply("250 SIZE 0")
+            elif command.startswith('HELO'):
+                self.reply("250 smtp-sink")
+            elif command.startswith('DATA'):
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = self.read_data()
+                if size is None:
+                    return
+
+                outcome = sink.outcome()
+                if sink.latency:
+                    time.sleep(sink.latency)
+                if outcome == 'drop':
+                    sink.count('drops')
+                    return
+                if outcome == 'error':
+                    sink.count('errors')
+                    self.reply("451 4.3.0 Temporary failure, try again later")
+                    continue
+                sink.count('accepted')
+                sink.count('bytes', size)
+                self.reply("250 2.0.0 Ok: queued")
+            elif command.startswith('QUIT'):
+                self.reply("221 2.0.0 Bye")
+                return
+            else:
+                # MAIL, RCPT, RSET, NOOP...
+                self.reply("250 2.0.0 Ok")
+
+    def read_data(self):
+        """Read a message up to the terminating period, returning its size"""
+        size = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+            if line == b".\r\n":
+                return size
+            size += len(line)
+
+
+class SMTPSinkServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class SMTPSink:
+    """
+    In-process SMTP server running on a background thread
+
+    Usage:
+        with SMTPSink(latency=0.01) as sink:
+            # point EMAIL_HOST/EMAIL_PORT at sink.host/sink.port
+            ...
+        print(sink.stats())
+    """
+
+    COUNTERS = ('connections', 'accepted', 'errors', 'drops', 'bytes')
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, drop_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(self.COUNTERS, 0)
+
+        self.server = SMTPSinkServer((host, port), SMTPSinkHandler)
+        self.server.sink = self
+        self.host, self.port = self.server.server_address
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def outcome(self):
+        """Decide whether the next message is accepted, refused or dropped"""
+        with self._lock:
+            roll = self._random.random()
+        if roll < self.drop_rate:
+            return 'drop'
+        if roll < self.drop_rate + self.error_rate:
+            return 'error'
+        return 'ok'
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] += n
+
+    def reset(self):
+        with self._lock:
+            self._counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local SMTP sink")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1025)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds before acknowledging a message")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of messages refused with 451")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="Fraction of messages followed by a dropped connection")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.host, args.port, args.latency, args.error_rate, args.drop_rate, args.seed)
+    sink.start()
+    print(f"SMTP sink listening on {sink.host}:{sink.port} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(10)
+            print(sink.stats())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.stop()
+        print(sink.stats())
+
+
+if __name__ == '__main__':
+    main()
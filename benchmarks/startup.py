@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Startup time report for the processes this project runs.
+
+For each entry point, a fresh interpreter is started --repeat times and
+the median wall time of its startup work is reported, together with an
+import time breakdown (python -X importtime) of one more run:
+
+- django: django.setup(), what every management command and script such
+  as check_task.py pays
+- worker: what a new Celery worker imports before its first task, i.e.
+  django.setup(), the Celery app and every app's tasks module
+- web: django.setup() and the URLconf, i.e. every view, serializer and
+  task module, as on the first request
+
+The breakdown lists the modules with the largest cumulative import time
+and the self time summed per top-level package.
+
+With --first-task, a Celery worker is also started --repeat times with a
+task already queued, and the time from spawning it to the task being
+recorded as done is reported (needs Redis, see README).
+
+Usage:
+    python -m benchmarks.startup [--entry-points django,worker,web]
+        [--repeat 5] [--top 15] [--first-task] [--output startup.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+SETUP = (
+    "import os\n"
+    "os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')\n"
+    "import django\n"
+    "django.setup()\n"
+)
+
+# Code run by each entry point after django.setup()
+ENTRY_POINTS = {
+    'django': "",
+    'worker': (
+        "from config.celery import app\n"
+        "app.loader.import_default_modules()\n"
+    ),
+    'web': (
+        "from django.urls import get_resolver\n"
+        "get_resolver().url_patterns\n"
+    ),
+}
+
+TIMED = (
+    "import time\n"
+    "started = time.perf_counter()\n"
+    "{code}"
+    "print(time.perf_counter() - started)\n"
+)
+
+
+def run_entry_point(name, importtime=False):
+    """
+    Run an entry point in a fresh interpreter
+
+    Returns:
+        tuple: (startup seconds, -X importtime output or None)
+    """
+    code = TIMED.format(code=SETUP + ENTRY_POINTS[name])
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    completed = subprocess.run(command, cwd=BASE_DIR, capture_output=True, text=True, check=True)
+    return float(completed.stdout.strip().splitlines()[-1]), completed.stderr if importtime else None
+
+
+def parse_importtime(output):
+    """(module, self seconds, cumulative seconds) per line of -X importtime output"""
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line.split(':', 1)[1].split('|')
+        modules.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return modules
+
+
+def import_breakdown(output, top):
+    """Largest imports by cumulative time, and self time per top-level package"""
+    modules = parse_importtime(output)
+    packages = {}
+    for name, self_seconds, _ in modules:
+        package = name.split('.', 1)[0]
+        packages[package] = packages.get(package, 0.0) + self_seconds
+
+    return {
+        'modules_imported': len(modules),
+        'import_seconds': round(sum(self_seconds for _, self_seconds, _ in modules), 6),
+        'slowest_modules': [
+            {'module': name, 'cumulative_seconds': round(cumulative, 6), 'self_seconds': round(self_seconds, 6)}
+            for name, self_seconds, cumulative in sorted(modules, key=lambda m: m[2], reverse=True)[:top]
+        ],
+        'packages': {
+            package: round(seconds, 6)
+            for package, seconds in sorted(packages.items(), key=lambda p: p[1], reverse=True)[:top]
+        },
+    }
+
+
+def report_entry_point(name, options):
+    timings = [run_entry_point(name)[0] for _ in range(options.repeat)]
+    _, output = run_entry_point(name, importtime=True)
+    return {
+        'entry_point': name,
+        'startup_seconds': {
+            'median': round(statistics.median(timings), 6),
+            'min': round(min(timings), 6),
+            'max': round(max(timings), 6),
+        },
+        **import_breakdown(output, options.top),
+    }
+
+
+def time_to_first_task(options):
+    """
+    Seconds from spawning a worker to it finishing a task that was queued
+    before it started, over --repeat fresh workers
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    import django
+    django.setup()
+
+    from config.celery import app
+    from tasks.tasks import test_connection_task
+
+    timings = []
+    for _ in range(options.repeat):
+        # A queue of its own, so no other worker takes the task
+        queue = f"startup-{uuid.uuid4().hex[:8]}"
+        result = test_connection_task.apply_async(queue=queue)
+        spawned = time.time()
+        process = subprocess.Popen(
+            [
+                sys.executable, '-m', 'celery', '-A', 'config', 'worker',
+                '-Q', queue, '--pool', options.pool, '--concurrency', '1',
+                '--loglevel', 'WARNING',
+                '-n', f"{queue}@%h",
+            ],
+            cwd=BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            result.get(timeout=options.timeout)
+            timings.append(app.AsyncResult(result.id).date_done.timestamp() - spawned)
+        finally:
+            process.terminate()
+            process.wait()
+    return {
+        'pool': options.pool,
+        'median': round(statistics.median(timings), 6),
+        'min': round(min(timings), 6),
+        'max': round(max(timings), 6),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Report the startup time of the project's processes")
+    parser.add_argument('--entry-points', default=','.join(ENTRY_POINTS),
+                        help="Comma separated subset of: " + ', '.join(ENTRY_POINTS))
+    parser.add_argument('--repeat', type=int, default=5, help="Fresh processes per measurement")
+    parser.add_argument('--top', type=int, default=15, help="Modules and packages listed per entry point")
+    parser.add_argument('--first-task', action='store_true', help="Also time a new worker's first task")
+    parser.add_argument('--pool', default='solo', help="Celery pool of the workers timed with --first-task")
+    parser.add_argument('--timeout', type=float, default=60, help="Seconds to wait for a first task")
+    parser.add_argument('--output', help="Write the JSON report to this file instead of stdout")
+    options = parser.parse_args(argv)
+
+    options.entry_points = [e.strip() for e in options.entry_points.split(',') if e.strip()]
+    unknown = set(options.entry_points) - set(ENTRY_POINTS)
+    if unknown:
+        parser.error(f"unknown entry points: {', '.join(sorted(unknown))}")
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    report = {
+        'python': platform.python_version(),
+        'repeat': options.repeat,
+        'entry_points': [],
+    }
+    for name in options.entry_points:
+        print(f"Timing {name} startup...", file=sys.stderr)
+        report['entry_points'].append(report_entry_point(name, options))
+    if options.first_task:
+        print("Timing a new worker's first task...", file=sys.stderr)
+        report['first_task_seconds'] = time_to_first_task(options)
+
+    output = json.dumps(report, indent=4)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
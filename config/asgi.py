@@ -3,6 +3,11 @@ ASGI config for config project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve it with an ASGI server (``uvicorn config.asgi:application``) so the
+Server-Sent Events status streams are held open without tying up a thread
+per browser tab, and the send and status endpoints are served by async
+views (EMAIL_ASYNC_VIEWS) that wait on Redis on the event loop.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -12,5 +17,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+# Serve the send and status endpoints with their async views
+os.environ.setdefault('EMAIL_ASYNC_VIEWS', 'True')
 
 application = get_asgi_application()
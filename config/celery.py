@@ -1,9 +1,21 @@
+import logging
 import os
 from celery import Celery
+from celery.signals import worker_init
+from kombu import Queue
+
+# Configure logger
+logger = logging.getLogger(__name__)
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
+# Workers skip Django's system checks at startup: they import the URLconf,
+# i.e. every view, serializer and DRF module, none of which a task needs.
+# The checks still run with manage.py (check, migrate, runserver). Set
+# CELERY_SKIP_CHECKS= (empty) to run them in workers as well.
+os.environ.setdefault('CELERY_SKIP_CHECKS', '1')
+
 app = Celery('celery_email_project')
 
 # Using a string here means the worker doesn't have to serialize
@@ -18,8 +30,109 @@ app.conf.timezone = 'Asia/Kolkata'
 # Redis as broker
 app.conf.broker_url = 'redis://localhost:6379/0'
 
-# Django Celery Results as backend
-app.conf.result_backend = 'django-db'
+# Result backend (django-db or Redis) and result expiry come from
+# CELERY_RESULT_BACKEND and CELERY_RESULT_EXPIRES in settings
+
+# Separate queues so latency-sensitive mail never waits behind campaigns:
+# - transactional: single and template emails
+# - bulk: bulk sends, mail merges and their chord callbacks
+# - attachments: emails with (possibly large) attachments
+# - maintenance: housekeeping and diagnostic tasks
+app.conf.task_queues = (
+    Queue('transactional'),
+    Queue('bulk'),
+    Queue('attachments'),
+    Queue('maintenance'),
+)
+app.conf.task_default_queue = 'transactional'
+app.conf.task_routes = {
+    'send_email_task': {'queue': 'transactional'},
+    'send_outbox_batch_task': {'queue': 'transactional'},
+    'send_template_email_task': {'queue': 'transactional'},
+    'send_bulk_email_task': {'queue': 'bulk'},
+    'send_mail_merge_task': {'queue': 'bulk'},
+    'merge_bulk_email_results_task': {'queue': 'bulk'},
+    'send_email_with_attachment_task': {'queue': 'attachments'},
+    'purge_recipient_uploads_task': {'queue': 'maintenance'},
+    'purge_body_store_task': {'queue': 'maintenance'},
+    'dispatch_outbox_task': {'queue': 'maintenance'},
+    'test_connection_task': {'queue': 'maintenance'},
+    'long_running_task': {'queue': 'maintenance'},
+    'config.celery.debug_task': {'queue': 'maintenance'},
+}
+
+# Per-message priorities within a queue. With the Redis transport a lower
+# number is served first.
+TASK_PRIORITIES = {
+    'high': 0,
+    'normal': 5,
+    'low': 9,
+}
+app.conf.task_default_priority = TASK_PRIORITIES['normal']
+app.conf.broker_transport_options = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+}
+
+# Reserve one message at a time so a worker busy with a long bulk task
+# doesn't sit on transactional mail that another worker could send
+app.conf.worker_prefetch_multiplier = 1
+
+# Worker pool and concurrency come from CELERY_WORKER_POOL and
+# CELERY_WORKER_CONCURRENCY in settings, or -P / -c on the command line.
+
+# The thread and greenlet pools fetch messages in a blocking loop that, once
+# every reserved message is running, only fetches again after its poll
+# times out (seconds later). Reserving a second message per thread keeps
+# the pool busy meanwhile. That is only done for workers that consume
+# nothing but IO_POOL_PREFETCH_QUEUES: a reserved message waits for a busy
+# thread, and transactional mail shouldn't wait while another worker is idle.
+IO_POOL_PREFETCH_MULTIPLIER = 2
+IO_POOL_PREFETCH_QUEUES = {'bulk', 'attachments'}
+
+
+def _pool_name(pool_cls):
+    """'threads', 'gevent'... from a pool name or pool class"""
+    if isinstance(pool_cls, str):
+        return pool_cls
+    module = getattr(pool_cls, '__module__', '')
+    return 'threads' if module.endswith('.thread') else module.rsplit('.', 1)[-1]
+
+
+@worker_init.connect
+def configure_worker_pool(sender=None, **kwargs):
+    """
+    Tune a worker for the pool it was started with, from settings or -P,
+    and the queues it consumes from (-Q)
+
+    Also warns when the gevent pool runs without monkey-patching: Celery
+    only patches the standard library for a pool given on the command line
+    (-P gevent), before anything else is imported. Chosen from settings
+    alone, the greenlets would block each other on every socket.
+    """
+    pool = _pool_name(getattr(sender, 'pool_cls', None))
+    queues = set(sender.app.amqp.queues.consume_from)
+    if pool in ('threads', 'gevent', 'eventlet') and queues <= IO_POOL_PREFETCH_QUEUES:
+        sender.prefetch_multiplier = max(sender.prefetch_multiplier, IO_POOL_PREFETCH_MULTIPLIER)
+    if pool == 'gevent':
+        from gevent import monkey
+        if not monkey.is_module_patched('socket'):
+            logger.error("The gevent pool needs the standard library patched: start the worker with -P gevent")
+
+
+@worker_init.connect
+def configure_worker_startup(sender=None, **kwargs):
+    """
+    Start taking tasks without first syncing with the other workers
+    (mingle), which waits a full second for their replies, unless
+    EMAIL_WORKER_MINGLE is set
+    """
+    from django.conf import settings
+
+    if not getattr(settings, 'EMAIL_WORKER_MINGLE', False):
+        sender.options['without_mingle'] = True
+
 
 # Load task modules from all registered Django apps.
 app.autodiscover_tasks()
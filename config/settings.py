@@ -12,14 +12,16 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
-from dotenv import load_dotenv
-
-# Load environment variables from .env file
-load_dotenv()
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Load environment variables from the .env file, if there is one; python-dotenv
+# is only imported when it is, which saves every process the import
+if (BASE_DIR / '.env').exists():
+    from dotenv import load_dotenv
+    load_dotenv(BASE_DIR / '.env')
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -92,6 +94,11 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Wait for concurrent writers (workers storing results) instead of
+        # failing straight away with "database is locked"
+        'OPTIONS': {
+            'timeout': 20,
+        },
     }
 }
 
@@ -144,23 +151,224 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Celery Configuration
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
-CELERY_RESULT_BACKEND = 'django-db'
+
+# Result backend: 'django-db' stores every task result in the database,
+# which means one SQLite write per finished task. 'redis' keeps results in
+# Redis, expiring after CELERY_RESULT_EXPIRES seconds, and only writes a
+# summary of a sample (EMAIL_RESULT_AUDIT_SAMPLE_RATE) of the results plus
+# every failure to the database for auditing. The status endpoints read
+# from both, so results written before a switch stay visible.
+EMAIL_RESULT_BACKEND = os.getenv('EMAIL_RESULT_BACKEND', 'django-db')
+EMAIL_RESULT_REDIS_URL = os.getenv('EMAIL_RESULT_REDIS_URL', 'redis://localhost:6379/1')
+EMAIL_RESULT_AUDIT_SAMPLE_RATE = float(os.getenv('EMAIL_RESULT_AUDIT_SAMPLE_RATE', 0.01))
+CELERY_RESULT_BACKEND = EMAIL_RESULT_REDIS_URL if EMAIL_RESULT_BACKEND == 'redis' else 'django-db'
+CELERY_RESULT_EXPIRES = int(os.getenv('CELERY_RESULT_EXPIRES', 86400))
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+# 'zlib' or 'gzip' compresses task messages on top of the JSON serializer;
+# workers decompress whatever a message says it was compressed with
+CELERY_TASK_COMPRESSION = os.getenv('CELERY_TASK_COMPRESSION') or None
 CELERY_TIMEZONE = TIME_ZONE
 
+# Worker pool: 'prefork' runs one process per concurrent task. Email tasks
+# spend nearly all their time waiting on SMTP, Redis and the database, so
+# 'threads' or 'gevent' run many of them in one process instead ('gevent'
+# also needs -P gevent on the worker command line). Without
+# CELERY_WORKER_CONCURRENCY the concurrency is EMAIL_WORKER_POOL_CONCURRENCY
+# for the pool, or one per CPU.
+CELERY_WORKER_POOL = os.getenv('CELERY_WORKER_POOL', 'prefork')
+EMAIL_WORKER_POOL_CONCURRENCY = {
+    'threads': 50,
+    'gevent': 200,
+}
+CELERY_WORKER_CONCURRENCY = (
+    int(os.getenv('CELERY_WORKER_CONCURRENCY', 0))
+    or EMAIL_WORKER_POOL_CONCURRENCY.get(CELERY_WORKER_POOL)
+)
+
+# Worker startup: a new worker normally spends a second asking the running
+# workers for the task ids they have revoked ("mingle") before it takes its
+# first task. Nothing here revokes tasks, so that is skipped unless
+# EMAIL_WORKER_MINGLE is set. Django's system checks are skipped as well
+# (CELERY_SKIP_CHECKS, see config/celery.py).
+EMAIL_WORKER_MINGLE = os.getenv('EMAIL_WORKER_MINGLE', 'False') == 'True'
+
+# Async API views: with EMAIL_ASYNC_VIEWS, the send-email, send-email/batch
+# and email-status endpoints are served by async views that wait on Redis
+# without holding a thread. It is switched on by config.asgi, so it only
+# needs setting to serve the sync views under ASGI ('False').
+EMAIL_ASYNC_VIEWS = os.getenv('EMAIL_ASYNC_VIEWS', 'False') == 'True'
+
+# Cluster-wide SMTP send budgets (token buckets shared by all workers through
+# Redis), e.g. EMAIL_RATE_LIMIT_PER_DAY = 500 for a free Gmail account. A
+# budget left as None is not enforced. Sends block for up to
+# EMAIL_RATE_LIMIT_MAX_WAIT seconds; longer waits re-queue the task with an
+# ETA. Use EMAIL_RATE_LIMIT_BACKEND = 'memory' for tests.
+EMAIL_RATE_LIMIT_PER_SECOND = None
+EMAIL_RATE_LIMIT_PER_MINUTE = None
+EMAIL_RATE_LIMIT_PER_DAY = None
+EMAIL_RATE_LIMIT_MAX_WAIT = 5
+EMAIL_RATE_LIMIT_BACKEND = 'redis'
+EMAIL_RATE_LIMIT_REDIS_URL = CELERY_BROKER_URL
+
+# Largest number of emails accepted by the batch send endpoint
+EMAIL_BATCH_MAX_EMAILS = 1000
+
+# Largest number of task ids accepted by the batch status endpoint
+EMAIL_STATUS_BATCH_MAX_IDS = 1000
+
+# Workers publish task state transitions to Redis pub/sub so the dashboard
+# can stream them over Server-Sent Events instead of polling
+EMAIL_STATUS_EVENTS = True
+EMAIL_STATUS_REDIS_URL = CELERY_BROKER_URL
+EMAIL_STATUS_STREAM_KEEPALIVE = 15
+EMAIL_STATUS_STREAM_MAX_DURATION = 300
+# Seconds between status checks where the dashboard can't be streamed
+# transitions: under WSGI, and for the groups of fanned out bulk sends
+EMAIL_STATUS_POLL_INTERVAL = 2
+
+# Per-stage timing of the email tasks (render, strip_tags, mime,
+# attachment_read, throttle, smtp_connect, smtp_tls, smtp_auth, smtp_data,
+# total). Histograms per task type are kept in Redis and served in the
+# Prometheus text format at /api/metrics/. EMAIL_TASK_TIMINGS also adds each
+# run's breakdown to its task result under "timings".
+EMAIL_METRICS = True
+EMAIL_METRICS_REDIS_URL = CELERY_BROKER_URL
+EMAIL_METRICS_BUCKETS = None
+EMAIL_TASK_TIMINGS = os.getenv('EMAIL_TASK_TIMINGS', 'False') == 'True'
+
+# Idempotent sends: requests are deduplicated by the client's
+# idempotency_key only, so the same email can still be sent twice on
+# purpose. Each send is keyed by that key, or else by its task id, which
+# catches redelivered tasks. A key that was sent successfully in the last
+# EMAIL_IDEMPOTENCY_TTL seconds is not sent again; the original result is
+# returned instead. Keys are claimed in Redis for up to
+# EMAIL_IDEMPOTENCY_LOCK_TIMEOUT seconds while a send is in flight, and a
+# task that finds its key claimed checks again after
+# EMAIL_IDEMPOTENCY_RETRY_DELAY seconds. Sent keys are also cached in each
+# worker (EMAIL_IDEMPOTENCY_CACHE_SIZE entries).
+EMAIL_IDEMPOTENCY = os.getenv('EMAIL_IDEMPOTENCY', 'True') == 'True'
+EMAIL_IDEMPOTENCY_REDIS_URL = CELERY_BROKER_URL
+EMAIL_IDEMPOTENCY_TTL = 86400
+EMAIL_IDEMPOTENCY_LOCK_TIMEOUT = 300
+EMAIL_IDEMPOTENCY_RETRY_DELAY = 30
+EMAIL_IDEMPOTENCY_CACHE_SIZE = 10000
+
+# Outbox: with EMAIL_OUTBOX, single email requests are written to the
+# OutboxEmail table in the request's transaction instead of being queued.
+# Celery beat runs dispatch_outbox_task every EMAIL_OUTBOX_INTERVAL seconds,
+# which claims due emails in batches of EMAIL_OUTBOX_BATCH_SIZE (at most
+# EMAIL_OUTBOX_MAX_BATCHES per run), each sent over one SMTP session.
+# Claims older than EMAIL_OUTBOX_CLAIM_TIMEOUT seconds (a worker died
+# mid-batch) are taken over by the next run.
+EMAIL_OUTBOX = os.getenv('EMAIL_OUTBOX', 'False') == 'True'
+EMAIL_OUTBOX_INTERVAL = float(os.getenv('EMAIL_OUTBOX_INTERVAL', 5))
+EMAIL_OUTBOX_BATCH_SIZE = 200
+EMAIL_OUTBOX_MAX_BATCHES = 10
+EMAIL_OUTBOX_CLAIM_TIMEOUT = 300
+
+# Claim-check storage of large bodies: with EMAIL_BODY_STORE set to 'redis'
+# or 'disk', a message or html_message of at least
+# EMAIL_BODY_STORE_THRESHOLD characters is stored once, zlib-compressed,
+# under its SHA-256 and only the hash goes into the task message. Bodies
+# not checked in again for EMAIL_BODY_STORE_TTL seconds expire: Redis
+# expires them itself, the disk store (EMAIL_BODY_STORE_PATH, which must be
+# shared by web servers and workers) is purged by purge_body_store_task.
+# Each worker keeps the last EMAIL_BODY_CACHE_SIZE bodies it fetched in
+# memory.
+EMAIL_BODY_STORE = os.getenv('EMAIL_BODY_STORE', '')
+EMAIL_BODY_STORE_THRESHOLD = int(os.getenv('EMAIL_BODY_STORE_THRESHOLD', 4096))
+EMAIL_BODY_STORE_REDIS_URL = CELERY_BROKER_URL
+EMAIL_BODY_STORE_PATH = BASE_DIR / 'body_store'
+EMAIL_BODY_STORE_TTL = 7 * 86400
+EMAIL_BODY_CACHE_SIZE = 256
+
 # Celery Beat settings
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+# Installed into the database scheduler when beat starts
+CELERY_BEAT_SCHEDULE = {}
+if EMAIL_OUTBOX:
+    CELERY_BEAT_SCHEDULE['dispatch-email-outbox'] = {
+        'task': 'dispatch_outbox_task',
+        'schedule': EMAIL_OUTBOX_INTERVAL,
+    }
+if EMAIL_BODY_STORE == 'disk':
+    CELERY_BEAT_SCHEDULE['purge-email-body-store'] = {
+        'task': 'purge_body_store_task',
+        'schedule': 3600,
+    }
 
 # Email settings
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
-EMAIL_HOST = 'smtp.gmail.com'
-EMAIL_PORT = 587
+# Django's SMTP backend plus per-stage timing (see EMAIL_METRICS below)
+EMAIL_BACKEND = 'email_sender.backends.EmailBackend'
+EMAIL_HOST = os.environ.get('EMAIL_HOST', 'smtp.gmail.com')
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 587))
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
-EMAIL_USE_TLS = True
-DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
+EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', 'True') == 'True'
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL') or EMAIL_HOST_USER
+
+# Bulk sending: how many times a shared SMTP session may be re-opened
+# when the server drops it mid-batch
+EMAIL_MAX_RECONNECTS = 3
+
+# Bulk and mail merge sends can instead run on an asyncio engine that keeps
+# EMAIL_ASYNC_CONCURRENCY SMTP sessions busy from one worker process (needs
+# aiosmtplib and the SMTP backend). Messages are built and sent in batches
+# of EMAIL_ASYNC_BATCH_SIZE.
+EMAIL_ASYNC_ENGINE = os.getenv('EMAIL_ASYNC_ENGINE', 'False') == 'True'
+EMAIL_ASYNC_CONCURRENCY = 10
+EMAIL_ASYNC_BATCH_SIZE = 500
+
+# Multi-recipient delivery: with EMAIL_MULTI_RCPT, bulk sends (same content
+# for everyone, not mail merge) go out as one message per envelope of up to
+# EMAIL_MULTI_RCPT_MAX recipients of the same domain, with RCPT TO for each
+# and EMAIL_MULTI_RCPT_TO as the To header. Only enable it for a relay that
+# accepts that many recipients per message. It needs EMAIL_BACKEND to be
+# email_sender.backends.EmailBackend (or a subclass), which reports refused
+# recipients; with any other backend it is ignored. Envelopes are also kept within
+# the smallest EMAIL_RATE_LIMIT_* budget. Bulk and mail merge lists are
+# grouped by domain before being split into chunks either way.
+EMAIL_MULTI_RCPT = os.getenv('EMAIL_MULTI_RCPT', 'False') == 'True'
+EMAIL_MULTI_RCPT_MAX = int(os.getenv('EMAIL_MULTI_RCPT_MAX', 50))
+EMAIL_MULTI_RCPT_TO = 'undisclosed-recipients:;'
+
+# Template emails: seconds between checks for edited template files, and how
+# many rendered (html, plain text) pairs each worker keeps in its LRU cache
+EMAIL_TEMPLATE_CHECK_INTERVAL = 2
+EMAIL_RENDER_CACHE_SIZE = 256
+
+# Mail merge: recipients rendered and sent per task
+EMAIL_MAIL_MERGE_CHUNK_SIZE = 500
+
+# Retries of transient SMTP failures (4xx replies, dropped connections,
+# timeouts): up to EMAIL_RETRY_MAX_RETRIES, waiting EMAIL_RETRY_BACKOFF
+# seconds doubled per retry (capped at EMAIL_RETRY_BACKOFF_MAX) with jitter.
+# Bulk and mail merge tasks re-queue only the recipients that failed.
+# Permanent failures (5xx replies) are never retried.
+EMAIL_RETRY_MAX_RETRIES = int(os.getenv('EMAIL_RETRY_MAX_RETRIES', 5))
+EMAIL_RETRY_BACKOFF = float(os.getenv('EMAIL_RETRY_BACKOFF', 30))
+EMAIL_RETRY_BACKOFF_MAX = 600
+
+# Recipient file uploads: valid addresses are stored in chunks of this many,
+# each sent by one bulk task. At most EMAIL_UPLOAD_MAX_ERRORS rejected rows
+# are listed in the response, and chunks are kept for
+# EMAIL_UPLOAD_RETENTION_DAYS (see purge_recipient_uploads_task).
+EMAIL_UPLOAD_CHUNK_SIZE = 1000
+EMAIL_UPLOAD_MAX_ERRORS = 100
+EMAIL_UPLOAD_RETENTION_DAYS = 7
+
+# Compact bulk results: per-recipient outcomes are written to the delivery
+# log table in batches of this many rows
+EMAIL_DELIVERY_LOG_BATCH_SIZE = 500
+
+# Attachments are streamed into the SMTP session in chunks of this many bytes.
+# Larger files are rejected, and a send that would push the worker process
+# past EMAIL_TASK_MEMORY_LIMIT fails fast with status "rejected".
+EMAIL_ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+EMAIL_ATTACHMENT_MAX_SIZE = 25 * 1024 * 1024
+EMAIL_TASK_MEMORY_LIMIT = int(os.environ.get('EMAIL_TASK_MEMORY_LIMIT_MB', 512)) * 1024 * 1024
 
 # Logging configuration
 LOGGING = {
@@ -187,6 +395,8 @@ LOGGING = {
             'class': 'logging.FileHandler',
             'filename': BASE_DIR / 'logs' / 'email-tasks.log',
             'formatter': 'verbose',
+            # Open the file on the first record, not at startup
+            'delay': True,
         },
     },
     'loggers': {
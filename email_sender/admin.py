@@ -1,3 +1,24 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import DeliveryLog, OutboxEmail, RecipientChunk
+
+
+@admin.register(DeliveryLog)
+class DeliveryLogAdmin(admin.ModelAdmin):
+    list_display = ('recipient', 'status', 'task_id', 'created_at')
+    list_filter = ('status',)
+    search_fields = ('recipient', 'task_id')
+
+
+@admin.register(RecipientChunk)
+class RecipientChunkAdmin(admin.ModelAdmin):
+    list_display = ('upload_id', 'index', 'count', 'created_at')
+    search_fields = ('upload_id',)
+    exclude = ('recipients',)
+
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('recipient', 'subject', 'status', 'attempts', 'created_at', 'sent_at')
+    list_filter = ('status',)
+    search_fields = ('recipient', 'idempotency_key')
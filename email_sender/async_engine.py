@@ -0,0 +1,202 @@
+import asyncio
+import importlib.util
+import logging
+
+from celery.signals import worker_init
+from django.conf import settings
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
+from django.core.mail.message import sanitize_address
+from django.utils.module_loading import import_string
+
+from .metrics import stage
+from .rate_limit import RateLimited, athrottle
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+def async_engine_enabled():
+    """
+    Whether bulk and mail merge sends should go through the asyncio engine
+
+    Needs EMAIL_ASYNC_ENGINE, aiosmtplib and the SMTP mail backend; anything
+    else (e.g. the locmem backend in tests) keeps the synchronous path.
+    aiosmtplib itself is only imported by workers that will use it (see
+    preload_aiosmtplib), not by every process that imports the tasks.
+    """
+    return (
+        getattr(settings, 'EMAIL_ASYNC_ENGINE', False)
+        and importlib.util.find_spec('aiosmtplib') is not None
+        and issubclass(import_string(settings.EMAIL_BACKEND), SMTPEmailBackend)
+    )
+
+
+@worker_init.connect
+def preload_aiosmtplib(**kwargs):
+    """Import aiosmtplib in the worker before forking the pool, if it will be used"""
+    if async_engine_enabled():
+        import aiosmtplib  # noqa: F401
+
+
+class AsyncSMTPEngine:
+    """
+    Sends batches of messages over up to EMAIL_ASYNC_CONCURRENCY concurrent
+    SMTP sessions multiplexed on one event loop inside the worker process.
+
+    Sessions stay open between batches and are closed when the engine is.
+
+    Usage:
+        with AsyncSMTPEngine() as engine:
+            outcomes = engine.send_batch(messages)
+        stats = engine.stats()
+
+    Each outcome is (sent, error) in the order of the messages, or None for
+    messages that were not attempted because the rate limiter asked to wait
+    longer than EMAIL_RATE_LIMIT_MAX_WAIT; engine.rate_limited then holds
+    the RateLimited error.
+    """
+
+    def __init__(self, concurrency=None, max_reconnects=None):
+        if concurrency is None:
+            concurrency = getattr(settings, 'EMAIL_ASYNC_CONCURRENCY', 10)
+        if max_reconnects is None:
+            max_reconnects = getattr(settings, 'EMAIL_MAX_RECONNECTS', 3)
+        self.concurrency = concurrency
+        self.max_reconnects = max_reconnects
+        self.connections_opened = 0
+        self.reconnects = 0
+        self.messages_sent = 0
+        self.rate_limited = None
+        self.loop = None
+        self._idle = []
+
+    def __enter__(self):
+        self.loop = asyncio.new_event_loop()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.loop.run_until_complete(self._close_all())
+        finally:
+            self.loop.close()
+        return False
+
+    async def _connect(self):
+        import aiosmtplib
+
+        smtp = aiosmtplib.SMTP(
+            hostname=settings.EMAIL_HOST,
+            port=settings.EMAIL_PORT,
+            username=settings.EMAIL_HOST_USER or None,
+            password=settings.EMAIL_HOST_PASSWORD or None,
+            use_tls=getattr(settings, 'EMAIL_USE_SSL', False),
+            start_tls=settings.EMAIL_USE_TLS or False,
+            timeout=getattr(settings, 'EMAIL_TIMEOUT', None) or 60,
+        )
+        with stage('smtp_connect'):
+            await smtp.connect()
+        self.connections_opened += 1
+        return smtp
+
+    async def _close(self, smtp):
+        try:
+            await smtp.quit()
+        except Exception:
+            smtp.close()
+
+    async def _close_all(self):
+        idle, self._idle = self._idle, []
+        for smtp in idle:
+            await self._close(smtp)
+
+    async def _send_one(self, smtp, email):
+        """Send one message, reconnecting if the session was dropped"""
+        import aiosmtplib
+
+        encoding = email.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(email.from_email, encoding)
+        recipients = [sanitize_address(addr, encoding) for addr in email.recipients()]
+        with stage('mime'):
+            message = email.message().as_bytes(linesep='\r\n')
+
+        attempts = 0
+        while True:
+            try:
+                if smtp is None:
+                    smtp = await self._connect()
+                with stage('smtp_data'):
+                    refused, _ = await smtp.sendmail(from_email, recipients, message)
+                self.messages_sent += 1
+                if refused:
+                    # Some recipients of a multi-recipient message were refused
+                    return smtp, (1, aiosmtplib.SMTPRecipientsRefused([
+                        aiosmtplib.SMTPRecipientRefused(response.code, response.message, address)
+                        for address, response in refused.items()
+                    ]))
+                return smtp, (1, None)
+            except (aiosmtplib.SMTPServerDisconnected, ConnectionError) as e:
+                if smtp is not None:
+                    smtp.close()
+                smtp = None
+                if attempts >= self.max_reconnects:
+                    return smtp, (0, e)
+                attempts += 1
+                self.reconnects += 1
+                logger.warning(f"SMTP session dropped ({str(e)}), reconnecting")
+            except Exception as e:
+                return smtp, (0, e)
+
+    async def _send_batch(self, messages):
+        outcomes = [None] * len(messages)
+        pending = asyncio.Queue()
+        for index in range(len(messages)):
+            pending.put_nowait(index)
+
+        async def session_worker():
+            smtp = self._idle.pop() if self._idle else None
+            try:
+                while self.rate_limited is None:
+                    try:
+                        index = pending.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                    try:
+                        await athrottle(max(1, len(messages[index].recipients())))
+                    except RateLimited as e:
+                        self.rate_limited = e
+                        break
+                    smtp, outcomes[index] = await self._send_one(smtp, messages[index])
+            finally:
+                if smtp is not None:
+                    self._idle.append(smtp)
+
+        workers = min(self.concurrency, len(messages))
+        await asyncio.gather(*(session_worker() for _ in range(workers)))
+        return outcomes
+
+    def send_batch(self, messages):
+        """
+        Send a batch of messages concurrently
+
+        Args:
+            messages (list): EmailMessage instances
+
+        Returns:
+            list: (sent, error) per message, or None if it was not attempted
+        """
+        if not messages or self.rate_limited is not None:
+            return [None] * len(messages)
+        return self.loop.run_until_complete(self._send_batch(messages))
+
+    def stats(self):
+        """Connection reuse counters suitable for a task result"""
+        return {
+            "engine": "async",
+            "concurrency": self.concurrency,
+            "connections_opened": self.connections_opened,
+            "reconnects": self.reconnects,
+            "messages_sent": self.messages_sent,
+            "messages_per_connection": (
+                round(self.messages_sent / self.connections_opened, 2)
+                if self.connections_opened else 0
+            ),
+        }
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+
+import redis.asyncio as aioredis
+
+
+class AutoPipeline:
+    """
+    Sends the Redis commands of concurrent requests on an event loop to
+    Redis together, one pipeline at a time
+
+    Commands queued while a pipeline is in flight go out in the next one,
+    so under load each round trip carries the commands of every request
+    that was waiting instead of one request's, over a single connection.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.pipe = None
+        # (future, index of the first command, index after the last)
+        self.waiters = []
+        self.flusher = None
+
+    async def execute(self, queue):
+        """
+        Add commands to the next pipeline and wait for their results
+
+        Args:
+            queue (callable): Called with the pipeline to add the commands
+                to, e.g. lambda pipe: pipe.mget(keys)
+
+        Returns:
+            list: Result per command added
+
+        Raises:
+            redis.RedisError: If Redis can't be reached or a command failed
+        """
+        if self.pipe is None:
+            self.pipe = self.client.pipeline(transaction=False)
+        start = len(self.pipe.command_stack)
+        queue(self.pipe)
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((future, start, len(self.pipe.command_stack)))
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self._flush())
+        return await future
+
+    async def _flush(self):
+        try:
+            while self.waiters:
+                pipe, waiters = self.pipe, self.waiters
+                self.pipe, self.waiters = None, []
+                try:
+                    results = await pipe.execute(raise_on_error=False)
+                except Exception as e:
+                    # Nothing was answered, so every waiter gets the error
+                    for future, _, _ in waiters:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for future, start, end in waiters:
+                    if future.done():
+                        continue
+                    own = results[start:end]
+                    error = next((result for result in own if isinstance(result, Exception)), None)
+                    if error is not None:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(own)
+        finally:
+            self.flusher = None
+
+
+# event loop -> {url: AutoPipeline}
+_pipelines = {}
+_pipelines_lock = threading.Lock()
+
+
+def get_auto_pipeline(url):
+    """
+    AutoPipeline to the Redis server at url, shared by everything running
+    on the current event loop
+
+    The connections of an async client belong to the loop that opened them,
+    so there is one per loop and URL. Under an ASGI server that is one per
+    URL for the life of the process. Those of loops that have been closed
+    are dropped.
+
+    Args:
+        url (str): Redis URL
+    """
+    loop = asyncio.get_running_loop()
+    pipelines = _pipelines.get(loop)
+    if pipelines is None:
+        with _pipelines_lock:
+            for closed in [other for other in _pipelines if other.is_closed()]:
+                del _pipelines[closed]
+            pipelines = _pipelines.setdefault(loop, {})
+    pipeline = pipelines.get(url)
+    if pipeline is None:
+        client = aioredis.Redis.from_url(url, socket_connect_timeout=1, socket_timeout=5)
+        pipeline = pipelines[url] = AutoPipeline(client)
+    return pipeline
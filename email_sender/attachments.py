@@ -0,0 +1,194 @@
+import base64
+import logging
+import mimetypes
+import os
+import re
+import resource
+import smtplib
+import uuid
+from email.mime.base import MIMEBase
+
+from django.conf import settings
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
+from django.core.mail.message import DEFAULT_ATTACHMENT_MIME_TYPE, sanitize_address
+
+from .metrics import stage
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# base64 turns every 57 input bytes into one 76 character line, so reading
+# in multiples of 57 keeps the encoded lines identical to a one-shot encode
+BASE64_LINE_BYTES = 57
+
+
+class AttachmentTooLarge(Exception):
+    """Raised when an attachment would push the task over its memory ceiling"""
+
+
+def current_rss_bytes():
+    """Resident set size of this process, falling back to the peak RSS"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def check_memory_ceiling(extra_bytes=0):
+    """
+    Fail fast if sending would take the worker past EMAIL_TASK_MEMORY_LIMIT
+
+    Args:
+        extra_bytes (int): Memory the send is expected to allocate on top
+            of the current RSS
+
+    Raises:
+        AttachmentTooLarge: If the projected RSS is above the limit
+    """
+    limit = getattr(settings, 'EMAIL_TASK_MEMORY_LIMIT', None)
+    if not limit:
+        return
+    projected = current_rss_bytes() + extra_bytes
+    if projected > limit:
+        raise AttachmentTooLarge(
+            f"Sending would use about {projected / (1024 * 1024):.1f} MB, "
+            f"above the {limit / (1024 * 1024):.1f} MB task memory limit"
+        )
+
+
+def check_attachment_size(attachment_path):
+    """
+    Reject attachments above EMAIL_ATTACHMENT_MAX_SIZE before reading them
+
+    Raises:
+        AttachmentTooLarge: If the file is above the configured maximum
+    """
+    size = os.path.getsize(attachment_path)
+    max_size = getattr(settings, 'EMAIL_ATTACHMENT_MAX_SIZE', None)
+    if max_size and size > max_size:
+        raise AttachmentTooLarge(
+            f"Attachment is {size / (1024 * 1024):.1f} MB, "
+            f"above the {max_size / (1024 * 1024):.1f} MB limit"
+        )
+    return size
+
+
+def supports_streaming(connection):
+    """Whether the mail backend talks SMTP directly and can be streamed to"""
+    return isinstance(connection, SMTPEmailBackend)
+
+
+def _placeholder_part(filename, mimetype, marker):
+    """MIME part whose body is a marker that the file contents replace"""
+    mimetype = mimetype or mimetypes.guess_type(filename)[0] or DEFAULT_ATTACHMENT_MIME_TYPE
+    maintype, subtype = mimetype.split('/', 1)
+    part = MIMEBase(maintype, subtype)
+    part.add_header('Content-Transfer-Encoding', 'base64')
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    part.set_payload(marker)
+    return part
+
+
+def _iter_base64(attachment_path, chunk_size):
+    """Read a file in chunks and yield its base64 encoding with CRLF lines"""
+    chunk_size = max(BASE64_LINE_BYTES, chunk_size - chunk_size % BASE64_LINE_BYTES)
+    with open(attachment_path, 'rb') as attachment:
+        while True:
+            chunk = attachment.read(chunk_size)
+            if not chunk:
+                break
+            yield base64.encodebytes(chunk).replace(b'\n', b'\r\n')
+
+
+def _quote_periods(data):
+    """SMTP dot-stuffing for lines that start with a period"""
+    return re.sub(rb'(?m)^\.', b'..', data)
+
+
+def stream_email_with_attachment(connection, email, attachment_path, filename, mimetype=None):
+    """
+    Send email with a file attached, streaming the file into the SMTP DATA
+    command instead of building the whole message in memory
+
+    Only one chunk of the file (EMAIL_ATTACHMENT_CHUNK_SIZE bytes) and its
+    base64 encoding are held in memory at a time.
+
+    Args:
+        connection (EmailBackend): Django SMTP backend to send with
+        email (EmailMessage): Message without the attachment
+        attachment_path (str): Path to the attachment file
+        filename (str): Filename shown to the recipient
+        mimetype (str, optional): Attachment content type, guessed if omitted
+
+    Returns:
+        int: Number of messages sent (0 or 1)
+    """
+    recipients = email.recipients()
+    if not recipients:
+        return 0
+
+    marker = f"attachment-{uuid.uuid4().hex}"
+    email.attach(_placeholder_part(filename, mimetype, marker))
+
+    encoding = email.encoding or settings.DEFAULT_CHARSET
+    from_email = sanitize_address(email.from_email, encoding)
+    recipients = [sanitize_address(addr, encoding) for addr in recipients]
+    with stage('mime'):
+        prefix, suffix = email.message().as_bytes(linesep='\r\n').split(marker.encode('ascii'), 1)
+    if not prefix.endswith(b'\r\n'):
+        prefix += b'\r\n'
+
+    chunk_size = getattr(settings, 'EMAIL_ATTACHMENT_CHUNK_SIZE', 1024 * 1024)
+
+    new_connection = connection.open()
+    smtp = connection.connection
+    try:
+        with stage('smtp_data'):
+            smtp.ehlo_or_helo_if_needed()
+            code, response = smtp.mail(from_email)
+            if code != 250:
+                raise smtplib.SMTPSenderRefused(code, response, from_email)
+            for recipient in recipients:
+                code, response = smtp.rcpt(recipient)
+                if code not in (250, 251):
+                    raise smtplib.SMTPRecipientsRefused({recipient: (code, response)})
+            code, response = smtp.docmd('data')
+            if code != 354:
+                raise smtplib.SMTPDataError(code, response)
+            smtp.send(_quote_periods(prefix))
+
+        sent_any = False
+        chunks = _iter_base64(attachment_path, chunk_size)
+        while True:
+            with stage('attachment_read'):
+                encoded = next(chunks, None)
+            if encoded is None:
+                break
+            with stage('smtp_data'):
+                smtp.send(encoded)
+            sent_any = True
+
+        with stage('smtp_data'):
+            # The encoded file already ends with a line break
+            if sent_any and suffix.startswith(b'\r\n'):
+                suffix = suffix[2:]
+            if not suffix.endswith(b'\r\n'):
+                suffix += b'\r\n'
+            smtp.send(_quote_periods(suffix) + b'.\r\n')
+
+            code, response = smtp.getreply()
+            if code != 250:
+                raise smtplib.SMTPDataError(code, response)
+    except smtplib.SMTPException:
+        # Leave the session usable for the next message
+        try:
+            smtp.rset()
+        except smtplib.SMTPException:
+            pass
+        raise
+    finally:
+        if new_connection:
+            connection.close()
+    return 1
@@ -0,0 +1,68 @@
+import smtplib
+
+from django.conf import settings
+from django.core.mail.backends import smtp
+from django.core.mail.message import sanitize_address
+
+from .metrics import stage
+
+
+class TimedSMTPMixin:
+    """Times the phases of an SMTP session as email task stages"""
+
+    def connect(self, *args, **kwargs):
+        with stage('smtp_connect'):
+            return super().connect(*args, **kwargs)
+
+    def starttls(self, *args, **kwargs):
+        with stage('smtp_tls'):
+            return super().starttls(*args, **kwargs)
+
+    def login(self, *args, **kwargs):
+        with stage('smtp_auth'):
+            return super().login(*args, **kwargs)
+
+    def sendmail(self, *args, **kwargs):
+        with stage('smtp_data'):
+            return super().sendmail(*args, **kwargs)
+
+
+class TimedSMTP(TimedSMTPMixin, smtplib.SMTP):
+    pass
+
+
+class TimedSMTP_SSL(TimedSMTPMixin, smtplib.SMTP_SSL):
+    pass
+
+
+class EmailBackend(smtp.EmailBackend):
+    """
+    Django's SMTP backend with per-stage timing of connect, TLS, auth, MIME
+    construction and the DATA transfer
+    """
+
+    @property
+    def connection_class(self):
+        return TimedSMTP_SSL if self.use_ssl else TimedSMTP
+
+    # Recipients the server refused in the last send, while accepting others
+    refused = {}
+
+    def _send(self, email_message):
+        """Same as Django's _send, with MIME construction timed on its own"""
+        self.refused = {}
+        if not email_message.recipients():
+            return False
+        encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(email_message.from_email, encoding)
+        recipients = [sanitize_address(addr, encoding) for addr in email_message.recipients()]
+        with stage('mime'):
+            message = email_message.message().as_bytes(linesep='\r\n')
+        try:
+            # Recipients refused while others were accepted, see BatchSession
+            self.refused = self.connection.sendmail(from_email, recipients, message)
+        except smtplib.SMTPException:
+            if not self.fail_silently:
+                raise
+            return False
+        return True
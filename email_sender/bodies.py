@@ -0,0 +1,243 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+import zlib
+
+import redis
+from django.conf import settings
+
+from .rendering import LRUCache
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Key of a claim check in place of a body in task arguments
+CLAIM_CHECK = 'claim_check'
+
+
+class BodyMissing(Exception):
+    """Raised when a claim-checked body is no longer in the store"""
+
+    def __init__(self, digest):
+        self.digest = digest
+        super().__init__(f"Email body {digest} is missing from the body store")
+
+
+class RedisBodyStore:
+    """Bodies kept in Redis for EMAIL_BODY_STORE_TTL seconds"""
+
+    def __init__(self, url, ttl=7 * 86400, prefix='email-body'):
+        self.client = redis.Redis.from_url(url, socket_connect_timeout=1, socket_timeout=5)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, digest):
+        return f"{self.prefix}:{digest}"
+
+    def touch(self, digest):
+        """Renew the expiry of a stored body; False if it isn't stored"""
+        return bool(self.client.expire(self._key(digest), self.ttl))
+
+    def put(self, digest, data):
+        self.client.set(self._key(digest), data, ex=self.ttl)
+
+    def get(self, digest):
+        return self.client.get(self._key(digest))
+
+
+class DiskBodyStore:
+    """
+    Bodies kept as files under EMAIL_BODY_STORE_PATH, which has to be shared
+    by the web servers and the workers. A file's mtime is renewed whenever
+    its body is checked in again; purge() deletes files that haven't been
+    for EMAIL_BODY_STORE_TTL seconds.
+    """
+
+    def __init__(self, path, ttl=7 * 86400):
+        self.path = str(path)
+        self.ttl = ttl
+
+    def _path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def touch(self, digest):
+        """Renew the mtime of a stored body; False if it isn't stored"""
+        try:
+            os.utime(self._path(digest))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def put(self, digest, data):
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so a worker never reads a half written body
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, digest):
+        try:
+            with open(self._path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def purge(self, older_than=None):
+        """
+        Delete bodies (and leftover temporary files) not checked in for
+        older_than seconds, EMAIL_BODY_STORE_TTL by default
+
+        Returns:
+            int: Number of files deleted
+        """
+        cutoff = time.time() - (self.ttl if older_than is None else older_than)
+        deleted = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.unlink(path)
+                        deleted += 1
+                except FileNotFoundError:
+                    continue
+        return deleted
+
+
+class ClaimCheck:
+    """
+    Content-addressed storage of large email bodies, so task messages carry
+    a hash instead of the body.
+
+    Bodies of at least EMAIL_BODY_STORE_THRESHOLD bytes are zlib-compressed
+    and stored once under their SHA-256; the same body sent again (another
+    chunk of a bulk send, the same newsletter to many single sends) only has
+    its expiry renewed in the store, and is uploaded again only if the store
+    no longer has it. Workers keep the last EMAIL_BODY_CACHE_SIZE fetched
+    bodies in an LRU cache.
+    """
+
+    def __init__(self, store, threshold=4096, cache_size=256):
+        self.store = store
+        self.threshold = threshold
+        # digest -> body, for workers
+        self.bodies = LRUCache(maxsize=cache_size)
+
+    def check_in(self, body):
+        """The body, or a claim check for it if it is large enough to store"""
+        if not isinstance(body, str) or len(body) < self.threshold:
+            return body
+        data = body.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        # Ask the store rather than remembering uploads here: it may have
+        # evicted the body since
+        if not self.store.touch(digest):
+            self.store.put(digest, zlib.compress(data))
+        self.bodies.put(digest, body)
+        return {CLAIM_CHECK: digest}
+
+    def check_out(self, value):
+        """
+        The body a claim check stands for, or the value itself if it isn't one
+
+        Raises:
+            BodyMissing: If the body has expired from the store
+        """
+        if not isinstance(value, dict) or CLAIM_CHECK not in value:
+            return value
+        digest = value[CLAIM_CHECK]
+        body = self.bodies.get(digest)
+        if body is None:
+            data = self.store.get(digest)
+            if data is None:
+                raise BodyMissing(digest)
+            body = zlib.decompress(data).decode('utf-8')
+            self.bodies.put(digest, body)
+        return body
+
+
+_claim_check = None
+_claim_check_lock = threading.Lock()
+
+
+def get_claim_check():
+    """The process-wide claim check, or None when EMAIL_BODY_STORE is off"""
+    global _claim_check
+    if _claim_check is None:
+        with _claim_check_lock:
+            if _claim_check is None:
+                kind = getattr(settings, 'EMAIL_BODY_STORE', None)
+                ttl = getattr(settings, 'EMAIL_BODY_STORE_TTL', 7 * 86400)
+                if kind == 'redis':
+                    url = getattr(settings, 'EMAIL_BODY_STORE_REDIS_URL', None) or settings.CELERY_BROKER_URL
+                    store = RedisBodyStore(url, ttl=ttl)
+                elif kind == 'disk':
+                    store = DiskBodyStore(settings.EMAIL_BODY_STORE_PATH, ttl=ttl)
+                else:
+                    store = None
+                _claim_check = ClaimCheck(
+                    store,
+                    threshold=getattr(settings, 'EMAIL_BODY_STORE_THRESHOLD', 4096),
+                    cache_size=getattr(settings, 'EMAIL_BODY_CACHE_SIZE', 256),
+                ) if store is not None else False
+    return _claim_check or None
+
+
+def reset_claim_check():
+    """Forget the process-wide claim check so it is rebuilt from settings"""
+    global _claim_check
+    with _claim_check_lock:
+        _claim_check = None
+
+
+def check_in(body):
+    """
+    Body to put in a task message: a claim check for large bodies when the
+    body store is on, otherwise the body itself. Falls back to the body if
+    the store can't be written.
+    """
+    claim_check = get_claim_check()
+    if claim_check is None:
+        return body
+    try:
+        return claim_check.check_in(body)
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Body store unavailable, sending the body in the task: {str(e)}")
+        return body
+
+
+def check_out(value):
+    """
+    Body from a task argument that may be a claim check
+
+    Raises:
+        BodyMissing: If the body has expired from the store
+    """
+    if not isinstance(value, dict):
+        return value
+    claim_check = get_claim_check()
+    if claim_check is None:
+        raise BodyMissing(value.get(CLAIM_CHECK))
+    return claim_check.check_out(value)
+
+
+def purge_body_store():
+    """
+    Delete expired bodies from the disk store; Redis expires its own
+
+    Returns:
+        int: Number of files deleted
+    """
+    claim_check = get_claim_check()
+    if claim_check is None or not isinstance(claim_check.store, DiskBodyStore):
+        return 0
+    return claim_check.store.purge()
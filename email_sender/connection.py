@@ -0,0 +1,159 @@
+import logging
+import smtplib
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+from .rate_limit import RateLimited, throttle
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Errors that mean the SMTP session is gone and a fresh one should be opened
+DISCONNECT_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError)
+
+
+class SMTPSession:
+    """
+    A single reusable connection to the mail server.
+
+    Opens the connection lazily on the first send, keeps it open for every
+    following message and transparently reconnects when the server drops the
+    session mid-batch.
+
+    Usage:
+        with SMTPSession() as session:
+            for email in messages:
+                session.send(email)
+        stats = session.stats()
+    """
+
+    def __init__(self, connection=None, max_reconnects=None):
+        self.connection = connection or get_connection(fail_silently=False)
+        if max_reconnects is None:
+            max_reconnects = getattr(settings, 'EMAIL_MAX_RECONNECTS', 3)
+        self.max_reconnects = max_reconnects
+        self.connections_opened = 0
+        self.reconnects = 0
+        self.messages_sent = 0
+        self._is_open = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def open(self):
+        """Open the underlying connection if it is not already open"""
+        if not self._is_open:
+            self.connection.open()
+            self._is_open = True
+            self.connections_opened += 1
+
+    def close(self):
+        """Close the underlying connection, ignoring errors from a dead session"""
+        if self._is_open:
+            try:
+                self.connection.close()
+            except Exception as e:
+                logger.warning(f"Error closing SMTP connection: {str(e)}")
+            self._is_open = False
+
+    def reconnect(self):
+        """Drop the current connection and open a new one"""
+        self.close()
+        self.reconnects += 1
+        self.open()
+
+    def send(self, email):
+        """
+        Send a single message over the shared connection, reconnecting if the
+        server drops the session.
+
+        Args:
+            email (EmailMessage): Message to send
+
+        Returns:
+            int: Number of messages sent (0 or 1)
+
+        Raises:
+            RateLimited: If the send budget is exhausted for too long
+        """
+        # Budgets count recipients, a multi-recipient message uses several
+        throttle(max(1, len(email.recipients())))
+        self.open()
+        attempts = 0
+        while True:
+            try:
+                sent = self.connection.send_messages([email]) or 0
+                break
+            except DISCONNECT_ERRORS as e:
+                if attempts >= self.max_reconnects:
+                    raise
+                attempts += 1
+                logger.warning(f"SMTP session dropped ({str(e)}), reconnecting")
+                self.reconnect()
+
+        self.messages_sent += sent
+        return sent
+
+    def stats(self):
+        """Connection reuse counters suitable for a task result"""
+        return {
+            "connections_opened": self.connections_opened,
+            "reconnects": self.reconnects,
+            "messages_sent": self.messages_sent,
+            "messages_per_connection": (
+                round(self.messages_sent / self.connections_opened, 2)
+                if self.connections_opened else 0
+            ),
+        }
+
+
+class BatchSession(SMTPSession):
+    """
+    An SMTPSession with the send_batch() interface of AsyncSMTPEngine,
+    sending the messages of a batch one after the other
+
+    Used for multi-recipient messages: recipients the server refused while
+    accepting others are reported as an SMTPRecipientsRefused error on an
+    otherwise sent message. Only email_sender.backends.EmailBackend keeps
+    those refusals (see planner.multi_rcpt_enabled).
+
+    Usage:
+        with BatchSession() as session:
+            outcomes = session.send_batch(messages)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limited = None
+
+    def send_batch(self, messages):
+        """
+        Send a batch of messages over the session
+
+        Args:
+            messages (list): EmailMessage instances
+
+        Returns:
+            list: (sent, error) per message, or None if it was not attempted
+                because the rate limiter asked to wait too long
+        """
+        outcomes = [None] * len(messages)
+        for index, email in enumerate(messages):
+            if self.rate_limited is not None:
+                break
+            try:
+                sent = self.send(email)
+            except RateLimited as e:
+                self.rate_limited = e
+                break
+            except Exception as e:
+                outcomes[index] = (0, e)
+                continue
+            refused = getattr(self.connection, 'refused', None)
+            outcomes[index] = (sent, smtplib.SMTPRecipientsRefused(refused) if refused else None)
+        return outcomes
@@ -0,0 +1,130 @@
+import uuid
+
+from django.conf import settings
+
+from .models import DeliveryLog
+
+
+class DeliveryRecorder:
+    """
+    Collects per-recipient outcomes of a bulk or mail merge task.
+
+    In the default mode every result is kept and returned, as before. In
+    compact mode only failures are kept in memory; every outcome is written
+    to the DeliveryLog table in batches of EMAIL_DELIVERY_LOG_BATCH_SIZE rows
+    and the task result carries just the counters, the failures and the id
+    to page the log by.
+    """
+
+    def __init__(self, task_id=None, compact=False, batch_size=None, resume=None):
+        if batch_size is None:
+            batch_size = getattr(settings, 'EMAIL_DELIVERY_LOG_BATCH_SIZE', 500)
+        self.task_id = task_id or str(uuid.uuid4())
+        self.compact = compact
+        self.batch_size = batch_size
+        self.success_count = 0
+        self.failure_count = 0
+        self.logged_count = 0
+        self.results = []
+        self.failures = []
+        self._pending = []
+
+        # Carry over what an earlier, deferred run of the task recorded
+        if resume:
+            self.success_count = resume["summary"]["success"]
+            self.failure_count = resume["summary"]["failed"]
+            self.results = list(resume.get("results", []))
+            self.failures = list(resume.get("failures", []))
+            self.logged_count = resume.get("delivery_log", {}).get("entries", 0)
+
+    @property
+    def processed(self):
+        """Number of outcomes recorded so far"""
+        return self.success_count + self.failure_count
+
+    def record(self, recipient, result):
+        """
+        Record the outcome of sending to one recipient
+
+        Args:
+            recipient (str): Email address of the recipient
+            result (dict): Result dict of the send
+        """
+        if result["status"] == "success":
+            self.success_count += 1
+        else:
+            self.failure_count += 1
+
+        if not self.compact:
+            self.results.append(result)
+            return
+
+        if result["status"] != "success":
+            self.failures.append({**result, "recipient": recipient})
+        self._pending.append(DeliveryLog(
+            task_id=self.task_id,
+            recipient=recipient,
+            status=result["status"],
+            message=result.get("message", ""),
+        ))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered outcomes to the delivery log"""
+        if self._pending:
+            DeliveryLog.objects.bulk_create(self._pending)
+            self.logged_count += len(self._pending)
+            self._pending = []
+
+    def result(self, total):
+        """
+        Task result for the recorded outcomes
+
+        Args:
+            total (int): Number of recipients the task was given
+        """
+        result = {
+            "status": "completed",
+            "summary": {
+                "total": total,
+                "success": self.success_count,
+                "failed": self.failure_count,
+            },
+        }
+        if self.compact:
+            self.flush()
+            result["failures"] = self.failures
+            result["delivery_log"] = {
+                "task_id": self.task_id,
+                "entries": self.logged_count,
+            }
+        else:
+            result["results"] = self.results
+        return result
+
+
+def delivery_log_page(task_ids, status=None, after=None, limit=100):
+    """
+    One page of delivery log entries, ordered by id
+
+    Args:
+        task_ids (list): Task ids whose deliveries to list
+        status (str, optional): Only entries with this status
+        after (int, optional): Return entries with an id above this one
+        limit (int): Maximum number of entries
+
+    Returns:
+        tuple: (list of entry dicts, id to pass as after for the next page or None)
+    """
+    entries = DeliveryLog.objects.filter(task_id__in=task_ids)
+    if status:
+        entries = entries.filter(status=status)
+    if after:
+        entries = entries.filter(id__gt=after)
+
+    page = list(entries.order_by('id').values(
+        'id', 'task_id', 'recipient', 'status', 'message', 'created_at'
+    )[:limit + 1])
+    next_after = page[limit - 1]['id'] if len(page) > limit else None
+    return page[:limit], next_after
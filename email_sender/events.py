@@ -0,0 +1,168 @@
+import asyncio
+import json
+import logging
+import threading
+
+import redis
+import redis.asyncio as aioredis
+from asgiref.sync import sync_to_async
+from celery import states
+from celery.signals import task_prerun, task_postrun, task_retry
+from django.conf import settings
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def status_channel(task_id):
+    """Redis pub/sub channel carrying the state transitions of a task"""
+    return f"email-status:{task_id}"
+
+
+def _redis_url():
+    return getattr(settings, 'EMAIL_STATUS_REDIS_URL', None) or settings.CELERY_BROKER_URL
+
+
+def get_client():
+    """Redis client used by workers to publish state transitions"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = redis.Redis.from_url(_redis_url(), socket_connect_timeout=1, socket_timeout=1)
+    return _client
+
+
+def publish_status(task_id, state):
+    """
+    Publish a state transition for task_id to anyone streaming its status
+
+    Args:
+        task_id (str): Celery task id
+        state (str): New Celery state
+    """
+    if not getattr(settings, 'EMAIL_STATUS_EVENTS', True) or not task_id:
+        return
+    try:
+        get_client().publish(status_channel(task_id), json.dumps({"task_id": task_id, "status": state}))
+    except redis.RedisError as e:
+        logger.warning(f"Could not publish status of task {task_id}: {str(e)}")
+
+
+@task_prerun.connect
+def publish_task_started(task_id=None, **kwargs):
+    publish_status(task_id, states.STARTED)
+
+
+@task_retry.connect
+def publish_task_retry(request=None, **kwargs):
+    publish_status(getattr(request, 'id', None), states.RETRY)
+
+
+@task_postrun.connect
+def publish_task_finished(task_id=None, state=None, **kwargs):
+    # postrun fires after the result has been stored, so subscribers can
+    # read the final result as soon as they hear about it
+    publish_status(task_id, state)
+
+
+def _sse(data, event=None):
+    """Format one Server-Sent Event"""
+    message = f"data: {json.dumps(data)}\n\n"
+    if event:
+        message = f"event: {event}\n{message}"
+    return message
+
+
+def poll_events(status):
+    """
+    Server-Sent Events telling the dashboard to poll the status endpoint:
+    the current status, then a "poll" event with the interval in seconds
+
+    Sent when the stream can't be held open, i.e. outside ASGI, where every
+    open stream would tie up a server thread.
+
+    Args:
+        status (dict): Current status of the task
+    """
+    interval = getattr(settings, 'EMAIL_STATUS_POLL_INTERVAL', 2)
+    return _sse(status, event="status") + _sse({"interval": interval}, event="poll")
+
+
+async def _poll_group(task_id, status, get_status, deadline):
+    """
+    Status events of a group, whose chunk tasks publish their own
+    transitions but not the group's: its progress is re-read every
+    EMAIL_STATUS_POLL_INTERVAL seconds and sent when it changes
+    """
+    interval = getattr(settings, 'EMAIL_STATUS_POLL_INTERVAL', 2)
+    loop = asyncio.get_running_loop()
+    while loop.time() < deadline:
+        await asyncio.sleep(interval)
+        latest = await get_status(task_id)
+        if latest == status:
+            yield ": keepalive\n\n"
+            continue
+        status = latest
+        yield _sse(status, event="status")
+        if status["status"] in states.READY_STATES:
+            return
+    yield _sse({"task_id": task_id}, event="timeout")
+
+
+async def status_event_stream(task_id, get_status):
+    """
+    Async iterator of Server-Sent Events for one task
+
+    Sends the current status straight away and then one event per state
+    transition published by the workers, closing once the task is ready.
+    Between transitions only a keepalive comment is sent every
+    EMAIL_STATUS_STREAM_KEEPALIVE seconds. Groups of chunk tasks have their
+    progress polled instead.
+
+    Args:
+        task_id (str): Celery task or group id
+        get_status (callable): Returns the status dict of a task id
+    """
+    keepalive = getattr(settings, 'EMAIL_STATUS_STREAM_KEEPALIVE', 15)
+    max_duration = getattr(settings, 'EMAIL_STATUS_STREAM_MAX_DURATION', 300)
+    get_status = sync_to_async(get_status)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_duration
+
+    client = aioredis.Redis.from_url(_redis_url())
+    pubsub = client.pubsub()
+    try:
+        # Subscribe before reading the current status so no transition is missed
+        await pubsub.subscribe(status_channel(task_id))
+
+        status = await get_status(task_id)
+        yield _sse(status, event="status")
+        if status["status"] in states.READY_STATES:
+            return
+        if 'progress' in status:
+            async for event in _poll_group(task_id, status, get_status, deadline):
+                yield event
+            return
+
+        while loop.time() < deadline:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=keepalive)
+            if message is None:
+                yield ": keepalive\n\n"
+                continue
+
+            event = json.loads(message["data"])
+            if event["status"] in states.READY_STATES:
+                yield _sse(await get_status(task_id), event="status")
+                return
+            yield _sse(event, event="status")
+
+        # Let the browser's EventSource reconnect with a fresh stream
+        yield _sse({"task_id": task_id}, event="timeout")
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+        await client.aclose()
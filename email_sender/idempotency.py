@@ -0,0 +1,404 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+from .async_redis import get_auto_pipeline
+from .rendering import LRUCache
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Value of a send key while the send is in flight
+PENDING = 'pending'
+
+
+class SendInProgress(Exception):
+    """Raised when another worker is still sending the same email"""
+
+    def __init__(self, key, wait):
+        self.key = key
+        self.wait = wait
+        super().__init__(f"Email {key} is already being sent, retry in {wait}s")
+
+
+def idempotency_key(*parts):
+    """
+    Stable key for a send, hashed from what makes it unique
+
+    Args:
+        *parts: JSON serializable values, e.g. recipient, subject and body
+    """
+    encoded = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def recipient_key(key, recipient):
+    """
+    Key of one recipient of a multi-recipient send, derived from the key of
+    the whole send, or None without one
+    """
+    if key:
+        return idempotency_key(key, recipient)
+    return None
+
+
+class IdempotencyStore:
+    """
+    Remembers which emails were sent, and what the send returned, in Redis.
+
+    A send first claims its key with SET NX. Once it succeeds the result is
+    stored for EMAIL_IDEMPOTENCY_TTL seconds so a redelivered task or a
+    retried request gets the original result back instead of sending again.
+    Failed sends release the key so they can be retried. Stored results are
+    also kept in a per-process LRU cache to save the Redis round trip for
+    repeats seen by the same worker, until they expire in Redis.
+    """
+
+    def __init__(self, url, ttl=86400, lock_timeout=300, cache_size=10000, prefix='email-idem'):
+        self.url = url
+        self.client = redis.Redis.from_url(url, socket_connect_timeout=1, socket_timeout=1)
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.prefix = prefix
+        self.cache = LRUCache(maxsize=cache_size)
+
+    def _send_key(self, key):
+        return f"{self.prefix}:send:{key}"
+
+    def _request_key(self, key):
+        return f"{self.prefix}:request:{key}"
+
+    def _cached(self, key):
+        """Cached result of a send, or None if unknown or expired"""
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        result, expires = entry
+        return result if time.monotonic() < expires else None
+
+    def _cache(self, key, result, ttl):
+        """Cache the result of a send for as long as Redis keeps it"""
+        if ttl > 0:
+            self.cache.put(key, (result, time.monotonic() + ttl))
+
+    @staticmethod
+    def _decode(value):
+        value = value.decode()
+        return PENDING if value == PENDING else json.loads(value)
+
+    def begin(self, key):
+        """
+        Claim a send
+
+        Returns:
+            None if the caller now owns the send, PENDING if another worker
+            is sending it, or the stored result of the earlier send
+        """
+        result = self._cached(key)
+        if result is not None:
+            return result
+
+        name = self._send_key(key)
+        if self.client.set(name, PENDING, nx=True, ex=self.lock_timeout):
+            return None
+        value, ttl = self.client.pipeline(transaction=False).get(name).ttl(name).execute()
+        if value is None:
+            # Expired between the two calls, try once more
+            return None if self.client.set(name, PENDING, nx=True, ex=self.lock_timeout) else PENDING
+        result = self._decode(value)
+        if result is not PENDING:
+            self._cache(key, result, ttl)
+        return result
+
+    def begin_many(self, keys):
+        """begin() for many keys in two Redis round trips at most"""
+        outcomes = [self._cached(key) for key in keys]
+        todo = [i for i, outcome in enumerate(outcomes) if outcome is None]
+        if not todo:
+            return outcomes
+
+        pipe = self.client.pipeline(transaction=False)
+        for i in todo:
+            pipe.set(self._send_key(keys[i]), PENDING, nx=True, ex=self.lock_timeout)
+        claimed = pipe.execute()
+
+        taken = [i for i, ok in zip(todo, claimed) if not ok]
+        if taken:
+            pipe = self.client.pipeline(transaction=False)
+            for i in taken:
+                pipe.get(self._send_key(keys[i]))
+                pipe.ttl(self._send_key(keys[i]))
+            replies = pipe.execute()
+            for i, value, ttl in zip(taken, replies[::2], replies[1::2]):
+                # A key that expired in between is reported as in flight
+                outcomes[i] = PENDING if value is None else self._decode(value)
+                if outcomes[i] is not PENDING:
+                    self._cache(keys[i], outcomes[i], ttl)
+        return outcomes
+
+    def finish(self, outcomes):
+        """
+        Record the outcome of claimed sends in one Redis round trip
+
+        Successful results are stored for the duplicates, anything else
+        releases the claim so a retry can send.
+
+        Args:
+            outcomes (list): (key, result dict) pairs
+        """
+        pipe = self.client.pipeline(transaction=False)
+        for key, result in outcomes:
+            if isinstance(result, dict) and result.get('status') == 'success':
+                pipe.set(self._send_key(key), json.dumps(result), ex=self.ttl)
+                self._cache(key, result, self.ttl)
+            else:
+                pipe.delete(self._send_key(key))
+        pipe.execute()
+
+    def release(self, *keys):
+        """Give up claims so the sends can be tried again"""
+        if keys:
+            self.client.delete(*(self._send_key(key) for key in keys))
+
+    def lookup_request(self, key):
+        """Task id queued for an earlier request with the same key, if any"""
+        value = self.client.get(self._request_key(key))
+        return value.decode() if value is not None else None
+
+    def remember_request(self, key, task_id):
+        """Remember the task queued for a request"""
+        self.client.set(self._request_key(key), task_id, nx=True, ex=self.ttl)
+
+    def lookup_requests(self, keys):
+        """lookup_request() for many keys in one Redis round trip"""
+        values = self.client.mget([self._request_key(key) for key in keys])
+        return [value.decode() if value is not None else None for value in values]
+
+    def remember_requests(self, tasks):
+        """remember_request() for many (key, task id) pairs in one Redis round trip"""
+        pipe = self.client.pipeline(transaction=False)
+        for key, task_id in tasks:
+            pipe.set(self._request_key(key), task_id, nx=True, ex=self.ttl)
+        pipe.execute()
+
+    async def alookup_requests(self, keys):
+        """lookup_requests() with redis.asyncio, for async views"""
+        values, = await get_auto_pipeline(self.url).execute(
+            lambda pipe: pipe.mget([self._request_key(key) for key in keys])
+        )
+        return [value.decode() if value is not None else None for value in values]
+
+    async def aremember_requests(self, tasks):
+        """remember_requests() with redis.asyncio, for async views"""
+        def remember(pipe):
+            for key, task_id in tasks:
+                pipe.set(self._request_key(key), task_id, nx=True, ex=self.ttl)
+
+        await get_auto_pipeline(self.url).execute(remember)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """The process-wide idempotency store, or None when deduplication is off"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if not getattr(settings, 'EMAIL_IDEMPOTENCY', True):
+                    _store = False
+                else:
+                    _store = IdempotencyStore(
+                        getattr(settings, 'EMAIL_IDEMPOTENCY_REDIS_URL', None) or settings.CELERY_BROKER_URL,
+                        ttl=getattr(settings, 'EMAIL_IDEMPOTENCY_TTL', 86400),
+                        lock_timeout=getattr(settings, 'EMAIL_IDEMPOTENCY_LOCK_TIMEOUT', 300),
+                        cache_size=getattr(settings, 'EMAIL_IDEMPOTENCY_CACHE_SIZE', 10000),
+                    )
+    return _store or None
+
+
+def reset_store():
+    """Forget the process-wide store so it is rebuilt from settings"""
+    global _store
+    with _store_lock:
+        _store = None
+
+
+def _keyed(keys):
+    """(index, key) of the keys that are not None"""
+    return [(index, key) for index, key in enumerate(keys) if key is not None]
+
+
+def claim(key):
+    """
+    Claim a send before connecting to SMTP
+
+    Args:
+        key (str): Key of the send, or None to send without a claim
+
+    Returns:
+        None if the email should be sent, otherwise the stored result of the
+        earlier send
+
+    Raises:
+        SendInProgress: If another worker is sending the same email
+    """
+    store = get_store()
+    if store is None or key is None:
+        return None
+    try:
+        previous = store.begin(key)
+    except redis.RedisError as e:
+        # Don't stop sending because the store is unreachable
+        logger.warning(f"Idempotency store unavailable, sending anyway: {str(e)}")
+        return None
+    if previous is PENDING:
+        raise SendInProgress(key, getattr(settings, 'EMAIL_IDEMPOTENCY_RETRY_DELAY', 30))
+    if previous is not None:
+        logger.info(f"Skipping duplicate email {key}")
+    return previous
+
+
+def claim_many(keys):
+    """
+    claim() for a batch of sends
+
+    Returns:
+        list: None for sends to make, PENDING for sends in flight elsewhere
+            or the stored result of an earlier send
+    """
+    previous = [None] * len(keys)
+    keyed = _keyed(keys)
+    store = get_store()
+    if store is None or not keyed:
+        return previous
+    try:
+        claimed = store.begin_many([key for _, key in keyed])
+    except redis.RedisError as e:
+        logger.warning(f"Idempotency store unavailable, sending anyway: {str(e)}")
+        return previous
+    for (index, _), result in zip(keyed, claimed):
+        previous[index] = result
+    return previous
+
+
+def finish(*outcomes):
+    """
+    Record the outcome of claimed sends
+
+    Args:
+        *outcomes: (key, result dict) pairs
+    """
+    outcomes = [(key, result) for key, result in outcomes if key is not None]
+    store = get_store()
+    if store is None or not outcomes:
+        return
+    try:
+        store.finish(outcomes)
+    except redis.RedisError as e:
+        logger.warning(f"Could not record idempotency keys: {str(e)}")
+
+
+def release(*keys):
+    """Release claims of sends that were not attempted"""
+    keys = [key for key in keys if key is not None]
+    store = get_store()
+    if store is None or not keys:
+        return
+    try:
+        store.release(*keys)
+    except redis.RedisError as e:
+        logger.warning(f"Could not release idempotency keys: {str(e)}")
+
+
+def queued_task(key):
+    """Id of the task queued for an earlier request with the same key, if any"""
+    store = get_store()
+    if store is None or key is None:
+        return None
+    try:
+        return store.lookup_request(key)
+    except redis.RedisError as e:
+        logger.warning(f"Idempotency store unavailable, queueing anyway: {str(e)}")
+        return None
+
+
+def remember_task(key, task_id):
+    """Remember the task queued for a request so retries of it get the same task"""
+    store = get_store()
+    if store is None or key is None:
+        return
+    try:
+        store.remember_request(key, task_id)
+    except redis.RedisError as e:
+        logger.warning(f"Could not record idempotency key {key}: {str(e)}")
+
+
+def queued_tasks(keys):
+    """queued_task() for a batch of requests"""
+    task_ids = [None] * len(keys)
+    keyed = _keyed(keys)
+    store = get_store()
+    if store is None or not keyed:
+        return task_ids
+    try:
+        found = store.lookup_requests([key for _, key in keyed])
+    except redis.RedisError as e:
+        logger.warning(f"Idempotency store unavailable, queueing anyway: {str(e)}")
+        return task_ids
+    for (index, _), task_id in zip(keyed, found):
+        task_ids[index] = task_id
+    return task_ids
+
+
+def remember_tasks(tasks):
+    """
+    remember_task() for a batch of requests
+
+    Args:
+        tasks (list): (key, task id) pairs
+    """
+    tasks = [(key, task_id) for key, task_id in tasks if key is not None]
+    store = get_store()
+    if store is None or not tasks:
+        return
+    try:
+        store.remember_requests(tasks)
+    except redis.RedisError as e:
+        logger.warning(f"Could not record {len(tasks)} idempotency keys: {str(e)}")
+
+
+async def aqueued_tasks(keys):
+    """queued_tasks() for async views"""
+    task_ids = [None] * len(keys)
+    keyed = _keyed(keys)
+    store = get_store()
+    if store is None or not keyed:
+        return task_ids
+    try:
+        found = await store.alookup_requests([key for _, key in keyed])
+    except redis.RedisError as e:
+        logger.warning(f"Idempotency store unavailable, queueing anyway: {str(e)}")
+        return task_ids
+    for (index, _), task_id in zip(keyed, found):
+        task_ids[index] = task_id
+    return task_ids
+
+
+async def aremember_tasks(tasks):
+    """remember_tasks() for async views"""
+    tasks = [(key, task_id) for key, task_id in tasks if key is not None]
+    store = get_store()
+    if store is None or not tasks:
+        return
+    try:
+        await store.aremember_requests(tasks)
+    except redis.RedisError as e:
+        logger.warning(f"Could not record {len(tasks)} idempotency keys: {str(e)}")
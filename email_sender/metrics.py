@@ -0,0 +1,221 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import redis
+from celery import Task
+from django.conf import settings
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the stage histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRIC_NAME = 'email_task_stage_seconds'
+SERIES_KEY = 'email-metrics:series'
+
+# Counters kept with count(), name -> help text
+COUNTERS = {
+    'email_template_cache_total': "Lookups in the compiled template and rendered output caches",
+}
+COUNTERS_KEY = 'email-metrics:counters'
+
+# Seconds spent per stage by the task running in this thread/greenlet
+_timings = ContextVar('email_task_timings', default=None)
+
+_client = None
+_client_lock = threading.Lock()
+
+# Counter increments of this process not yet added to the shared counters,
+# series ('name{labels}') -> n
+_counts = {}
+_counts_lock = threading.Lock()
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a phase of the current email task
+
+    A stage may be entered several times per task (e.g. once per message of
+    a bulk send); the time is summed. Outside a TimedTask this does nothing.
+
+    Args:
+        name (str): Stage name, e.g. "render" or "smtp_data"
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - started
+
+
+def count(name, labels, n=1):
+    """
+    Add to a counter of the whole cluster
+
+    Increments are kept in the process and added to the shared counters
+    along with the timings of the next task run, without a round trip of
+    their own.
+
+    Args:
+        name (str): Counter name, one of COUNTERS
+        labels (dict): Label name -> value
+        n (int): Increment
+    """
+    series = name + '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+    with _counts_lock:
+        _counts[series] = _counts.get(series, 0) + n
+
+
+def _take_counts():
+    global _counts
+    with _counts_lock:
+        counts, _counts = _counts, {}
+    return counts
+
+
+def buckets():
+    return tuple(getattr(settings, 'EMAIL_METRICS_BUCKETS', None) or DEFAULT_BUCKETS)
+
+
+def get_client():
+    """Redis client holding the stage histograms of every worker"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                url = getattr(settings, 'EMAIL_METRICS_REDIS_URL', None) or settings.CELERY_BROKER_URL
+                _client = redis.Redis.from_url(url, socket_connect_timeout=1, socket_timeout=1)
+    return _client
+
+
+def _series_key(task_name, stage_name):
+    return f"email-metrics:{task_name}:{stage_name}"
+
+
+def _bucket_field(seconds, bounds):
+    for bound in bounds:
+        if seconds <= bound:
+            return str(bound)
+    return '+Inf'
+
+
+def record_timings(task_name, timings):
+    """
+    Add the stage timings of one task run to the shared histograms
+
+    Every stage of the run, and the counter increments since the last
+    run (see count()), are written in a single Redis round trip.
+
+    Args:
+        task_name (str): Celery task name
+        timings (dict): Stage name -> seconds
+    """
+    if not getattr(settings, 'EMAIL_METRICS', True) or not timings:
+        return
+    bounds = buckets()
+    counts = _take_counts()
+    try:
+        pipe = get_client().pipeline(transaction=False)
+        for series, n in counts.items():
+            pipe.hincrby(COUNTERS_KEY, series, n)
+        for stage_name, seconds in timings.items():
+            key = _series_key(task_name, stage_name)
+            pipe.sadd(SERIES_KEY, f"{task_name}:{stage_name}")
+            pipe.hincrby(key, _bucket_field(seconds, bounds), 1)
+            pipe.hincrby(key, 'count', 1)
+            pipe.hincrbyfloat(key, 'sum', seconds)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Could not record timings of {task_name}: {str(e)}")
+        # Keep the increments for the next run
+        with _counts_lock:
+            for series, n in counts.items():
+                _counts[series] = _counts.get(series, 0) + n
+
+
+class TimedTask(Task):
+    """
+    Task base class that times the stages of each run
+
+    The timings are added to the per task type histograms and, with
+    EMAIL_TASK_TIMINGS, attached to the task result under "timings". A
+    task called directly from inside another one reports as part of it.
+    """
+
+    def __call__(self, *args, **kwargs):
+        if _timings.get() is not None:
+            return super().__call__(*args, **kwargs)
+
+        timings = {}
+        token = _timings.set(timings)
+        started = time.perf_counter()
+        try:
+            result = super().__call__(*args, **kwargs)
+        finally:
+            timings['total'] = time.perf_counter() - started
+            _timings.reset(token)
+            record_timings(self.name, timings)
+
+        if isinstance(result, dict) and getattr(settings, 'EMAIL_TASK_TIMINGS', False):
+            result['timings'] = {name: round(seconds, 6) for name, seconds in timings.items()}
+        return result
+
+
+def _labels(task_name, stage_name, le=None):
+    labels = f'task="{task_name}",stage="{stage_name}"'
+    if le is not None:
+        labels += f',le="{le}"'
+    return '{' + labels + '}'
+
+
+def metrics_text():
+    """
+    The stage histograms and the counters in the Prometheus text
+    exposition format
+
+    Raises:
+        redis.RedisError: If the histograms can't be read
+    """
+    client = get_client()
+    series = sorted(s.decode() for s in client.smembers(SERIES_KEY))
+
+    pipe = client.pipeline(transaction=False)
+    for name in series:
+        pipe.hgetall(_series_key(*name.split(':', 1)))
+    histograms = pipe.execute()
+
+    lines = [
+        f"# HELP {METRIC_NAME} Time spent in each stage of the email tasks",
+        f"# TYPE {METRIC_NAME} histogram",
+    ]
+    bounds = buckets()
+    for name, fields in zip(series, histograms):
+        task_name, stage_name = name.split(':', 1)
+        fields = {k.decode(): v.decode() for k, v in fields.items()}
+
+        cumulative = 0
+        for bound in bounds:
+            cumulative += int(fields.get(str(bound), 0))
+            lines.append(f"{METRIC_NAME}_bucket{_labels(task_name, stage_name, bound)} {cumulative}")
+        count = int(fields.get('count', 0))
+        lines.append(f"{METRIC_NAME}_bucket{_labels(task_name, stage_name, '+Inf')} {count}")
+        lines.append(f"{METRIC_NAME}_sum{_labels(task_name, stage_name)} {float(fields.get('sum', 0))}")
+        lines.append(f"{METRIC_NAME}_count{_labels(task_name, stage_name)} {count}")
+
+    counters = {k.decode(): int(v) for k, v in client.hgetall(COUNTERS_KEY).items()}
+    for name, help_text in COUNTERS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for series in sorted(s for s in counters if s.startswith(name + '{')):
+            lines.append(f"{series} {counters[series]}")
+
+    return "\n".join(lines) + "\n"
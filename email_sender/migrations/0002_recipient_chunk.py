@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_sender', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipientChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('upload_id', models.CharField(max_length=64)),
+                ('index', models.PositiveIntegerField()),
+                ('recipients', models.TextField()),
+                ('count', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['upload_id', 'index'],
+                'constraints': [models.UniqueConstraint(fields=('upload_id', 'index'), name='recipient_chunk_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:03
+
+from django.db import migrations, models
+
+
+def clear_duplicate_keys(apps, schema_editor):
+    """Keep each idempotency key on its newest outbox email only"""
+    OutboxEmail = apps.get_model('email_sender', 'OutboxEmail')
+    seen = set()
+    for pk, key in OutboxEmail.objects.order_by('-id').values_list('id', 'idempotency_key').iterator():
+        if key in seen:
+            OutboxEmail.objects.filter(pk=pk).update(idempotency_key=None)
+        seen.add(key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_sender', '0003_outbox_email'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outboxemail',
+            name='idempotency_key',
+            field=models.CharField(db_index=True, max_length=255, null=True),
+        ),
+        migrations.RunPython(clear_duplicate_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='outboxemail',
+            name='idempotency_key',
+            field=models.CharField(max_length=255, null=True, unique=True),
+        ),
+    ]
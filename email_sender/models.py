@@ -1,3 +1,87 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class DeliveryLog(models.Model):
+    """Outcome of sending one email of a bulk or mail merge task"""
+    task_id = models.CharField(max_length=255)
+    recipient = models.EmailField()
+    status = models.CharField(max_length=20)
+    message = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # Keyset paging through the deliveries of one task
+            models.Index(fields=['task_id', 'id'], name='delivery_task_id_idx'),
+            models.Index(fields=['task_id', 'status', 'id'], name='delivery_task_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.recipient} ({self.status})"
+
+
+class RecipientChunk(models.Model):
+    """One chunk of an uploaded recipient list, sent by a single bulk task"""
+    upload_id = models.CharField(max_length=64)
+    index = models.PositiveIntegerField()
+    # Newline separated addresses
+    recipients = models.TextField()
+    count = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['upload_id', 'index']
+        constraints = [
+            models.UniqueConstraint(fields=['upload_id', 'index'], name='recipient_chunk_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.upload_id} #{self.index} ({self.count} recipients)"
+
+
+class OutboxEmail(models.Model):
+    """
+    Email written in the caller's database transaction and sent later, in
+    batches, by the outbox dispatcher
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    html_message = models.TextField(null=True, blank=True)
+    # Unique, so concurrent requests can't add the same email twice. Cleared
+    # once EMAIL_IDEMPOTENCY_TTL has passed, which lets the key be used again.
+    idempotency_key = models.CharField(max_length=255, null=True, unique=True)
+    priority = models.PositiveSmallIntegerField(default=5)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    # Not sent before this time, set when a transient failure is retried
+    available_at = models.DateTimeField(default=timezone.now)
+    # Dispatch run that claimed the email and when
+    claim_token = models.CharField(max_length=64, blank=True, db_index=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # Claiming the next batch of due emails
+            models.Index(fields=['status', 'priority', 'id'], name='outbox_status_priority_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.recipient} ({self.status})"
@@ -0,0 +1,198 @@
+import logging
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import OutboxEmail
+from .retry import backoff_delay, can_retry, is_transient_result
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+
+def outbox_enabled():
+    """Whether single email requests are written to the outbox instead of queued"""
+    return getattr(settings, 'EMAIL_OUTBOX', False)
+
+
+def enqueue_email(recipient_email, subject, message, html_message=None, idempotency_key=None, priority=5):
+    """
+    Add an email to the outbox
+
+    Runs in the caller's transaction, so the email is only sent if that
+    transaction commits, and doesn't need the broker to be up. An email
+    with the same idempotency key added in the last EMAIL_IDEMPOTENCY_TTL
+    seconds is returned instead of adding it again, including one added
+    by a concurrent request (the key is unique).
+
+    Args:
+        recipient_email (str): Email address of the recipient
+        subject (str): Email subject
+        message (str): Plain text message
+        html_message (str, optional): HTML content for the email
+        idempotency_key (str): Key identifying the send
+        priority (int): Lower is dispatched first, see TASK_PRIORITIES
+
+    Returns:
+        tuple: (OutboxEmail, created)
+    """
+    since = timezone.now() - timedelta(seconds=getattr(settings, 'EMAIL_IDEMPOTENCY_TTL', 86400))
+    with transaction.atomic():
+        if idempotency_key is not None:
+            existing = OutboxEmail.objects.filter(idempotency_key=idempotency_key).first()
+            if existing is not None:
+                if existing.created_at >= since:
+                    return existing, False
+                # The key has expired, so it is free for this email
+                OutboxEmail.objects.filter(pk=existing.pk).update(idempotency_key=None)
+        try:
+            # Savepoint, so a duplicate doesn't break the caller's transaction
+            with transaction.atomic():
+                email = OutboxEmail.objects.create(
+                    recipient=recipient_email,
+                    subject=subject,
+                    message=message,
+                    html_message=html_message,
+                    idempotency_key=idempotency_key,
+                    priority=priority,
+                )
+        except IntegrityError:
+            # Added by a concurrent request since the check above
+            logger.info(f"Outbox email with key {idempotency_key} was added concurrently")
+            return OutboxEmail.objects.get(idempotency_key=idempotency_key), False
+    return email, True
+
+
+def _claimable(now):
+    """Due pending emails, and emails whose claim was abandoned by a dead worker"""
+    stale = now - timedelta(seconds=getattr(settings, 'EMAIL_OUTBOX_CLAIM_TIMEOUT', 300))
+    return (
+        Q(status=OutboxEmail.PENDING, available_at__lte=now)
+        | Q(status=OutboxEmail.SENDING, claimed_at__lt=stale)
+    )
+
+
+def claim_batch(limit):
+    """
+    Claim up to limit due emails for one send batch
+
+    Rows locked by a concurrent dispatcher are skipped (SELECT ... FOR
+    UPDATE SKIP LOCKED where the database supports it), and the claim is a
+    conditional UPDATE, so two dispatchers never claim the same email.
+
+    Returns:
+        tuple: (claim token, number of emails claimed)
+    """
+    token = uuid.uuid4().hex
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            OutboxEmail.objects.select_for_update(skip_locked=True)
+            .filter(_claimable(now))
+            .order_by('priority', 'id')
+            .values_list('id', flat=True)[:limit]
+        )
+        if not ids:
+            return token, 0
+        claimed = OutboxEmail.objects.filter(_claimable(now), id__in=ids).update(
+            status=OutboxEmail.SENDING,
+            claim_token=token,
+            claimed_at=now,
+            attempts=F('attempts') + 1,
+        )
+    return token, claimed
+
+
+def claimed_emails(token):
+    """Emails still held by a claim, in dispatch order"""
+    return list(
+        OutboxEmail.objects.filter(claim_token=token, status=OutboxEmail.SENDING).order_by('priority', 'id')
+    )
+
+
+def release_batch(token, delay=0, emails=None):
+    """
+    Put claimed emails back in the outbox without counting an attempt,
+    e.g. when the batch could not be queued or the rate limiter deferred it
+
+    Args:
+        token (str): Claim token
+        delay (float): Seconds before the emails are due again
+        emails (list, optional): Only release these OutboxEmails
+    """
+    rows = OutboxEmail.objects.filter(claim_token=token, status=OutboxEmail.SENDING)
+    if emails is not None:
+        rows = rows.filter(id__in=[email.id for email in emails])
+    return rows.update(
+        status=OutboxEmail.PENDING,
+        claim_token='',
+        available_at=timezone.now() + timedelta(seconds=delay),
+        attempts=F('attempts') - 1,
+    )
+
+
+def record_outcomes(outcomes):
+    """
+    Store the results of a sent batch
+
+    Sent and permanently failed emails are final. Transient failures go
+    back to pending with exponential backoff until EMAIL_RETRY_MAX_RETRIES
+    retries are used up.
+
+    Args:
+        outcomes (list): (OutboxEmail, result dict) pairs
+
+    Returns:
+        dict: Number of emails sent, failed and retried
+    """
+    now = timezone.now()
+    sent, failed, retried = [], [], []
+    for email, result in outcomes:
+        if result["status"] == "success":
+            sent.append(email.id)
+            continue
+        email.last_error = result.get("message", "")
+        email.claim_token = ''
+        if result["status"] == "skipped":
+            # Another worker holds the idempotency key, check again later
+            email.status = OutboxEmail.PENDING
+            email.available_at = now + timedelta(seconds=getattr(settings, 'EMAIL_IDEMPOTENCY_RETRY_DELAY', 30))
+            retried.append(email)
+        elif is_transient_result(result) and can_retry(email.attempts - 1):
+            email.status = OutboxEmail.PENDING
+            email.available_at = now + timedelta(seconds=backoff_delay(email.attempts - 1))
+            retried.append(email)
+        else:
+            email.status = OutboxEmail.FAILED
+            failed.append(email)
+
+    with transaction.atomic():
+        if sent:
+            OutboxEmail.objects.filter(id__in=sent).update(
+                status=OutboxEmail.SENT, sent_at=now, claim_token='', last_error='',
+            )
+        if failed or retried:
+            OutboxEmail.objects.bulk_update(
+                failed + retried, ['status', 'available_at', 'claim_token', 'last_error'],
+            )
+
+    return {"sent": len(sent), "failed": len(failed), "retried": len(retried)}
+
+
+def outbox_status(email):
+    """Status dict of an outbox email for the API"""
+    result = {
+        'outbox_id': email.id,
+        'status': email.status,
+        'attempts': email.attempts,
+        'created_at': email.created_at,
+    }
+    if email.sent_at:
+        result['sent_at'] = email.sent_at
+    if email.last_error:
+        result['error'] = email.last_error
+    return result
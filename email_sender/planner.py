@@ -0,0 +1,121 @@
+import smtplib
+import sys
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.utils.module_loading import import_string
+
+from .backends import EmailBackend
+from .rate_limit import max_tokens
+
+
+def recipient_domain(address):
+    """Lowercased domain of an email address, '' if it has none"""
+    return address.rpartition('@')[2].lower()
+
+
+def group_by_domain(items, address=None):
+    """
+    Reorder items so that those of the same recipient domain are contiguous
+
+    Domains keep the order in which they first appear, and items keep their
+    order within a domain. Chunks cut from the result hold whole domains
+    wherever possible, so each SMTP session carries runs of messages for one
+    destination, which the relay can hand on over a single connection.
+
+    Args:
+        items (list): Addresses, or rows holding one
+        address (callable, optional): item -> address, for rows
+    """
+    groups = {}
+    for item in items:
+        groups.setdefault(recipient_domain(address(item) if address else item), []).append(item)
+    return [item for group in groups.values() for item in group]
+
+
+def plan_envelopes(recipients, max_recipients=None):
+    """
+    Split recipients into SMTP envelopes: one domain per envelope and at
+    most max_recipients (EMAIL_MULTI_RCPT_MAX) RCPT TO commands each
+
+    An envelope is throttled as one email per recipient, so it is also kept
+    within the smallest rate limit budget, which could otherwise never
+    grant it enough tokens.
+
+    Args:
+        recipients (list): Email addresses
+
+    Returns:
+        list: Lists of addresses, one per message to send
+    """
+    if max_recipients is None:
+        max_recipients = getattr(settings, 'EMAIL_MULTI_RCPT_MAX', 50)
+    budget = max_tokens()
+    if budget is not None:
+        max_recipients = min(max_recipients, budget)
+    groups = {}
+    for recipient in recipients:
+        groups.setdefault(recipient_domain(recipient), []).append(recipient)
+
+    envelopes = []
+    for group in groups.values():
+        for start in range(0, len(group), max_recipients):
+            envelopes.append(group[start:start + max_recipients])
+    return envelopes
+
+
+def multi_rcpt_enabled():
+    """
+    Whether bulk sends may deliver one message to many recipients
+
+    Needs EMAIL_MULTI_RCPT and this project's SMTP backend
+    (email_sender.backends.EmailBackend or a subclass), which keeps the
+    recipients refused by each send for BatchSession to report. Django's own
+    SMTP backend drops them, so with it, and with any other backend, bulk
+    sends keep one message per recipient.
+    """
+    return (
+        getattr(settings, 'EMAIL_MULTI_RCPT', False)
+        and issubclass(import_string(settings.EMAIL_BACKEND), EmailBackend)
+    )
+
+
+def build_envelope_message(recipients, subject, message, html_message=None, connection=None):
+    """
+    Build one EmailMultiAlternatives for every recipient of an envelope
+
+    Recipients are only in the envelope (RCPT TO), never in the headers, so
+    they don't see each other; the To header is EMAIL_MULTI_RCPT_TO.
+
+    Args:
+        recipients (list): Email addresses of the envelope
+        subject (str): Email subject
+        message (str): Plain text message
+        html_message (str, optional): HTML content for the email
+        connection: Optional mail backend connection to attach to the message
+    """
+    email = EmailMultiAlternatives(
+        subject=subject,
+        body=message,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        bcc=recipients,
+        headers={'To': getattr(settings, 'EMAIL_MULTI_RCPT_TO', 'undisclosed-recipients:;')},
+        connection=connection,
+    )
+    if html_message:
+        email.attach_alternative(html_message, "text/html")
+    return email
+
+
+def refused_recipients(error):
+    """
+    Recipients the server refused, as {address: (code, message)}, or None
+    if the error isn't a recipient refusal
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return error.recipients
+    # Only loaded by the async engine: without it there are no aiosmtplib errors
+    aiosmtplib = sys.modules.get('aiosmtplib')
+    if aiosmtplib is not None and isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return {refused.recipient: (refused.code, refused.message) for refused in error.recipients}
+    return None
@@ -0,0 +1,165 @@
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import kombu
+from asgiref.sync import sync_to_async
+from kombu.transport.redis import Channel as RedisChannel
+from kombu.utils.json import dumps
+
+from .async_redis import get_auto_pipeline
+
+# kombu releases whose Redis channel _buffered() was checked against. It
+# replaces private methods of the channel, which can change in any release,
+# so with other versions messages are published by the producer as usual.
+BUFFERED_KOMBU_VERSIONS = ((5, 3), (5, 6))
+
+
+def can_buffer(channel):
+    """Whether the messages published on a channel can be buffered"""
+    oldest, newest = BUFFERED_KOMBU_VERSIONS
+    return (
+        isinstance(channel, RedisChannel)
+        and oldest <= tuple(kombu.VERSION[:2]) <= newest
+        and all(hasattr(channel, name) for name in ('_put', '_q_for_pri', '_get_message_priority'))
+    )
+
+
+@contextmanager
+def _buffered(channel):
+    """
+    Collect the messages published on a Redis broker channel, as (list key,
+    payload) pairs, instead of pushing them
+
+    Each exchange's routing table is read once. Messages to the default
+    exchange, as Celery's are, don't need it at all.
+    """
+    messages = []
+    tables = {}
+
+    def get_table(exchange):
+        if exchange not in tables:
+            tables[exchange] = RedisChannel.get_table(channel, exchange)
+        return tables[exchange]
+
+    def put(queue, message, **kwargs):
+        # As kombu's Channel._put, without the LPUSH
+        priority = channel._get_message_priority(message, reverse=False)
+        messages.append((channel._q_for_pri(queue, priority), dumps(message)))
+
+    channel.get_table, channel._put = get_table, put
+    try:
+        yield messages
+    finally:
+        del channel.get_table, channel._put
+
+
+@contextmanager
+def pipelined(channel):
+    """
+    Buffer the messages published on a Redis broker channel and push them in
+    one pipeline, i.e. one round trip, when the block exits
+
+    Each publish normally costs two round trips: reading the exchange's
+    routing table and pushing the message. Here the table is read once per
+    exchange and the pushes are queued. Nothing is pushed if the block
+    raises. Other transports, and kombu versions that haven't been checked
+    (see BUFFERED_KOMBU_VERSIONS), publish one message at a time as usual.
+
+    Args:
+        channel: kombu channel of the producer used in the block
+    """
+    if not can_buffer(channel):
+        yield
+        return
+
+    with _buffered(channel) as messages:
+        yield
+    if messages:
+        pipe = channel._create_client().pipeline(transaction=False)
+        for key, payload in messages:
+            pipe.lpush(key, payload)
+        pipe.execute()
+
+
+def publish_many(task, calls):
+    """
+    Queue many calls of a task over one pooled broker connection, in one
+    pipelined publish on Redis
+
+    Args:
+        task: Celery task
+        calls (list): (kwargs, options) per call, options being apply_async
+            options such as priority
+
+    Returns:
+        list: AsyncResult per call, in order
+    """
+    with task.app.producer_or_acquire() as producer:
+        with pipelined(producer.channel):
+            # Buffered publishes can't fail, so they aren't wrapped in retries
+            return [
+                task.apply_async(kwargs=kwargs, producer=producer, retry=False, **options)
+                for kwargs, options in calls
+            ]
+
+
+def _async_broker_url(app):
+    """Broker URL if redis.asyncio can connect to it, i.e. a plain Redis URL"""
+    url = app.conf.broker_write_url or app.conf.broker_url
+    return url if urlparse(url).scheme in ('redis', 'rediss', 'unix') else None
+
+
+def _build_messages(task, calls):
+    """
+    Build the messages of many task calls without pushing them
+
+    Returns:
+        tuple: (AsyncResult per call, (list key, payload) per message), or
+            None if the broker's channel can't be buffered
+    """
+    with task.app.producer_or_acquire() as producer:
+        channel = producer.channel
+        if not can_buffer(channel):
+            return None
+        with _buffered(channel) as messages:
+            results = [
+                task.apply_async(kwargs=kwargs, producer=producer, retry=False, **options)
+                for kwargs, options in calls
+            ]
+        prefix = channel.global_keyprefix
+    return results, [(prefix + key, payload) for key, payload in messages]
+
+
+async def apublish_many(task, calls):
+    """
+    publish_many() for async views, without blocking the event loop
+
+    On Redis, Celery and kombu build the messages as usual, in a thread
+    since getting a producer may connect to the broker. Instead of being
+    pushed by the producer, they are then pushed with redis.asyncio,
+    together with those of concurrent requests (see AutoPipeline). Other
+    brokers (and Sentinel), and kombu versions whose channel can't be
+    buffered, are published to from a thread.
+
+    Args:
+        task: Celery task
+        calls (list): (kwargs, options) per call, see publish_many
+
+    Returns:
+        list: AsyncResult per call, in order
+    """
+    url = _async_broker_url(task.app)
+    built = None
+    if url is not None:
+        built = await sync_to_async(_build_messages, thread_sensitive=False)(task, calls)
+    if built is None:
+        return await sync_to_async(publish_many, thread_sensitive=False)(task, calls)
+
+    results, messages = built
+
+    def push(pipe):
+        for key, payload in messages:
+            pipe.lpush(key, payload)
+
+    await get_auto_pipeline(url).execute(push)
+    return results
@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+from .metrics import stage
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Window length in seconds of each configurable budget
+WINDOWS = (
+    ('second', 'EMAIL_RATE_LIMIT_PER_SECOND', 1),
+    ('minute', 'EMAIL_RATE_LIMIT_PER_MINUTE', 60),
+    ('day', 'EMAIL_RATE_LIMIT_PER_DAY', 86400),
+)
+
+
+class RateLimited(Exception):
+    """Raised when the send budget is exhausted for longer than we may block"""
+
+    def __init__(self, wait):
+        self.wait = wait
+        super().__init__(f"SMTP send rate limit reached, retry in {wait:.1f}s")
+
+
+def check_capacity(n, capacity):
+    """
+    Refuse to wait for more tokens than a bucket holds: they would never
+    all be there at once, and the send would be deferred forever
+    """
+    if n > capacity:
+        raise ValueError(f"Can't take {n} tokens from a rate limit bucket of {capacity}")
+
+
+class MemoryRateLimiter:
+    """
+    Token buckets kept in process memory.
+
+    Only limits the current process, so it is meant for tests and single
+    worker setups.
+    """
+
+    def __init__(self, buckets):
+        # name -> [capacity, window seconds, tokens, last refill]
+        now = time.monotonic()
+        self.buckets = {
+            name: [capacity, window, float(capacity), now]
+            for name, capacity, window in buckets
+        }
+        self.capacity = min(capacity for _, capacity, _ in buckets)
+        self._lock = threading.Lock()
+
+    def acquire(self, n=1):
+        """
+        Take n tokens from every bucket if they all have enough
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise seconds to wait
+
+        Raises:
+            ValueError: If n is more than the smallest bucket can ever hold
+        """
+        check_capacity(n, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            for bucket in self.buckets.values():
+                capacity, window, tokens, last = bucket
+                rate = capacity / window
+                bucket[2] = min(capacity, tokens + (now - last) * rate)
+                bucket[3] = now
+                if bucket[2] < n:
+                    wait = max(wait, (n - bucket[2]) / rate)
+            if wait:
+                return wait
+            for bucket in self.buckets.values():
+                bucket[2] -= n
+            return 0.0
+
+
+# Refill and take tokens from every bucket atomically, using the Redis
+# server clock so all workers agree on time. Returns the milliseconds to
+# wait (as a string to keep the fraction), or "0" when the tokens were taken.
+TOKEN_BUCKET_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+local n = tonumber(ARGV[1])
+local wait = 0
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2])
+    local window = tonumber(ARGV[i * 2 + 1])
+    local rate = capacity / window
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + (now - ts) * rate)
+    levels[i] = tokens
+    if tokens < n then
+        wait = math.max(wait, (n - tokens) / rate)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', tostring(levels[i] - n), 'ts', tostring(now))
+    redis.call('PEXPIRE', key, tonumber(ARGV[i * 2 + 1]) * 2)
+end
+return '0'
+"""
+
+
+class RedisRateLimiter:
+    """
+    Token buckets stored in Redis and shared by every worker in the cluster
+    """
+
+    def __init__(self, buckets, url, prefix='email-rate'):
+        self.buckets = list(buckets)
+        self.client = redis.Redis.from_url(url, socket_connect_timeout=1, socket_timeout=1)
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+        self.keys = [f"{prefix}:{name}" for name, _, _ in self.buckets]
+        self.args = []
+        for _, capacity, window in self.buckets:
+            self.args.extend([capacity, window * 1000])
+        self.capacity = min(capacity for _, capacity, _ in self.buckets)
+
+    def acquire(self, n=1):
+        """
+        Take n tokens from every bucket if they all have enough
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise seconds to wait
+
+        Raises:
+            ValueError: If n is more than the smallest bucket can ever hold
+        """
+        check_capacity(n, self.capacity)
+        wait_ms = float(self.script(keys=self.keys, args=[n] + self.args))
+        return wait_ms / 1000
+
+
+def configured_buckets():
+    """(name, capacity, window seconds) for every budget that is set"""
+    buckets = []
+    for name, setting, window in WINDOWS:
+        capacity = getattr(settings, setting, None)
+        if capacity:
+            buckets.append((name, capacity, window))
+    return buckets
+
+
+def max_tokens():
+    """
+    Most emails a single throttle() call can be granted: the capacity of
+    the smallest configured budget, or None when no budget is set
+    """
+    buckets = configured_buckets()
+    return min(capacity for _, capacity, _ in buckets) if buckets else None
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """The process-wide rate limiter, or None when no budget is configured"""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                buckets = configured_buckets()
+                if not buckets:
+                    _limiter = False
+                elif getattr(settings, 'EMAIL_RATE_LIMIT_BACKEND', 'redis') == 'memory':
+                    _limiter = MemoryRateLimiter(buckets)
+                else:
+                    account = settings.EMAIL_HOST_USER or 'default'
+                    _limiter = RedisRateLimiter(
+                        buckets,
+                        getattr(settings, 'EMAIL_RATE_LIMIT_REDIS_URL', None) or settings.CELERY_BROKER_URL,
+                        prefix=f"email-rate:{account}",
+                    )
+    return _limiter or None
+
+
+def reset_rate_limiter():
+    """Forget the process-wide limiter so it is rebuilt from settings"""
+    global _limiter
+    with _limiter_lock:
+        _limiter = None
+
+
+def throttle(n=1, max_wait=None):
+    """
+    Wait until n emails may be sent under the configured budgets
+
+    Blocks for at most max_wait seconds (EMAIL_RATE_LIMIT_MAX_WAIT by
+    default). If the budget frees up later than that, RateLimited is raised
+    with the remaining wait so the task can be re-queued with an ETA.
+
+    Args:
+        n (int): Number of emails about to be sent
+        max_wait (float, optional): Longest time to block
+
+    Raises:
+        RateLimited: If sending has to wait longer than max_wait
+    """
+    limiter = get_rate_limiter()
+    if limiter is None:
+        return
+
+    if max_wait is None:
+        max_wait = getattr(settings, 'EMAIL_RATE_LIMIT_MAX_WAIT', 5)
+    deadline = time.monotonic() + max_wait
+
+    with stage('throttle'):
+        while True:
+            try:
+                wait = limiter.acquire(n)
+            except redis.RedisError as e:
+                # Don't stop sending because the limiter is unreachable
+                logger.warning(f"Rate limiter unavailable, sending anyway: {str(e)}")
+                return
+            if not wait:
+                return
+            remaining = deadline - time.monotonic()
+            if wait > remaining:
+                raise RateLimited(wait)
+            time.sleep(wait)
+
+
+async def athrottle(n=1, max_wait=None):
+    """
+    Asyncio version of throttle() that waits without blocking the event loop
+
+    Raises:
+        RateLimited: If sending has to wait longer than max_wait
+    """
+    limiter = get_rate_limiter()
+    if limiter is None:
+        return
+
+    if max_wait is None:
+        max_wait = getattr(settings, 'EMAIL_RATE_LIMIT_MAX_WAIT', 5)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_wait
+
+    with stage('throttle'):
+        while True:
+            try:
+                wait = await asyncio.to_thread(limiter.acquire, n)
+            except redis.RedisError as e:
+                logger.warning(f"Rate limiter unavailable, sending anyway: {str(e)}")
+                return
+            if not wait:
+                return
+            remaining = deadline - loop.time()
+            if wait > remaining:
+                raise RateLimited(wait)
+            await asyncio.sleep(wait)
@@ -0,0 +1,250 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from celery.signals import worker_init
+from django.conf import settings
+from django.template import engines
+from django.template.loader import get_template
+from django.template.loader_tags import ExtendsNode, IncludeNode
+from django.utils.html import strip_tags
+
+from .metrics import count, stage
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Small thread-safe LRU cache that counts hits and misses"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class TemplateCache:
+    """
+    Worker-resident cache of compiled templates.
+
+    Each entry remembers the modification times of its source file and of
+    the templates it extends or includes, which are re-checked at most every
+    EMAIL_TEMPLATE_CHECK_INTERVAL seconds so an edited template is
+    recompiled without restarting the worker.
+    """
+
+    def __init__(self, check_interval=None):
+        if check_interval is None:
+            check_interval = getattr(settings, 'EMAIL_TEMPLATE_CHECK_INTERVAL', 2)
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        # template_name -> (template, ((source path, mtime), ...), last checked)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _source_paths(template):
+        """
+        Files a template is built from: its own, and those of the templates
+        it extends or includes by a constant name, recursively
+        """
+        paths = []
+        todo = [template.template]
+        while todo:
+            compiled = todo.pop()
+            if compiled.origin.name in paths:
+                continue
+            paths.append(compiled.origin.name)
+            for node in compiled.nodelist.get_nodes_by_type(ExtendsNode):
+                if isinstance(node.parent_name.var, str):
+                    todo.append(compiled.engine.get_template(node.parent_name.var))
+            for node in compiled.nodelist.get_nodes_by_type(IncludeNode):
+                if isinstance(node.template.var, str):
+                    todo.append(compiled.engine.get_template(node.template.var))
+        return paths
+
+    @staticmethod
+    def _mtimes(paths):
+        mtimes = []
+        for path in paths:
+            try:
+                mtimes.append((path, os.path.getmtime(path)))
+            except OSError:
+                mtimes.append((path, None))
+        return tuple(mtimes)
+
+    def _load(self, template_name):
+        template = get_template(template_name)
+        return template, self._mtimes(self._source_paths(template))
+
+    def get(self, template_name):
+        """
+        Return (compiled template, version) for template_name
+
+        The version changes whenever the template file, or one it extends
+        or includes, changes, so it can be used to key anything derived
+        from the rendered output.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(template_name)
+
+        if entry is not None:
+            template, mtimes, checked = entry
+            if now - checked < self.check_interval:
+                self._count('hit')
+                return template, mtimes
+            if self._mtimes(path for path, _ in mtimes) == mtimes:
+                self._count('hit')
+                with self._lock:
+                    self._entries[template_name] = (template, mtimes, now)
+                return template, mtimes
+            logger.info(f"Template {template_name} changed on disk, recompiling")
+            self._count('reload')
+            # Django's cached loader still holds the old versions
+            for loader in engines['django'].engine.template_loaders:
+                if hasattr(loader, 'reset'):
+                    loader.reset()
+
+        template, mtimes = self._load(template_name)
+        self._count('miss')
+        with self._lock:
+            self._entries[template_name] = (template, mtimes, now)
+        return template, mtimes
+
+    def _count(self, result):
+        with self._lock:
+            if result == 'hit':
+                self.hits += 1
+            elif result == 'miss':
+                self.misses += 1
+            else:
+                self.reloads += 1
+        count('email_template_cache_total', {'cache': 'templates', 'result': result})
+
+    def warm(self, template_names):
+        """Compile every template in template_names ahead of the first send"""
+        for template_name in template_names:
+            try:
+                self.get(template_name)
+            except Exception as e:
+                logger.error(f"Could not warm template {template_name}: {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+        }
+
+
+template_cache = TemplateCache()
+rendered_cache = LRUCache(maxsize=getattr(settings, 'EMAIL_RENDER_CACHE_SIZE', 256))
+
+
+def context_hash(context):
+    """Stable hash of a template context"""
+    encoded = json.dumps(context, sort_keys=True, default=str)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def render_email(template_name, context=None, use_cache=True):
+    """
+    Render an email template to its HTML and plain text versions
+
+    The compiled template comes from the worker-resident template cache and
+    the (html, plain text) pair is cached per template version and context.
+
+    Args:
+        template_name (str): Name of the template to use
+        context (dict, optional): Context data for the template
+        use_cache (bool): Cache the rendered output. Disable for contexts
+            that are unique per recipient so they don't evict shared entries.
+
+    Returns:
+        tuple: (html_message, plain_message)
+    """
+    if context is None:
+        context = {}
+
+    template, version = template_cache.get(template_name)
+    if not use_cache:
+        return _render(template, context)
+
+    key = (template_name, version, context_hash(context))
+    rendered = rendered_cache.get(key)
+    count('email_template_cache_total', {'cache': 'rendered', 'result': 'miss' if rendered is None else 'hit'})
+    if rendered is None:
+        rendered = _render(template, context)
+        rendered_cache.put(key, rendered)
+    return rendered
+
+
+def _render(template, context):
+    with stage('render'):
+        html_message = template.render(context)
+    with stage('strip_tags'):
+        plain_message = strip_tags(html_message)
+    return html_message, plain_message
+
+
+def email_template_names():
+    """Names of all templates under templates/email/"""
+    email_dir = os.path.join(settings.BASE_DIR, 'templates', 'email')
+    if not os.path.isdir(email_dir):
+        return []
+    return sorted(
+        f"email/{filename}"
+        for filename in os.listdir(email_dir)
+        if filename.endswith('.html')
+    )
+
+
+@worker_init.connect
+def warm_template_cache(**kwargs):
+    """Compile the email templates once in the worker before forking the pool"""
+    template_names = email_template_names()
+    template_cache.warm(template_names)
+    logger.info(f"Warmed template cache with {len(template_names)} email templates")
@@ -0,0 +1,95 @@
+import json
+import logging
+import random
+
+from celery import current_app, states
+from celery.signals import task_postrun
+from django.conf import settings
+from django.db import DatabaseError
+from django_celery_results.backends import DatabaseBackend
+from django_celery_results.models import TaskResult
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Per-recipient detail left out of audited results
+BULKY_KEYS = ('results', 'failures', 'timings')
+
+
+def result_summary(result):
+    """Task result without its per-recipient detail"""
+    if not isinstance(result, dict):
+        return result
+    summary = {key: value for key, value in result.items() if key not in BULKY_KEYS}
+    if 'failures' in result:
+        summary['failures_count'] = len(result['failures'])
+    return summary
+
+
+def audit_enabled():
+    """Whether results are kept outside the database and need auditing"""
+    return not isinstance(current_app.backend, DatabaseBackend)
+
+
+@task_postrun.connect
+def audit_task_result(task_id=None, task=None, retval=None, state=None, **kwargs):
+    """
+    Write a summary of a sample of task results, and of every failure, to
+    the database when the result backend is Redis
+
+    The rows go to django_celery_results' TaskResult table, so they show up
+    in the admin and the status endpoints can still answer once the result
+    has expired from Redis.
+    """
+    if state not in states.READY_STATES or not task_id or not audit_enabled():
+        return
+    if state == states.SUCCESS:
+        if random.random() >= getattr(settings, 'EMAIL_RESULT_AUDIT_SAMPLE_RATE', 0.01):
+            return
+        result = result_summary(retval)
+    else:
+        result = {
+            'exc_type': type(retval).__name__,
+            'exc_message': [str(retval)],
+            'exc_module': type(retval).__module__,
+        }
+
+    try:
+        TaskResult.objects.store_result(
+            'application/json',
+            'utf-8',
+            task_id,
+            json.dumps(result, default=str),
+            state,
+            task_name=getattr(task, 'name', None),
+        )
+    except (DatabaseError, TypeError, ValueError) as e:
+        logger.warning(f"Could not audit result of task {task_id}: {str(e)}")
+
+
+def audited_statuses(task_ids, include_results=True):
+    """
+    Statuses of tasks from the audit rows in the database, in one query
+
+    Returns:
+        dict: task_id -> {"status", and "result" or "error"} for the ids
+            that have a row
+    """
+    fields = ['task_id', 'status']
+    if include_results:
+        fields.append('result')
+
+    statuses = {}
+    for row in TaskResult.objects.filter(task_id__in=task_ids).only(*fields):
+        status = {'status': row.status}
+        if include_results and row.status in states.READY_STATES:
+            decoded = json.loads(row.result) if row.result else None
+            if row.status == states.SUCCESS:
+                status['result'] = decoded
+            else:
+                status['error'] = (
+                    ' '.join(str(arg) for arg in decoded.get('exc_message') or [])
+                    if isinstance(decoded, dict) else str(decoded)
+                )
+        statuses[row.task_id] = status
+    return statuses
@@ -0,0 +1,85 @@
+import random
+import smtplib
+import socket
+import sys
+
+from django.conf import settings
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+# Network failures worth another try: dropped or reset sessions, timeouts
+# and DNS lookups that failed
+NETWORK_ERRORS = (ConnectionError, TimeoutError, socket.gaierror, smtplib.SMTPServerDisconnected)
+
+
+def _reply_codes(error):
+    """SMTP reply codes carried by an smtplib or aiosmtplib error"""
+    if isinstance(error, smtplib.SMTPResponseException):
+        return [error.smtp_code]
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return [code for code, _ in error.recipients.values()]
+    # Only loaded by the async engine: without it there are no aiosmtplib errors
+    aiosmtplib = sys.modules.get('aiosmtplib')
+    if aiosmtplib is not None:
+        if isinstance(error, aiosmtplib.SMTPResponseException):
+            return [error.code]
+        if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+            return [refused.code for refused in error.recipients]
+    return []
+
+
+def classify_error(error):
+    """
+    Whether a send error is worth retrying
+
+    4xx replies ("try again later") and network failures are transient.
+    5xx replies, and anything that isn't an SMTP or network error (a
+    template that doesn't render, a missing attachment...), are permanent:
+    sending again would fail the same way and only add load on a provider
+    that is already struggling.
+
+    Args:
+        error (Exception): Error raised while sending
+
+    Returns:
+        str: TRANSIENT or PERMANENT
+    """
+    codes = _reply_codes(error)
+    if codes:
+        return TRANSIENT if all(400 <= code < 500 for code in codes) else PERMANENT
+    if isinstance(error, NETWORK_ERRORS):
+        return TRANSIENT
+    return PERMANENT
+
+
+def is_transient(error):
+    return classify_error(error) == TRANSIENT
+
+
+def is_transient_result(result):
+    """Whether a delivery result dict is a failure worth retrying"""
+    return result.get("status") == "error" and result.get("error_type") == TRANSIENT
+
+
+def can_retry(transient_retries):
+    """Whether another retry of transient failures is allowed"""
+    return transient_retries < getattr(settings, 'EMAIL_RETRY_MAX_RETRIES', 5)
+
+
+def backoff_delay(transient_retries):
+    """
+    Seconds to wait before the next retry of transient failures
+
+    Exponential (EMAIL_RETRY_BACKOFF doubled per retry, capped at
+    EMAIL_RETRY_BACKOFF_MAX) with jitter over the upper half of the window,
+    so the tasks that failed together during an outage don't all come back
+    at the same moment.
+
+    Args:
+        transient_retries (int): Retries of transient failures so far
+    """
+    base = getattr(settings, 'EMAIL_RETRY_BACKOFF', 30)
+    cap = getattr(settings, 'EMAIL_RETRY_BACKOFF_MAX', 600)
+    delay = min(cap, base * 2 ** transient_retries)
+    return random.uniform(delay / 2, delay)
@@ -1,4 +1,32 @@
+from django.conf import settings
 from rest_framework import serializers
+from config.celery import TASK_PRIORITIES
+from .uploads import UPLOAD_FORMATS
+from .validation import validate_recipients
+
+
+def priority_field():
+    """Optional per-request priority of the queued task"""
+    return serializers.ChoiceField(choices=list(TASK_PRIORITIES), required=False, default='normal')
+
+
+def idempotency_key_field():
+    """Optional client key that makes retries of a request send only once"""
+    return serializers.CharField(max_length=255, required=False, allow_null=True, allow_blank=False)
+
+
+class RecipientListField(serializers.ListField):
+    """
+    List of email addresses, validated, lowercased and deduplicated in one
+    pass by validate_recipients instead of by an EmailField per address.
+    Errors are reported per index like a ListField of EmailFields.
+    """
+
+    def run_child_validation(self, data):
+        addresses, errors, _ = validate_recipients(data)
+        if errors:
+            raise serializers.ValidationError(errors)
+        return addresses
 
 
 class EmailSerializer(serializers.Serializer):
@@ -7,16 +35,42 @@ class EmailSerializer(serializers.Serializer):
     subject = serializers.CharField(max_length=255)
     message = serializers.CharField()
     html_message = serializers.CharField(required=False, allow_null=True)
+    priority = priority_field()
+    idempotency_key = idempotency_key_field()
+
+
+class EmailBatchSerializer(serializers.Serializer):
+    """Serializer for queueing many independent emails in one request"""
+    emails = EmailSerializer(
+        many=True,
+        allow_empty=False,
+        max_length=getattr(settings, 'EMAIL_BATCH_MAX_EMAILS', 1000),
+    )
 
 
 class BulkEmailSerializer(serializers.Serializer):
     """Serializer for sending bulk emails"""
-    recipient_list = serializers.ListField(
-        child=serializers.EmailField()
-    )
+    recipient_list = RecipientListField()
+    subject = serializers.CharField(max_length=255)
+    message = serializers.CharField()
+    html_message = serializers.CharField(required=False, allow_null=True)
+    chunk_size = serializers.IntegerField(required=False, allow_null=True, min_value=1)
+    compact = serializers.BooleanField(required=False, default=False)
+    priority = priority_field()
+    idempotency_key = idempotency_key_field()
+
+
+class BulkEmailUploadSerializer(serializers.Serializer):
+    """Serializer for a bulk send whose recipients are uploaded as a CSV or NDJSON file"""
+    recipients_file = serializers.FileField()
+    file_format = serializers.ChoiceField(choices=UPLOAD_FORMATS, required=False, allow_null=True)
     subject = serializers.CharField(max_length=255)
     message = serializers.CharField()
     html_message = serializers.CharField(required=False, allow_null=True)
+    chunk_size = serializers.IntegerField(required=False, allow_null=True, min_value=1)
+    compact = serializers.BooleanField(required=False, default=True)
+    priority = priority_field()
+    idempotency_key = idempotency_key_field()
 
 
 class TemplateEmailSerializer(serializers.Serializer):
@@ -25,6 +79,26 @@ class TemplateEmailSerializer(serializers.Serializer):
     subject = serializers.CharField(max_length=255)
     template_name = serializers.CharField()
     context = serializers.DictField(required=False, default=dict)
+    priority = priority_field()
+    idempotency_key = idempotency_key_field()
+
+
+class MailMergeRowSerializer(serializers.Serializer):
+    """Serializer for a single mail merge recipient"""
+    recipient = serializers.EmailField()
+    context = serializers.DictField(required=False, default=dict)
+
+
+class MailMergeSerializer(serializers.Serializer):
+    """Serializer for sending one template to many recipients"""
+    subject = serializers.CharField(max_length=255)
+    template_name = serializers.CharField()
+    base_context = serializers.DictField(required=False, default=dict)
+    rows = MailMergeRowSerializer(many=True, allow_empty=False)
+    chunk_size = serializers.IntegerField(required=False, allow_null=True, min_value=1)
+    compact = serializers.BooleanField(required=False, default=False)
+    priority = priority_field()
+    idempotency_key = idempotency_key_field()
 
 
 class EmailWithAttachmentSerializer(serializers.Serializer):
@@ -35,3 +109,22 @@ class EmailWithAttachmentSerializer(serializers.Serializer):
     attachment_path = serializers.CharField()
     filename = serializers.CharField(required=False, allow_null=True)
     html_message = serializers.CharField(required=False, allow_null=True)
+    priority = priority_field()
+    idempotency_key = idempotency_key_field()
+
+
+class TaskStatusBatchSerializer(serializers.Serializer):
+    """Serializer for looking up the status of many tasks at once"""
+    task_ids = serializers.ListField(
+        child=serializers.CharField(max_length=255),
+        allow_empty=False,
+        max_length=getattr(settings, 'EMAIL_STATUS_BATCH_MAX_IDS', 1000),
+    )
+    include_results = serializers.BooleanField(required=False, default=True)
+
+
+class DeliveryLogQuerySerializer(serializers.Serializer):
+    """Serializer for paging through the delivery log of a task"""
+    status = serializers.CharField(required=False)
+    after = serializers.IntegerField(required=False, min_value=0)
+    limit = serializers.IntegerField(required=False, default=100, min_value=1, max_value=1000)
@@ -0,0 +1,225 @@
+from asgiref.sync import sync_to_async
+from celery import current_app, states
+from celery.backends.redis import RedisBackend
+from celery.result import AsyncResult, GroupResult
+from django_celery_results.backends import DatabaseBackend
+from django_celery_results.models import GroupResult as TaskGroupResult, TaskResult
+
+from .async_redis import get_auto_pipeline
+from .results import audit_enabled, audited_statuses
+from .tasks import merge_bulk_results
+
+
+def task_status(task_id):
+    """
+    Status of a single task, or the aggregated progress if task_id is the
+    group id of a fanned out bulk send
+
+    Args:
+        task_id (str): Celery task or group id
+    """
+    group_result = GroupResult.restore(task_id)
+    if group_result is not None:
+        return group_status(task_id, group_result)
+
+    task_result = AsyncResult(task_id)
+
+    result = {
+        'task_id': task_id,
+        'status': task_result.status,
+    }
+
+    if task_result.status == states.PENDING and audit_enabled():
+        # Expired from Redis (or stored before switching to it)
+        audited = audited_statuses([task_id]).get(task_id)
+        if audited is not None:
+            return {'task_id': task_id, **audited}
+
+    if task_result.ready():
+        if task_result.successful():
+            result['result'] = task_result.get()
+        else:
+            result['error'] = str(task_result.result)
+
+    return result
+
+
+def group_status(group_id, group_result):
+    """
+    Aggregate the progress of the chunk tasks of a fanned out bulk send
+
+    Args:
+        group_id (str): Id of the saved group
+        group_result (GroupResult): The restored group
+    """
+    completed = [r for r in group_result.results if r.ready()]
+    finished = [r.result for r in completed if r.successful()]
+    merged = merge_bulk_results(finished)
+
+    result = {
+        'task_id': group_id,
+        'status': 'SUCCESS' if len(completed) == len(group_result.results) else 'PROGRESS',
+        'progress': {
+            'chunks_total': len(group_result.results),
+            'chunks_completed': len(completed),
+            'chunks_failed': len(completed) - len(finished),
+        },
+        'summary': merged['summary'],
+    }
+    if result['status'] == 'SUCCESS':
+        result['result'] = merged
+    return result
+
+
+def group_task_ids(group_id):
+    """Ids of the chunk tasks of a saved group, or None if it is not a group"""
+    group_result = GroupResult.restore(group_id)
+    if group_result is None:
+        return None
+    return [result.id for result in group_result.results]
+
+
+def _status_from_row(backend, row, include_results=True):
+    """Build the status dict for a TaskResult row without another query"""
+    result = {'status': row.status}
+    if row.status in states.READY_STATES and include_results:
+        decoded = backend.decode_content(row, row.result)
+        if row.status == states.SUCCESS:
+            result['result'] = decoded
+        else:
+            result['error'] = str(backend.exception_to_python(decoded))
+    return result
+
+
+def _status_from_meta(backend, meta, include_results=True):
+    """Build the status dict from a task meta stored in Redis"""
+    result = {'status': meta['status']}
+    if meta['status'] in states.READY_STATES and include_results:
+        if meta['status'] == states.SUCCESS:
+            result['result'] = meta['result']
+        else:
+            result['error'] = str(backend.exception_to_python(meta['result']))
+    return result
+
+
+def task_statuses(task_ids, include_results=True):
+    """
+    Status of many tasks with a single indexed query against the result
+    backend table, or a single MGET with the Redis result backend
+
+    Ids without a stored task result are looked up individually: saved
+    groups report their aggregated progress and anything else is still
+    pending. With Redis, results that have expired are read from the
+    audit rows in the database first.
+
+    Args:
+        task_ids (list): Celery task or group ids
+        include_results (bool): Include task results, or only the states
+
+    Returns:
+        dict: task_id -> {"status", and "result" or "error" once ready}
+    """
+    task_ids = list(dict.fromkeys(task_ids))
+    statuses = {}
+
+    backend = current_app.backend
+    if isinstance(backend, DatabaseBackend):
+        fields = ['task_id', 'status']
+        if include_results:
+            fields += ['result', 'content_type', 'content_encoding']
+        rows = TaskResult.objects.filter(task_id__in=task_ids).only(*fields)
+        for row in rows:
+            statuses[row.task_id] = _status_from_row(backend, row, include_results)
+
+        missing = [task_id for task_id in task_ids if task_id not in statuses]
+        group_ids = set(
+            TaskGroupResult.objects.filter(group_id__in=missing).values_list('group_id', flat=True)
+        ) if missing else set()
+        for task_id in missing:
+            if task_id not in group_ids:
+                statuses[task_id] = {'status': states.PENDING}
+
+    elif isinstance(backend, RedisBackend):
+        values = backend.mget([backend.get_key_for_task(task_id) for task_id in task_ids])
+        statuses.update(_statuses_from_metas(backend, task_ids, values, include_results))
+
+        missing = [task_id for task_id in task_ids if task_id not in statuses]
+        if missing:
+            statuses.update(audited_statuses(missing, include_results))
+            missing = [task_id for task_id in missing if task_id not in statuses]
+        if missing:
+            values = backend.mget([backend.get_key_for_group(task_id) for task_id in missing])
+            for task_id, value in zip(missing, values):
+                if value is None:
+                    statuses[task_id] = {'status': states.PENDING}
+
+    missing = [task_id for task_id in task_ids if task_id not in statuses]
+    statuses.update(_individual_statuses(missing, include_results))
+
+    return {task_id: statuses[task_id] for task_id in task_ids}
+
+
+def _statuses_from_metas(backend, task_ids, values, include_results=True):
+    """Status dicts of the tasks whose metas were found in Redis"""
+    return {
+        task_id: _status_from_meta(backend, backend.decode_result(value), include_results)
+        for task_id, value in zip(task_ids, values)
+        if value is not None
+    }
+
+
+def _individual_statuses(task_ids, include_results=True):
+    """task_status() of each task, without its task_id"""
+    statuses = {}
+    for task_id in task_ids:
+        status = task_status(task_id)
+        status.pop('task_id', None)
+        if not include_results:
+            status.pop('result', None)
+        statuses[task_id] = status
+    return statuses
+
+
+async def atask_statuses(task_ids, include_results=True):
+    """
+    task_statuses() for async views
+
+    With the Redis result backend the task metas, and the group metas of
+    the ids without one, are read with redis.asyncio, together with the
+    reads of concurrent requests (see AutoPipeline). The audit rows, saved
+    groups and the database backend are read from a thread, as Django's
+    async ORM does.
+    """
+    backend = current_app.backend
+    if not isinstance(backend, RedisBackend):
+        return await sync_to_async(task_statuses)(task_ids, include_results)
+
+    task_ids = list(dict.fromkeys(task_ids))
+    pipeline = get_auto_pipeline(current_app.conf.result_backend)
+    values, = await pipeline.execute(
+        lambda pipe: pipe.mget([backend.get_key_for_task(task_id) for task_id in task_ids])
+    )
+    statuses = _statuses_from_metas(backend, task_ids, values, include_results)
+
+    missing = [task_id for task_id in task_ids if task_id not in statuses]
+    if missing:
+        statuses.update(await sync_to_async(audited_statuses)(missing, include_results))
+        missing = [task_id for task_id in missing if task_id not in statuses]
+    if missing:
+        values, = await pipeline.execute(
+            lambda pipe: pipe.mget([backend.get_key_for_group(task_id) for task_id in missing])
+        )
+        for task_id, value in zip(missing, values):
+            if value is None:
+                statuses[task_id] = {'status': states.PENDING}
+        missing = [task_id for task_id in missing if task_id not in statuses]
+    if missing:
+        statuses.update(await sync_to_async(_individual_statuses)(missing, include_results))
+
+    return {task_id: statuses[task_id] for task_id in task_ids}
+
+
+async def atask_status(task_id):
+    """task_status() for async views"""
+    statuses = await atask_statuses([task_id])
+    return {'task_id': task_id, **statuses[task_id]}
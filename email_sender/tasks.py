@@ -1,26 +1,324 @@
 import logging
-from celery import shared_task
-from django.core.mail import send_mail, EmailMessage, EmailMultiAlternatives
-from django.template.loader import render_to_string
+from asgiref.sync import sync_to_async
+from celery import shared_task, chord
+from django.core.mail import send_mail, get_connection, EmailMessage, EmailMultiAlternatives
 from django.conf import settings
-from django.utils.html import strip_tags
 import os
+import redis
+import smtplib
+
+from .attachments import (
+    AttachmentTooLarge,
+    check_attachment_size,
+    check_memory_ceiling,
+    stream_email_with_attachment,
+    supports_streaming,
+)
+from .async_engine import AsyncSMTPEngine, async_engine_enabled
+from .bodies import BodyMissing, check_in, check_out, get_claim_check, purge_body_store
+from .connection import BatchSession, SMTPSession
+from .delivery_log import DeliveryRecorder
+from .idempotency import (
+    PENDING,
+    SendInProgress,
+    claim,
+    claim_many,
+    finish,
+    recipient_key,
+    release,
+)
+from .metrics import TimedTask, stage
+from .outbox import claim_batch, claimed_emails, record_outcomes, release_batch
+from .planner import (
+    build_envelope_message,
+    group_by_domain,
+    multi_rcpt_enabled,
+    plan_envelopes,
+    refused_recipients,
+)
+from .publish import apublish_many, publish_many
+from .rate_limit import RateLimited, throttle
+from . import events  # noqa: F401  publishes task state transitions
+from . import results  # noqa: F401  audits task results kept in Redis
+from .rendering import render_email
+from .retry import backoff_delay, can_retry, classify_error, is_transient, is_transient_result
+from .uploads import load_recipient_chunk, purge_recipient_chunks
 
 # Configure logger
 logger = logging.getLogger(__name__)
 
-@shared_task(name="send_email_task")
-def send_email_task(recipient_email, subject, message, html_message=None):
+
+def build_email_message(recipient_email, subject, message, html_message=None, connection=None):
+    """
+    Build (but do not send) the message that send_mail would send
+
+    Args:
+        recipient_email (str): Email address of the recipient
+        subject (str): Email subject
+        message (str): Plain text message
+        html_message (str, optional): HTML content for the email
+        connection (optional): Mail backend connection to bind the message to
+    """
+    email = EmailMultiAlternatives(
+        subject=subject,
+        body=message,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[recipient_email],
+        connection=connection,
+    )
+    if html_message:
+        email.attach_alternative(html_message, "text/html")
+    return email
+
+
+def delivery_result(recipient_email, subject, email_sent, error=None):
+    """
+    Result dict for one delivery, in the same shape send_email_task returns
+
+    Args:
+        recipient_email (str): Email address of the recipient
+        subject (str): Email subject
+        email_sent (int): Number of messages the backend reported as sent
+        error (Exception, optional): Error raised while sending, classified
+            under "error_type" as transient (worth retrying) or permanent
+    """
+    if error is not None:
+        logger.error(f"Error sending email to {recipient_email}: {str(error)}")
+        return {
+            "status": "error",
+            "message": f"Error sending email: {str(error)}",
+            "error_type": classify_error(error),
+            "details": {
+                "to": recipient_email,
+                "subject": subject,
+            }
+        }
+
+    if email_sent:
+        logger.info(f"Email sent successfully to {recipient_email}")
+        return {
+            "status": "success",
+            "message": f"Email sent to {recipient_email}",
+            "details": {
+                "to": recipient_email,
+                "subject": subject,
+            }
+        }
+
+    logger.error(f"Failed to send email to {recipient_email}")
+    return {
+        "status": "failed",
+        "message": f"Failed to send email to {recipient_email}",
+    }
+
+
+def in_progress_result(recipient_email, subject):
+    """Result dict for a recipient whose email another task is still sending"""
+    logger.warning(f"Email to {recipient_email} is already being sent, skipping")
+    return {
+        "status": "skipped",
+        "message": f"Email to {recipient_email} is already being sent",
+        "details": {
+            "to": recipient_email,
+            "subject": subject,
+        }
+    }
+
+
+def send_with_session(session, recipient_email, subject, message, html_message=None, idempotency_key=None):
+    """
+    Send one email over an already established SMTPSession and return the
+    same result dict as send_email_task
+
+    Args:
+        session (SMTPSession): Shared connection to send over
+        recipient_email (str): Email address of the recipient
+        subject (str): Email subject
+        message (str): Plain text message
+        html_message (str, optional): HTML content for the email
+        idempotency_key (str, optional): If an email was already sent under
+            this key, its stored result is returned instead of sending again
+    """
+    if idempotency_key:
+        try:
+            previous = claim(idempotency_key)
+        except SendInProgress:
+            return in_progress_result(recipient_email, subject)
+        if previous is not None:
+            return previous
+
+    try:
+        email = build_email_message(recipient_email, subject, message, html_message)
+        result = delivery_result(recipient_email, subject, session.send(email))
+
+    except RateLimited:
+        # Let the calling task defer the rest of its recipients
+        if idempotency_key:
+            release(idempotency_key)
+        raise
+
+    except Exception as e:
+        result = delivery_result(recipient_email, subject, 0, error=e)
+
+    if idempotency_key:
+        finish((idempotency_key, result))
+    return result
+
+
+def send_batch_once(engine, subject, items, error_result=None):
+    """
+    Send a batch over the async engine, skipping emails that were already sent
+
+    Args:
+        engine (AsyncSMTPEngine): Engine to send with
+        subject (str): Email subject
+        items (list): (recipient, idempotency key, build) tuples, where
+            build() returns the EmailMessage and is only called for emails
+            that still have to be sent
+        error_result (callable, optional): (recipient, error) -> result dict
+            for emails that could not be built
+
+    Returns:
+        list: Result dict per item, or None for the items that were not
+            attempted because the engine was rate limited
+    """
+    if error_result is None:
+        def error_result(recipient, error):
+            return delivery_result(recipient, subject, 0, error=error)
+
+    results = [None] * len(items)
+    finished, todo, emails = [], [], []
+    for index, ((recipient, key, build), previous) in enumerate(zip(items, claim_many([key for _, key, _ in items]))):
+        if previous is PENDING:
+            results[index] = in_progress_result(recipient, subject)
+        elif previous is not None:
+            results[index] = previous
+        else:
+            try:
+                emails.append(build())
+                todo.append(index)
+            except Exception as e:
+                results[index] = error_result(recipient, e)
+                finished.append((key, results[index]))
+
+    unsent = []
+    for index, outcome in zip(todo, engine.send_batch(emails)):
+        recipient, key, _ = items[index]
+        if outcome is None:
+            unsent.append(key)
+        else:
+            results[index] = delivery_result(recipient, subject, *outcome)
+            finished.append((key, results[index]))
+
+    finish(*finished)
+    release(*unsent)
+    return results
+
+
+def envelope_results(recipients, subject, outcome):
+    """
+    Result dict per recipient of a multi-recipient message
+
+    Args:
+        recipients (list): Email addresses of the envelope
+        subject (str): Email subject
+        outcome (tuple): (sent, error) of the message. Recipients refused
+            while others were accepted fail with their own reply code.
+    """
+    sent, error = outcome
+    refused = refused_recipients(error) if sent else None
+    if refused is None:
+        return [delivery_result(recipient, subject, sent, error=error) for recipient in recipients]
+    return [
+        delivery_result(
+            recipient, subject, 0,
+            error=smtplib.SMTPRecipientsRefused({recipient: refused[recipient]}),
+        ) if recipient in refused else delivery_result(recipient, subject, sent)
+        for recipient in recipients
+    ]
+
+
+def send_envelopes_once(engine, subject, message, html_message, items):
+    """
+    Send the same message to a batch of recipients as multi-recipient
+    envelopes (see plan_envelopes), skipping recipients who already got it
+
+    Args:
+        engine (AsyncSMTPEngine or BatchSession): Sender of the envelopes
+        subject (str): Email subject
+        message (str): Plain text message
+        html_message (str, optional): HTML content for the email
+        items (list): (recipient, idempotency key) tuples
+
+    Returns:
+        list: Result dict per item, or None for the items that were not
+            attempted because the engine was rate limited
+    """
+    results = [None] * len(items)
+    keys = {}
+    for index, ((recipient, key), previous) in enumerate(zip(items, claim_many([key for _, key in items]))):
+        if previous is PENDING:
+            results[index] = in_progress_result(recipient, subject)
+        elif previous is not None:
+            results[index] = previous
+        else:
+            keys[recipient] = (index, key)
+
+    envelopes = plan_envelopes(list(keys))
+    emails, built = [], []
+    for envelope in envelopes:
+        try:
+            emails.append(build_envelope_message(envelope, subject, message, html_message))
+            built.append(envelope)
+        except Exception as e:
+            for recipient in envelope:
+                results[keys[recipient][0]] = delivery_result(recipient, subject, 0, error=e)
+
+    for envelope, outcome in zip(built, engine.send_batch(emails)):
+        if outcome is not None:
+            for recipient, result in zip(envelope, envelope_results(envelope, subject, outcome)):
+                results[keys[recipient][0]] = result
+
+    finish(*[(key, results[index]) for index, key in keys.values() if results[index] is not None])
+    release(*[key for index, key in keys.values() if results[index] is None])
+    return results
+
+
+@shared_task(bind=True, base=TimedTask, name="send_email_task")
+def send_email_task(self, recipient_email, subject, message, html_message=None, idempotency_key=None,
+                    transient_retries=0):
     """
     Task to send an email to a single recipient
 
+    Transient SMTP failures (4xx replies, dropped connections) are retried
+    with exponential backoff up to EMAIL_RETRY_MAX_RETRIES times; permanent
+    ones (5xx replies) are returned as errors straight away.
+
     Args:
         recipient_email (str): Email address of the recipient
         subject (str): Email subject
         message (str): Plain text message
         html_message (str, optional): HTML content for the email
+        idempotency_key (str, optional): Key identifying this send, defaults
+            to the task id so a redelivered task doesn't send twice. An email
+            already sent under the same key is not sent again.
+        transient_retries (int): Retries after transient failures so far
+
+    message and html_message may be claim checks (see bodies.check_in);
+    retries keep passing the claim checks, not the bodies. A body store
+    that can't be reached is retried with backoff; a body that has expired
+    from it is a permanent error.
     """
+    key = idempotency_key or self.request.id
+
     try:
+        message, html_message = check_out(message), check_out(html_message)
+        previous = claim(key)
+        if previous is not None:
+            return previous
+
+        throttle()
+
         if html_message:
             # Send HTML email
             email_sent = send_mail(
@@ -41,108 +339,615 @@ def send_email_task(recipient_email, subject, message, html_message=None):
                 fail_silently=False,
             )
 
-        if email_sent:
-            logger.info(f"Email sent successfully to {recipient_email}")
-            return {
-                "status": "success",
-                "message": f"Email sent to {recipient_email}",
-                "details": {
-                    "to": recipient_email,
-                    "subject": subject,
-                }
-            }
-        else:
-            logger.error(f"Failed to send email to {recipient_email}")
-            return {
-                "status": "failed",
-                "message": f"Failed to send email to {recipient_email}",
-            }
+        result = delivery_result(recipient_email, subject, email_sent)
+
+    except SendInProgress as e:
+        logger.warning(f"Email to {recipient_email} is already being sent, checking again in {e.wait}s")
+        raise self.retry(exc=e, countdown=e.wait, max_retries=None)
+
+    except RateLimited as e:
+        release(key)
+        logger.warning(f"Rate limited, deferring email to {recipient_email} by {e.wait:.1f}s")
+        raise self.retry(exc=e, countdown=e.wait, max_retries=None)
+
+    except BodyMissing as e:
+        return delivery_result(recipient_email, subject, 0, error=e)
+
+    except redis.RedisError as e:
+        countdown = backoff_delay(transient_retries)
+        logger.warning(f"Body store unavailable, retrying email to {recipient_email} in {countdown:.1f}s: {str(e)}")
+        raise self.retry(exc=e, countdown=countdown)
 
     except Exception as e:
-        logger.error(f"Error sending email to {recipient_email}: {str(e)}")
-        return {
-            "status": "error",
-            "message": f"Error sending email: {str(e)}",
-            "details": {
-                "to": recipient_email,
-                "subject": subject,
-            }
+        result = delivery_result(recipient_email, subject, 0, error=e)
+        if is_transient_result(result) and can_retry(transient_retries):
+            release(key)
+            countdown = backoff_delay(transient_retries)
+            logger.warning(f"Transient error sending email to {recipient_email}, retrying in {countdown:.1f}s")
+            raise self.retry(
+                exc=e,
+                kwargs={**self.request.kwargs, "transient_retries": transient_retries + 1},
+                countdown=countdown,
+                max_retries=None,
+            )
+
+    finish((key, result))
+    return result
+
+
+def email_task_calls(emails):
+    """
+    (kwargs, options) of a send_email_task per email, with large bodies
+    checked in to the body store
+
+    Args:
+        emails (list): Dicts with recipient_email, subject, message and
+            optionally html_message, idempotency_key and priority (int)
+    """
+    return [
+        (
+            dict(
+                recipient_email=email['recipient_email'],
+                subject=email['subject'],
+                message=check_in(email['message']),
+                html_message=check_in(email.get('html_message')),
+                idempotency_key=email.get('idempotency_key'),
+            ),
+            dict(
+                priority=email.get('priority'),
+                # Shown by monitoring tools instead of the whole kwargs,
+                # which Celery would otherwise format for every message
+                kwargsrepr=repr({'recipient_email': email['recipient_email'], 'subject': email['subject']}),
+            ),
+        )
+        for email in emails
+    ]
+
+
+def dispatch_emails(emails):
+    """
+    Queue a send_email_task for each of many independent emails, published
+    together over one broker connection (see publish_many)
+
+    Args:
+        emails (list): See email_task_calls
+
+    Returns:
+        list: AsyncResult per email, in order
+    """
+    return publish_many(send_email_task, email_task_calls(emails))
+
+
+async def adispatch_emails(emails):
+    """
+    dispatch_emails() for async views, without blocking the event loop (see
+    apublish_many)
+    """
+    if get_claim_check() is None:
+        calls = email_task_calls(emails)
+    else:
+        # Checking in a large body writes it to the body store
+        calls = await sync_to_async(email_task_calls, thread_sensitive=False)(emails)
+    return await apublish_many(send_email_task, calls)
+
+
+@shared_task(name="dispatch_outbox_task")
+def dispatch_outbox_task():
+    """
+    Periodic task (celery beat, every EMAIL_OUTBOX_INTERVAL seconds) that
+    claims due outbox emails in batches of EMAIL_OUTBOX_BATCH_SIZE and
+    queues one send_outbox_batch_task per batch, up to
+    EMAIL_OUTBOX_MAX_BATCHES per run
+    """
+    batch_size = getattr(settings, 'EMAIL_OUTBOX_BATCH_SIZE', 200)
+    batches = 0
+    claimed = 0
+    for _ in range(getattr(settings, 'EMAIL_OUTBOX_MAX_BATCHES', 10)):
+        token, count = claim_batch(batch_size)
+        if not count:
+            break
+        try:
+            send_outbox_batch_task.apply_async(args=[token])
+        except Exception as e:
+            # Leave the emails in the outbox for the next run
+            release_batch(token)
+            logger.error(f"Could not queue outbox batch of {count} emails: {str(e)}")
+            break
+        batches += 1
+        claimed += count
+
+    if claimed:
+        logger.info(f"Dispatched {claimed} outbox emails in {batches} batches")
+    return {
+        "status": "success",
+        "message": f"Dispatched {claimed} outbox emails in {batches} batches",
+        "details": {
+            "batches": batches,
+            "emails": claimed,
         }
+    }
+
+
+@shared_task(bind=True, base=TimedTask, name="send_outbox_batch_task")
+def send_outbox_batch_task(self, claim_token):
+    """
+    Task to send a batch of claimed outbox emails over one shared SMTP
+    session and record each outcome on its outbox row
+
+    Args:
+        claim_token (str): Token of the claim made by dispatch_outbox_task.
+            Emails reclaimed by another dispatch since are left alone.
+    """
+    emails = claimed_emails(claim_token)
+    outcomes = []
+    with SMTPSession() as session:
+        for index, email in enumerate(emails):
+            try:
+                result = send_with_session(
+                    session, email.recipient, email.subject, email.message, email.html_message,
+                    idempotency_key=email.idempotency_key or f"outbox:{email.pk}",
+                )
+            except RateLimited as e:
+                # The rest of the batch goes back to the outbox until the budget allows
+                logger.warning(f"Rate limited, returning {len(emails) - index} outbox emails for {e.wait:.1f}s")
+                release_batch(claim_token, delay=e.wait, emails=emails[index:])
+                break
+            outcomes.append((email, result))
+
+    counts = record_outcomes(outcomes)
+    return {
+        "status": "completed",
+        "summary": {
+            "total": len(emails),
+            "success": counts["sent"],
+            "failed": counts["failed"],
+            "retried": counts["retried"],
+        },
+        "connection": session.stats(),
+    }
 
 
-@shared_task(name="send_bulk_email_task")
-def send_bulk_email_task(recipient_list, subject, message, html_message=None):
+@shared_task(bind=True, base=TimedTask, name="send_bulk_email_task")
+def send_bulk_email_task(self, recipient_list, subject, message, html_message=None, compact=False, resume=None,
+                         idempotency_key=None, recipient_chunk=None, transient_retries=0):
     """
     Task to send emails to multiple recipients
 
+    Recipients that fail with a transient SMTP error are re-queued on their
+    own, with exponential backoff, up to EMAIL_RETRY_MAX_RETRIES times.
+
     Args:
-        recipient_list (list): List of email addresses
+        recipient_list (list): List of email addresses, or None when
+            recipient_chunk is given
         subject (str): Email subject
         message (str): Plain text message
         html_message (str, optional): HTML content for the email
+        compact (bool): Return only counters and failures and write every
+            per-recipient outcome to the delivery log instead
+        resume (dict, optional): Partial result of an earlier run that was
+            deferred by the rate limiter
+        idempotency_key (str, optional): Key of the whole send. Recipients
+            who already got this email under this key (or, without one, in
+            an earlier delivery of this task) are skipped.
+        recipient_chunk (dict, optional): {"upload_id", "index"} of a stored
+            chunk of an uploaded recipient list to send to. The addresses
+            are read here instead of travelling through the broker; a chunk
+            deferred by the rate limiter is re-queued with the addresses it
+            has left.
+        transient_retries (int): Retries after transient failures so far
+
+    message and html_message may be claim checks (see bodies.check_in);
+    re-queued recipients are sent with the same claim checks. A body store
+    that can't be reached is retried with backoff; if a body has expired
+    from it, every recipient fails permanently.
+    """
+    if recipient_chunk is not None:
+        recipient_list = load_recipient_chunk(recipient_chunk)
+
+    recorder = DeliveryRecorder(task_id=self.request.id, compact=compact, resume=resume)
+    total = recorder.processed + len(recipient_list)
+
+    # As received, for the tasks re-queued below
+    bodies = [message, html_message]
+    try:
+        message, html_message = check_out(message), check_out(html_message)
+    except BodyMissing as e:
+        for recipient in recipient_list:
+            recorder.record(recipient, delivery_result(recipient, subject, 0, error=e))
+        return recorder.result(total=total)
+    except redis.RedisError as e:
+        countdown = backoff_delay(transient_retries)
+        logger.warning(f"Body store unavailable, retrying {len(recipient_list)} bulk recipients in {countdown:.1f}s: {str(e)}")
+        raise self.retry(exc=e, countdown=countdown)
+    retry_kwargs = {"compact": compact, "idempotency_key": idempotency_key, "transient_retries": transient_retries}
+    # Recipients to retry after a transient failure, recorded only once final
+    retrying = can_retry(transient_retries)
+    deferred = []
+
+    def key_for(recipient):
+        return recipient_key(idempotency_key or self.request.id, recipient)
+
+    multi_rcpt = multi_rcpt_enabled()
+    if async_engine_enabled() or multi_rcpt:
+        # Many concurrent SMTP sessions multiplexed in this process, and/or
+        # one message per envelope of same-domain recipients
+        if multi_rcpt:
+            recipient_list = group_by_domain(recipient_list)
+        with (AsyncSMTPEngine() if async_engine_enabled() else BatchSession()) as engine:
+            remaining = []
+            for batch in chunk_recipients(recipient_list, getattr(settings, 'EMAIL_ASYNC_BATCH_SIZE', 500)):
+                if multi_rcpt:
+                    results = send_envelopes_once(
+                        engine, subject, message, html_message, [(r, key_for(r)) for r in batch]
+                    )
+                else:
+                    items = [
+                        (r, key_for(r), lambda r=r: build_email_message(r, subject, message, html_message))
+                        for r in batch
+                    ]
+                    results = send_batch_once(engine, subject, items)
+                for recipient, result in zip(batch, results):
+                    if result is None:
+                        remaining.append(recipient)
+                    elif retrying and is_transient_result(result):
+                        deferred.append(recipient)
+                    else:
+                        recorder.record(recipient, result)
+
+        if engine.rate_limited is not None:
+            logger.warning(
+                f"Rate limited, deferring {len(deferred) + len(remaining)} bulk recipients by "
+                f"{engine.rate_limited.wait:.1f}s"
+            )
+            raise self.retry(
+                args=[deferred + remaining, subject, *bodies],
+                kwargs={**retry_kwargs, "resume": recorder.result(total=recorder.processed)},
+                countdown=engine.rate_limited.wait,
+                max_retries=None,
+            )
+
+        if deferred:
+            countdown = backoff_delay(transient_retries)
+            logger.warning(f"Retrying {len(deferred)} bulk recipients after transient errors in {countdown:.1f}s")
+            raise self.retry(
+                args=[deferred, subject, *bodies],
+                kwargs={
+                    **retry_kwargs,
+                    "transient_retries": transient_retries + 1,
+                    "resume": recorder.result(total=recorder.processed),
+                },
+                countdown=countdown,
+                max_retries=None,
+            )
+
+        result = recorder.result(total=total)
+        result["connection"] = engine.stats()
+        return result
+
+    # One SMTP session for the whole list instead of one per recipient
+    with SMTPSession() as session:
+        for index, recipient in enumerate(recipient_list):
+            try:
+                result = send_with_session(
+                    session, recipient, subject, message, html_message, idempotency_key=key_for(recipient)
+                )
+            except RateLimited as e:
+                # Re-queue only the recipients that are left, with an ETA
+                logger.warning(
+                    f"Rate limited, deferring {len(deferred) + len(recipient_list) - index} bulk recipients "
+                    f"by {e.wait:.1f}s"
+                )
+                raise self.retry(
+                    args=[deferred + recipient_list[index:], subject, *bodies],
+                    kwargs={**retry_kwargs, "resume": recorder.result(total=recorder.processed)},
+                    countdown=e.wait,
+                    max_retries=None,
+                )
+            if retrying and is_transient_result(result):
+                deferred.append(recipient)
+                continue
+            recorder.record(recipient, result)
+
+    if deferred:
+        # Only the recipients that failed transiently are sent again
+        countdown = backoff_delay(transient_retries)
+        logger.warning(f"Retrying {len(deferred)} bulk recipients after transient errors in {countdown:.1f}s")
+        raise self.retry(
+            args=[deferred, subject, *bodies],
+            kwargs={
+                **retry_kwargs,
+                "transient_retries": transient_retries + 1,
+                "resume": recorder.result(total=recorder.processed),
+            },
+            countdown=countdown,
+            max_retries=None,
+        )
+
+    result = recorder.result(total=total)
+    result["connection"] = session.stats()
+    return result
+
+
+def chunk_recipients(recipient_list, chunk_size):
+    """
+    Split a recipient list (or mail merge rows) into consecutive chunks of
+    at most chunk_size
+
+    Args:
+        recipient_list (list): List of email addresses
+        chunk_size (int): Maximum number of recipients per chunk
+    """
+    return [
+        recipient_list[i:i + chunk_size]
+        for i in range(0, len(recipient_list), chunk_size)
+    ]
+
+
+def merge_bulk_results(chunk_results):
+    """
+    Merge several send_bulk_email_task results into a single result with
+    the same {"status", "summary", "results"} shape (or "failures" and
+    "delivery_log" for compact chunks)
+
+    Args:
+        chunk_results (list): Results returned by the chunk tasks
     """
+    summary = {"total": 0, "success": 0, "failed": 0}
+    connection = {"connections_opened": 0, "reconnects": 0, "messages_sent": 0}
     results = []
-    success_count = 0
-    failure_count = 0
+    failures = []
+    delivery_log_task_ids = []
 
-    for recipient in recipient_list:
-        try:
-            # We use the single email task for each recipient
-            result = send_email_task(recipient, subject, message, html_message)
+    for chunk_result in chunk_results:
+        for key in summary:
+            summary[key] += chunk_result["summary"][key]
+        for key in connection:
+            connection[key] += chunk_result.get("connection", {}).get(key, 0)
+        if "delivery_log" in chunk_result:
+            failures.extend(chunk_result["failures"])
+            delivery_log_task_ids.append(chunk_result["delivery_log"]["task_id"])
+        else:
+            results.extend(chunk_result.get("results", []))
 
-            if result["status"] == "success":
-                success_count += 1
-            else:
-                failure_count += 1
+    connection["messages_per_connection"] = (
+        round(connection["messages_sent"] / connection["connections_opened"], 2)
+        if connection["connections_opened"] else 0
+    )
 
-            results.append(result)
-        except Exception as e:
-            logger.error(f"Error in bulk email sending to {recipient}: {str(e)}")
-            failure_count += 1
-            results.append({
-                "status": "error",
-                "message": f"Error sending email: {str(e)}",
-                "recipient": recipient
-            })
+    merged = {
+        "status": "completed",
+        "summary": summary,
+        "chunks": len(chunk_results),
+        "connection": connection,
+    }
+    if delivery_log_task_ids:
+        merged["failures"] = failures
+        merged["delivery_log"] = {"task_ids": delivery_log_task_ids}
+    else:
+        merged["results"] = results
+    return merged
+
+
+@shared_task(name="merge_bulk_email_results_task")
+def merge_bulk_email_results_task(chunk_results):
+    """
+    Chord callback that merges the per-chunk summaries of a fanned out
+    bulk send
+
+    Args:
+        chunk_results (list): Results returned by the chunk tasks
+    """
+    result = merge_bulk_results(chunk_results)
+    logger.info(
+        f"Bulk email fan-out completed: {result['summary']['success']}/"
+        f"{result['summary']['total']} sent across {result['chunks']} chunks"
+    )
+    return result
+
+
+def dispatch_bulk_email(recipient_list, subject, message, html_message=None, chunk_size=None, compact=False,
+                        priority=None, idempotency_key=None):
+    """
+    Queue a bulk send, fanning it out across workers when chunk_size is given
+
+    The recipient list is split into chunks that are sent by a group of
+    send_bulk_email_task sub-tasks, and merge_bulk_email_results_task
+    combines their summaries once all of them have finished.
+
+    Args:
+        recipient_list (list): List of email addresses
+        subject (str): Email subject
+        message (str): Plain text message
+        html_message (str, optional): HTML content for the email
+        chunk_size (int, optional): Recipients per sub-task
+        compact (bool): Keep per-recipient outcomes in the delivery log
+            instead of the task result
+        priority (int, optional): Message priority of every queued task
+        idempotency_key (str, optional): Key of the whole send, see
+            send_bulk_email_task
+
+    Returns:
+        tuple: (AsyncResult of the task holding the final result,
+                GroupResult of the chunk tasks or None)
+    """
+    # Large bodies are stored once and shared by every chunk
+    message, html_message = check_in(message), check_in(html_message)
+
+    if not chunk_size or len(recipient_list) <= chunk_size:
+        task = send_bulk_email_task.apply_async(
+            kwargs=dict(
+                recipient_list=recipient_list,
+                subject=subject,
+                message=message,
+                html_message=html_message,
+                compact=compact,
+                idempotency_key=idempotency_key,
+            ),
+            priority=priority,
+        )
+        return task, None
+
+    # Chunks hold whole domains where possible, so multi-recipient
+    # envelopes stay full and sessions carry runs of one destination
+    header = [
+        send_bulk_email_task.s(
+            chunk, subject, message, html_message, compact, idempotency_key=idempotency_key
+        ).set(priority=priority)
+        for chunk in chunk_recipients(group_by_domain(recipient_list), chunk_size)
+    ]
+    task = chord(header)(merge_bulk_email_results_task.s().set(priority=priority))
+
+    # Persist the group so the status endpoint can report progress. Eager
+    # mode runs the chord inline and has no group to track.
+    group_result = task.parent
+    if group_result is not None:
+        group_result.save()
+    return task, group_result
+
+
+def dispatch_recipient_upload(upload, subject, message, html_message=None, compact=True, priority=None,
+                              idempotency_key=None):
+    """
+    Queue a bulk send to an uploaded recipient list, one task per stored chunk
+
+    Only chunk references go through the broker, the tasks read their
+    addresses from the database.
+
+    Args:
+        upload (RecipientUpload): Stored upload, see store_recipient_file
+        subject (str): Email subject
+        message (str): Plain text message
+        html_message (str, optional): HTML content for the email
+        compact (bool): Keep per-recipient outcomes in the delivery log
+            instead of the task result
+        priority (int, optional): Message priority of every queued task
+        idempotency_key (str, optional): Key of the whole send, see
+            send_bulk_email_task
+
+    Returns:
+        tuple: (AsyncResult of the task holding the final result,
+                GroupResult of the chunk tasks or None)
+    """
+    refs = upload.chunk_refs()
+    message, html_message = check_in(message), check_in(html_message)
+    if len(refs) == 1:
+        task = send_bulk_email_task.apply_async(
+            kwargs=dict(
+                recipient_list=None,
+                subject=subject,
+                message=message,
+                html_message=html_message,
+                compact=compact,
+                idempotency_key=idempotency_key,
+                recipient_chunk=refs[0],
+            ),
+            priority=priority,
+        )
+        return task, None
+
+    header = [
+        send_bulk_email_task.s(
+            None, subject, message, html_message, compact, idempotency_key=idempotency_key, recipient_chunk=ref
+        ).set(priority=priority)
+        for ref in refs
+    ]
+    task = chord(header)(merge_bulk_email_results_task.s().set(priority=priority))
+
+    group_result = task.parent
+    if group_result is not None:
+        group_result.save()
+    return task, group_result
+
+
+@shared_task(name="purge_recipient_uploads_task")
+def purge_recipient_uploads_task():
+    """
+    Task to delete the stored chunks of recipient uploads older than
+    EMAIL_UPLOAD_RETENTION_DAYS, meant to be scheduled with celery beat
+    """
+    deleted = purge_recipient_chunks()
+    logger.info(f"Purged {deleted} recipient upload chunks")
+    return {
+        "status": "success",
+        "message": f"Purged {deleted} recipient upload chunks",
+        "details": {
+            "deleted": deleted,
+        }
+    }
 
+
+@shared_task(name="purge_body_store_task")
+def purge_body_store_task():
+    """
+    Task to delete bodies not checked in to the disk body store for
+    EMAIL_BODY_STORE_TTL seconds, scheduled by celery beat when
+    EMAIL_BODY_STORE is 'disk'
+    """
+    deleted = purge_body_store()
+    logger.info(f"Purged {deleted} stored email bodies")
     return {
-        "status": "completed",
-        "summary": {
-            "total": len(recipient_list),
-            "success": success_count,
-            "failed": failure_count,
-        },
-        "results": results
+        "status": "success",
+        "message": f"Purged {deleted} stored email bodies",
+        "details": {
+            "deleted": deleted,
+        }
     }
 
 
-@shared_task(name="send_template_email_task")
-def send_template_email_task(recipient_email, subject, template_name, context=None):
+@shared_task(bind=True, base=TimedTask, name="send_template_email_task")
+def send_template_email_task(self, recipient_email, subject, template_name, context=None, idempotency_key=None,
+                             transient_retries=0):
     """
     Task to send an email using a template
 
+    Transient SMTP failures are retried like in send_email_task.
+
     Args:
         recipient_email (str): Email address of the recipient
         subject (str): Email subject
         template_name (str): Name of the template to use
         context (dict, optional): Context data for the template
+        idempotency_key (str, optional): Key identifying this send, defaults
+            to the task id
+        transient_retries (int): Retries after transient failures so far
     """
     if context is None:
         context = {}
+    key = idempotency_key or self.request.id
 
     try:
-        # Render the HTML content
-        html_message = render_to_string(template_name, context)
-        # Create plain text version from HTML
-        plain_message = strip_tags(html_message)
+        # Render the HTML content and its plain text version (cached per worker)
+        html_message, plain_message = render_email(template_name, context)
+
+        # Raises transient errors while retries are left, so this task retries
+        return send_email_task(
+            recipient_email, subject, plain_message, html_message,
+            idempotency_key=key, transient_retries=transient_retries,
+        )
+
+    except SendInProgress as e:
+        logger.warning(f"Template email to {recipient_email} is already being sent, checking again in {e.wait}s")
+        raise self.retry(exc=e, countdown=e.wait, max_retries=None)
 
-        return send_email_task(recipient_email, subject, plain_message, html_message)
+    except RateLimited as e:
+        logger.warning(f"Rate limited, deferring template email to {recipient_email} by {e.wait:.1f}s")
+        raise self.retry(exc=e, countdown=e.wait, max_retries=None)
 
     except Exception as e:
+        if is_transient(e) and can_retry(transient_retries):
+            countdown = backoff_delay(transient_retries)
+            logger.warning(f"Transient error sending template email to {recipient_email}, retrying in {countdown:.1f}s")
+            raise self.retry(
+                exc=e,
+                kwargs={**self.request.kwargs, "transient_retries": transient_retries + 1},
+                countdown=countdown,
+                max_retries=None,
+            )
         logger.error(f"Error sending template email to {recipient_email}: {str(e)}")
         return {
             "status": "error",
             "message": f"Error sending template email: {str(e)}",
+            "error_type": classify_error(e),
             "details": {
                 "to": recipient_email,
                 "subject": subject,
@@ -151,11 +956,221 @@ def send_template_email_task(recipient_email, subject, template_name, context=No
         }
 
 
-@shared_task(name="send_email_with_attachment_task")
-def send_email_with_attachment_task(recipient_email, subject, message, attachment_path, filename=None, html_message=None):
+def mail_merge_error(recipient_email, subject, template_name, error):
+    """Result dict for a mail merge row whose template could not be rendered"""
+    return {
+        "status": "error",
+        "message": f"Error sending template email: {str(error)}",
+        "error_type": classify_error(error),
+        "details": {
+            "to": recipient_email,
+            "subject": subject,
+            "template": template_name,
+        }
+    }
+
+
+@shared_task(bind=True, base=TimedTask, name="send_mail_merge_task")
+def send_mail_merge_task(self, template_name, subject, rows, base_context=None, compact=False, resume=None,
+                         idempotency_key=None, transient_retries=0):
+    """
+    Task to send one template to many recipients, each with its own context
+
+    The template is compiled once per worker and every message goes out over
+    a single shared SMTP connection. Rows that fail with a transient SMTP
+    error are re-queued on their own, like in send_bulk_email_task.
+
+    Args:
+        template_name (str): Name of the template to use
+        subject (str): Email subject
+        rows (list): Dicts with a "recipient" address and an optional
+            per-recipient "context" merged over base_context
+        base_context (dict, optional): Context shared by every recipient
+        compact (bool): Return only counters and failures and write every
+            per-recipient outcome to the delivery log instead
+        resume (dict, optional): Partial result of an earlier run that was
+            deferred by the rate limiter
+        idempotency_key (str, optional): Key of the whole send. Recipients
+            who already got this email under this key (or, without one, in
+            an earlier delivery of this task) are skipped.
+        transient_retries (int): Retries after transient failures so far
+    """
+    if base_context is None:
+        base_context = {}
+
+    recorder = DeliveryRecorder(task_id=self.request.id, compact=compact, resume=resume)
+    total = recorder.processed + len(rows)
+    retry_kwargs = {"compact": compact, "idempotency_key": idempotency_key, "transient_retries": transient_retries}
+    # Rows to retry after a transient failure, recorded only once final
+    retrying = can_retry(transient_retries)
+    deferred = []
+
+    def merge_row(row):
+        """(merged context, idempotency key) of a row"""
+        context = {**base_context, **(row.get("context") or {})}
+        return context, recipient_key(idempotency_key or self.request.id, row["recipient"])
+
+    def build(recipient, context):
+        html_message, plain_message = render_email(template_name, context, use_cache=False)
+        return build_email_message(recipient, subject, plain_message, html_message)
+
+    def render_error(recipient, error):
+        logger.error(f"Error rendering mail merge template for {recipient}: {str(error)}")
+        return mail_merge_error(recipient, subject, template_name, error)
+
+    if async_engine_enabled():
+        with AsyncSMTPEngine() as engine:
+            remaining = []
+            for batch in chunk_recipients(rows, getattr(settings, 'EMAIL_ASYNC_BATCH_SIZE', 500)):
+                # Only the rows that were not sent before are rendered
+                items = []
+                for row in batch:
+                    context, key = merge_row(row)
+                    recipient = row["recipient"]
+                    items.append((recipient, key, lambda r=recipient, c=context: build(r, c)))
+                for row, result in zip(batch, send_batch_once(engine, subject, items, render_error)):
+                    if result is None:
+                        remaining.append(row)
+                    elif retrying and is_transient_result(result):
+                        deferred.append(row)
+                    else:
+                        recorder.record(row["recipient"], result)
+
+        if engine.rate_limited is not None:
+            logger.warning(
+                f"Rate limited, deferring {len(deferred) + len(remaining)} mail merge recipients by "
+                f"{engine.rate_limited.wait:.1f}s"
+            )
+            raise self.retry(
+                args=[template_name, subject, deferred + remaining, base_context],
+                kwargs={**retry_kwargs, "resume": recorder.result(total=recorder.processed)},
+                countdown=engine.rate_limited.wait,
+                max_retries=None,
+            )
+
+        if deferred:
+            countdown = backoff_delay(transient_retries)
+            logger.warning(f"Retrying {len(deferred)} mail merge recipients after transient errors in {countdown:.1f}s")
+            raise self.retry(
+                args=[template_name, subject, deferred, base_context],
+                kwargs={
+                    **retry_kwargs,
+                    "transient_retries": transient_retries + 1,
+                    "resume": recorder.result(total=recorder.processed),
+                },
+                countdown=countdown,
+                max_retries=None,
+            )
+
+        result = recorder.result(total=total)
+        result["connection"] = engine.stats()
+        return result
+
+    with SMTPSession() as session:
+        for index, row in enumerate(rows):
+            recipient = row["recipient"]
+            try:
+                context, key = merge_row(row)
+                html_message, plain_message = render_email(template_name, context, use_cache=False)
+                result = send_with_session(session, recipient, subject, plain_message, html_message, idempotency_key=key)
+            except RateLimited as e:
+                logger.warning(
+                    f"Rate limited, deferring {len(deferred) + len(rows) - index} mail merge recipients "
+                    f"by {e.wait:.1f}s"
+                )
+                raise self.retry(
+                    args=[template_name, subject, deferred + rows[index:], base_context],
+                    kwargs={**retry_kwargs, "resume": recorder.result(total=recorder.processed)},
+                    countdown=e.wait,
+                    max_retries=None,
+                )
+            except Exception as e:
+                result = render_error(recipient, e)
+            if retrying and is_transient_result(result):
+                deferred.append(row)
+                continue
+            recorder.record(recipient, result)
+
+    if deferred:
+        countdown = backoff_delay(transient_retries)
+        logger.warning(f"Retrying {len(deferred)} mail merge recipients after transient errors in {countdown:.1f}s")
+        raise self.retry(
+            args=[template_name, subject, deferred, base_context],
+            kwargs={
+                **retry_kwargs,
+                "transient_retries": transient_retries + 1,
+                "resume": recorder.result(total=recorder.processed),
+            },
+            countdown=countdown,
+            max_retries=None,
+        )
+
+    result = recorder.result(total=total)
+    result["connection"] = session.stats()
+    return result
+
+
+def dispatch_mail_merge(template_name, subject, rows, base_context=None, chunk_size=None, compact=False,
+                        priority=None, idempotency_key=None):
+    """
+    Queue a mail merge as one task per chunk of rows
+
+    Args:
+        template_name (str): Name of the template to use
+        subject (str): Email subject
+        rows (list): Dicts with "recipient" and optional "context"
+        base_context (dict, optional): Context shared by every recipient
+        chunk_size (int, optional): Rows per task, defaults to
+            EMAIL_MAIL_MERGE_CHUNK_SIZE
+        compact (bool): Keep per-recipient outcomes in the delivery log
+            instead of the task result
+        priority (int, optional): Message priority of every queued task
+        idempotency_key (str, optional): Key of the whole send, see
+            send_mail_merge_task
+
+    Returns:
+        tuple: (AsyncResult of the task holding the final result,
+                GroupResult of the chunk tasks or None)
+    """
+    if not chunk_size:
+        chunk_size = getattr(settings, 'EMAIL_MAIL_MERGE_CHUNK_SIZE', 500)
+
+    if len(rows) <= chunk_size:
+        task = send_mail_merge_task.apply_async(
+            kwargs=dict(
+                template_name=template_name,
+                subject=subject,
+                rows=rows,
+                base_context=base_context,
+                compact=compact,
+                idempotency_key=idempotency_key,
+            ),
+            priority=priority,
+        )
+        return task, None
+
+    header = [
+        send_mail_merge_task.s(
+            template_name, subject, chunk, base_context, compact, idempotency_key=idempotency_key
+        ).set(priority=priority)
+        for chunk in chunk_recipients(group_by_domain(rows, address=lambda row: row['recipient']), chunk_size)
+    ]
+    task = chord(header)(merge_bulk_email_results_task.s().set(priority=priority))
+
+    group_result = task.parent
+    if group_result is not None:
+        group_result.save()
+    return task, group_result
+
+
+@shared_task(bind=True, base=TimedTask, name="send_email_with_attachment_task")
+def send_email_with_attachment_task(self, recipient_email, subject, message, attachment_path, filename=None, html_message=None,
+                                    idempotency_key=None, transient_retries=0):
     """
     Task to send an email with an attachment
 
+    Transient SMTP failures are retried like in send_email_task.
+
     Args:
         recipient_email (str): Email address of the recipient
         subject (str): Email subject
@@ -163,16 +1178,41 @@ def send_email_with_attachment_task(recipient_email, subject, message, attachmen
         attachment_path (str): Path to the attachment file
         filename (str, optional): Custom filename for the attachment
         html_message (str, optional): HTML content for the email
+        idempotency_key (str, optional): Key identifying this send, defaults
+            to the task id
+        transient_retries (int): Retries after transient failures so far
     """
     try:
-        if not os.path.exists(attachment_path):
-            return {
-                "status": "error",
-                "message": f"Attachment file not found: {attachment_path}",
-            }
+        message, html_message = check_out(message), check_out(html_message)
+    except BodyMissing as e:
+        return delivery_result(recipient_email, subject, 0, error=e)
+    except redis.RedisError as e:
+        countdown = backoff_delay(transient_retries)
+        logger.warning(f"Body store unavailable, retrying email to {recipient_email} in {countdown:.1f}s: {str(e)}")
+        raise self.retry(exc=e, countdown=countdown)
 
-        if not filename:
-            filename = os.path.basename(attachment_path)
+    if not os.path.exists(attachment_path):
+        return {
+            "status": "error",
+            "message": f"Attachment file not found: {attachment_path}",
+        }
+
+    if not filename:
+        filename = os.path.basename(attachment_path)
+
+    key = idempotency_key or self.request.id
+    try:
+        previous = claim(key)
+    except SendInProgress as e:
+        logger.warning(f"Email with attachment to {recipient_email} is already being sent, checking again in {e.wait}s")
+        raise self.retry(exc=e, countdown=e.wait, max_retries=None)
+    if previous is not None:
+        return previous
+
+    try:
+        # Reject oversized files before anything is read into memory
+        attachment_size = check_attachment_size(attachment_path)
+        connection = get_connection(fail_silently=False)
 
         # Create email message
         if html_message:
@@ -181,6 +1221,7 @@ def send_email_with_attachment_task(recipient_email, subject, message, attachmen
                 body=message,
                 from_email=settings.DEFAULT_FROM_EMAIL,
                 to=[recipient_email],
+                connection=connection,
             )
             email.attach_alternative(html_message, "text/html")
         else:
@@ -189,18 +1230,25 @@ def send_email_with_attachment_task(recipient_email, subject, message, attachmen
                 body=message,
                 from_email=settings.DEFAULT_FROM_EMAIL,
                 to=[recipient_email],
+                connection=connection,
             )
 
-        # Attach file
-        with open(attachment_path, 'rb') as attachment:
-            email.attach(filename, attachment.read())
+        throttle()
 
-        # Send email
-        email_sent = email.send()
+        if supports_streaming(connection):
+            # Only one chunk and its base64 encoding are in memory at a time
+            check_memory_ceiling(getattr(settings, 'EMAIL_ATTACHMENT_CHUNK_SIZE', 1024 * 1024) * 3)
+            email_sent = stream_email_with_attachment(connection, email, attachment_path, filename)
+        else:
+            # The file, its base64 encoding and the serialized message
+            check_memory_ceiling(attachment_size * 3)
+            with stage('attachment_read'), open(attachment_path, 'rb') as attachment:
+                email.attach(filename, attachment.read())
+            email_sent = email.send()
 
         if email_sent:
             logger.info(f"Email with attachment sent successfully to {recipient_email}")
-            return {
+            result = {
                 "status": "success",
                 "message": f"Email with attachment sent to {recipient_email}",
                 "details": {
@@ -211,19 +1259,50 @@ def send_email_with_attachment_task(recipient_email, subject, message, attachmen
             }
         else:
             logger.error(f"Failed to send email with attachment to {recipient_email}")
-            return {
+            result = {
                 "status": "failed",
                 "message": f"Failed to send email with attachment",
             }
 
+    except RateLimited as e:
+        release(key)
+        logger.warning(f"Rate limited, deferring email with attachment to {recipient_email} by {e.wait:.1f}s")
+        raise self.retry(exc=e, countdown=e.wait, max_retries=None)
+
+    except AttachmentTooLarge as e:
+        logger.error(f"Rejected email with attachment to {recipient_email}: {str(e)}")
+        result = {
+            "status": "rejected",
+            "message": f"Attachment rejected: {str(e)}",
+            "details": {
+                "to": recipient_email,
+                "subject": subject,
+                "attachment": filename or attachment_path,
+            }
+        }
+
     except Exception as e:
+        if is_transient(e) and can_retry(transient_retries):
+            release(key)
+            countdown = backoff_delay(transient_retries)
+            logger.warning(f"Transient error sending email with attachment to {recipient_email}, retrying in {countdown:.1f}s")
+            raise self.retry(
+                exc=e,
+                kwargs={**self.request.kwargs, "transient_retries": transient_retries + 1},
+                countdown=countdown,
+                max_retries=None,
+            )
         logger.error(f"Error sending email with attachment to {recipient_email}: {str(e)}")
-        return {
+        result = {
             "status": "error",
             "message": f"Error sending email with attachment: {str(e)}",
+            "error_type": classify_error(e),
             "details": {
                 "to": recipient_email,
                 "subject": subject,
                 "attachment": filename or attachment_path,
             }
         }
+
+    finish((key, result))
+    return result
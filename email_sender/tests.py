@@ -1,3 +1,1938 @@
-from django.test import TestCase
+import asyncio
+import base64
+import email
+import json
+import logging
+import os
+import shutil
+import smtplib
+import socket
+import sys
+import tempfile
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import aiosmtplib
+from asgiref.sync import async_to_sync
+import fakeredis
+import redis
+from celery import Celery
+from celery.exceptions import Retry
+from celery.backends.redis import RedisBackend
+from celery.result import AsyncResult, GroupResult
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail import EmailMessage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from kombu import Connection, pools
+from kombu.transport.redis import Channel as RedisChannel
+from rest_framework import serializers
+from rest_framework.authentication import BasicAuthentication
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.throttling import AnonRateThrottle
+from django_celery_results.backends import DatabaseBackend
+from django_celery_results.models import TaskResult
+from django.db.models import QuerySet
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import async_redis, metrics, publish, rendering
+from .async_engine import AsyncSMTPEngine
+from .attachments import stream_email_with_attachment
+from .backends import EmailBackend as SMTPEmailBackend
+from .bodies import CLAIM_CHECK, check_in, check_out, get_claim_check, reset_claim_check
+from .connection import SMTPSession
+from .delivery_log import DeliveryRecorder, delivery_log_page
+from .events import poll_events, status_channel, status_event_stream
+from .idempotency import PENDING, IdempotencyStore, SendInProgress, claim, claim_many, reset_store
+from .retry import PERMANENT, TRANSIENT, backoff_delay, can_retry, classify_error
+from .rate_limit import (
+    MemoryRateLimiter,
+    RateLimited,
+    RedisRateLimiter,
+    max_tokens,
+    reset_rate_limiter,
+    throttle,
+)
+from .models import DeliveryLog, OutboxEmail, RecipientChunk
+from .outbox import claim_batch, enqueue_email
+from .planner import group_by_domain, multi_rcpt_enabled, plan_envelopes
+from .results import audit_task_result, result_summary
+from .status import task_statuses, task_status
+from .validation import BLANK, INVALID_EMAIL, NOT_A_STRING, normalize_email, validate_recipients
+from .uploads import RecipientFileError, load_recipient_chunk, store_recipient_file
+from .views import AsyncSendEmailView, SendEmailView, batch_to_queue
+from .rendering import LRUCache, TemplateCache, render_email
+from config.celery import (
+    IO_POOL_PREFETCH_MULTIPLIER,
+    TASK_PRIORITIES,
+    app,
+    configure_worker_pool,
+    configure_worker_startup,
+)
+from .tasks import (
+    chunk_recipients,
+    dispatch_bulk_email,
+    dispatch_mail_merge,
+    dispatch_outbox_task,
+    merge_bulk_email_results_task,
+    merge_bulk_results,
+    purge_body_store_task,
+    purge_recipient_uploads_task,
+    send_bulk_email_task,
+    send_email_task,
+    send_email_with_attachment_task,
+    send_mail_merge_task,
+)
+
+NO_BUDGETS = {
+    'EMAIL_RATE_LIMIT_PER_SECOND': None,
+    'EMAIL_RATE_LIMIT_PER_MINUTE': None,
+    'EMAIL_RATE_LIMIT_PER_DAY': None,
+}
+
+# Sends go to ScriptedEmailBackend and nothing needs Redis
+OFFLINE = {
+    'EMAIL_BACKEND': 'email_sender.tests.ScriptedEmailBackend',
+    'EMAIL_IDEMPOTENCY': False,
+    'EMAIL_METRICS': False,
+    'EMAIL_STATUS_EVENTS': False,
+    'EMAIL_BODY_STORE': '',
+    **NO_BUDGETS,
+}
+
+
+class ScriptedEmailBackend(LocmemEmailBackend):
+    """
+    Locmem backend that plays an SMTP server: the next DISCONNECTS sends
+    find the session dropped, and addresses in REFUSED are refused with
+    their reply code, the way smtplib reports both
+    """
+    DISCONNECTS = 0
+    REFUSED = {}
+    opened = 0
+
+    def open(self):
+        type(self).opened += 1
+        return True
+
+    def send_messages(self, messages):
+        if ScriptedEmailBackend.DISCONNECTS:
+            ScriptedEmailBackend.DISCONNECTS -= 1
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        for message in messages:
+            refused = {
+                address: (self.REFUSED[address], b"Refused")
+                for address in message.recipients() if address in self.REFUSED
+            }
+            if refused:
+                raise smtplib.SMTPRecipientsRefused(refused)
+        return super().send_messages(messages)
+
+
+class RelayEmailBackend(SMTPEmailBackend):
+    """
+    The project's SMTP backend on a relay that takes multi-recipient
+    messages, refusing the addresses in REFUSED with their reply code
+    """
+    REFUSED = {}
+    envelopes = []
+
+    def open(self):
+        if self.connection:
+            return False
+        self.connection = mock.Mock(sendmail=self.sendmail)
+        return True
+
+    def close(self):
+        self.connection = None
+
+    def sendmail(self, from_email, recipients, message):
+        type(self).envelopes.append(recipients)
+        refused = {address: (self.REFUSED[address], b"Refused") for address in recipients if address in self.REFUSED}
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+
+@override_settings(**OFFLINE)
+class OfflineTestCase(TestCase):
+    """Sends to ScriptedEmailBackend, reset for every test"""
+
+    def setUp(self):
+        super().setUp()
+        for name, value in (('DISCONNECTS', 0), ('REFUSED', {}), ('opened', 0)):
+            patcher = mock.patch.object(ScriptedEmailBackend, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        reset_rate_limiter()
+        self.addCleanup(reset_rate_limiter)
+
+    def run_tasks_eagerly(self):
+        """Run queued tasks, chords included, inline for the rest of the test"""
+        previous = {name: app.conf[name] for name in ('task_always_eager', 'task_eager_propagates')}
+        app.conf.update(task_always_eager=True, task_eager_propagates=True)
+        self.addCleanup(app.conf.update, previous)
+
+
+class FakeRedisTestCase(SimpleTestCase):
+    """Points every redis.Redis.from_url() client at one in-memory server"""
+
+    def setUp(self):
+        super().setUp()
+        self.server = fakeredis.FakeServer()
+        patcher = mock.patch(
+            'redis.Redis.from_url',
+            side_effect=lambda url, **kwargs: fakeredis.FakeRedis(server=self.server),
+        )
+        self.from_url = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.redis = fakeredis.FakeRedis(server=self.server)
+
+
+class MemoryRateLimiterTests(SimpleTestCase):
+
+    def test_takes_tokens_until_the_bucket_is_empty(self):
+        limiter = MemoryRateLimiter([('second', 3, 1)])
+        self.assertEqual([limiter.acquire() for _ in range(3)], [0, 0, 0])
+        wait = limiter.acquire()
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 1 / 3)
+
+    def test_waits_for_the_tightest_bucket(self):
+        limiter = MemoryRateLimiter([('second', 10, 1), ('minute', 2, 60)])
+        self.assertEqual(limiter.acquire(2), 0)
+        self.assertAlmostEqual(limiter.acquire(), 30, delta=0.1)
+
+    def test_refuses_more_tokens_than_the_smallest_bucket_holds(self):
+        limiter = MemoryRateLimiter([('second', 10, 1), ('minute', 5, 60)])
+        with self.assertRaises(ValueError):
+            limiter.acquire(6)
+        # Nothing was taken by the refused call
+        self.assertEqual(limiter.acquire(5), 0)
+
+
+class RedisRateLimiterTests(FakeRedisTestCase):
+
+    def test_script_takes_tokens_until_the_bucket_is_empty(self):
+        limiter = RedisRateLimiter([('second', 3, 1)], 'redis://localhost:6379/0', prefix='test-rate')
+        self.assertEqual([limiter.acquire() for _ in range(3)], [0, 0, 0])
+        wait = limiter.acquire()
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 1 / 3)
+        self.assertTrue(self.redis.exists('test-rate:second'))
+        self.assertGreater(self.redis.pttl('test-rate:second'), 0)
+
+    def test_budget_is_shared_by_every_limiter(self):
+        buckets = [('minute', 4, 60)]
+        first = RedisRateLimiter(buckets, 'redis://localhost:6379/0')
+        second = RedisRateLimiter(buckets, 'redis://localhost:6379/0')
+        self.assertEqual(first.acquire(3), 0)
+        self.assertGreater(second.acquire(2), 0)
+        self.assertEqual(second.acquire(1), 0)
+
+    def test_script_waits_for_the_tightest_bucket(self):
+        limiter = RedisRateLimiter([('second', 10, 1), ('minute', 2, 60)], 'redis://localhost:6379/0')
+        self.assertEqual(limiter.acquire(2), 0)
+        self.assertAlmostEqual(limiter.acquire(), 30, delta=0.1)
+
+    def test_refuses_more_tokens_than_the_smallest_bucket_holds(self):
+        limiter = RedisRateLimiter([('second', 10, 1)], 'redis://localhost:6379/0', prefix='test-rate')
+        with self.assertRaises(ValueError):
+            limiter.acquire(11)
+        self.assertFalse(self.redis.exists('test-rate:second'))
+
+    def test_client_times_out(self):
+        RedisRateLimiter([('second', 10, 1)], 'redis://localhost:6379/0')
+        kwargs = self.from_url.call_args.kwargs
+        self.assertTrue(kwargs['socket_timeout'])
+        self.assertTrue(kwargs['socket_connect_timeout'])
+
+
+@override_settings(EMAIL_RATE_LIMIT_BACKEND='memory', **NO_BUDGETS)
+class ThrottleTests(SimpleTestCase):
+
+    def setUp(self):
+        reset_rate_limiter()
+        self.addCleanup(reset_rate_limiter)
+
+    def test_no_budget_never_waits(self):
+        for _ in range(100):
+            throttle()
+
+    @override_settings(EMAIL_RATE_LIMIT_PER_MINUTE=2)
+    def test_raises_when_the_wait_is_too_long(self):
+        throttle(2)
+        with self.assertRaises(RateLimited) as raised:
+            throttle(max_wait=0)
+        self.assertAlmostEqual(raised.exception.wait, 30, delta=0.1)
+
+    @override_settings(EMAIL_RATE_LIMIT_PER_SECOND=100)
+    def test_blocks_for_short_waits(self):
+        throttle(100)
+        with mock.patch('email_sender.rate_limit.time.sleep') as sleep:
+            throttle(max_wait=5)
+        sleep.assert_called()
+        self.assertLessEqual(sleep.call_args.args[0], 0.01)
+
+    @override_settings(EMAIL_RATE_LIMIT_PER_SECOND=1, EMAIL_RATE_LIMIT_BACKEND='redis')
+    def test_sends_anyway_without_redis(self):
+        with mock.patch.object(RedisRateLimiter, 'acquire', side_effect=redis.TimeoutError):
+            throttle()
+
+    @override_settings(EMAIL_RATE_LIMIT_PER_SECOND=10, EMAIL_RATE_LIMIT_PER_DAY=500)
+    def test_max_tokens_is_the_smallest_budget(self):
+        self.assertEqual(max_tokens(), 10)
+
+    def test_max_tokens_without_budget(self):
+        self.assertIsNone(max_tokens())
+
+
+class SMTPSessionTests(OfflineTestCase):
+
+    def message(self, to='a@example.com'):
+        return EmailMessage("Subject", "Message", 'from@example.com', [to])
+
+    def test_opens_one_connection_for_every_message(self):
+        with SMTPSession() as session:
+            for to in ('a@example.com', 'b@example.com', 'c@example.com'):
+                self.assertEqual(session.send(self.message(to)), 1)
+        self.assertEqual(ScriptedEmailBackend.opened, 1)
+        self.assertEqual(session.stats()['messages_per_connection'], 3)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_reconnects_when_the_server_drops_the_session(self):
+        ScriptedEmailBackend.DISCONNECTS = 1
+        with SMTPSession() as session:
+            self.assertEqual(session.send(self.message()), 1)
+        self.assertEqual(session.reconnects, 1)
+        self.assertEqual(ScriptedEmailBackend.opened, 2)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_gives_up_after_max_reconnects(self):
+        ScriptedEmailBackend.DISCONNECTS = 3
+        with SMTPSession(max_reconnects=2) as session:
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                session.send(self.message())
+        self.assertEqual(session.reconnects, 2)
+        self.assertEqual(mail.outbox, [])
+
+    def test_bulk_task_sends_over_one_session(self):
+        recipients = [f"user{i}@example.com" for i in range(5)]
+        result = send_bulk_email_task.run(recipients, "Subject", "Message")
+        self.assertEqual(result['summary'], {'total': 5, 'success': 5, 'failed': 0})
+        self.assertEqual(result['connection']['connections_opened'], 1)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), recipients)
+
+
+class BulkFanOutTests(OfflineTestCase):
+
+    def chunk_result(self, success, failed, **extra):
+        return {
+            'status': 'completed',
+            'summary': {'total': success + failed, 'success': success, 'failed': failed},
+            'connection': {'connections_opened': 1, 'reconnects': 0, 'messages_sent': success},
+            **extra,
+        }
+
+    def test_chunk_recipients(self):
+        self.assertEqual(chunk_recipients(list(range(7)), 3), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(chunk_recipients([], 3), [])
+
+    def test_merge_adds_up_the_chunks(self):
+        merged = merge_bulk_results([
+            self.chunk_result(2, 0, results=[{'status': 'success'}] * 2),
+            self.chunk_result(1, 1, results=[{'status': 'success'}, {'status': 'error'}]),
+        ])
+        self.assertEqual(merged['summary'], {'total': 4, 'success': 3, 'failed': 1})
+        self.assertEqual(merged['chunks'], 2)
+        self.assertEqual(len(merged['results']), 4)
+        self.assertEqual(merged['connection']['connections_opened'], 2)
+        self.assertEqual(merged['connection']['messages_per_connection'], 1.5)
+
+    def test_merge_of_compact_chunks_points_at_their_delivery_logs(self):
+        failure = {'to': 'b@example.com', 'status': 'error'}
+        merged = merge_bulk_email_results_task([
+            self.chunk_result(2, 0, failures=[], delivery_log={'task_id': 'one', 'entries': 2}),
+            self.chunk_result(0, 1, failures=[failure], delivery_log={'task_id': 'two', 'entries': 1}),
+        ])
+        self.assertEqual(merged['failures'], [failure])
+        self.assertEqual(merged['delivery_log'], {'task_ids': ['one', 'two']})
+        self.assertNotIn('results', merged)
+
+    def test_chunks_run_as_a_chord(self):
+        self.run_tasks_eagerly()
+        recipients = [f"user{i}@{domain}" for i in range(3) for domain in ('one.com', 'two.com')]
+        task, group_result = dispatch_bulk_email(recipients, "Subject", "Message", chunk_size=3)
+        result = task.get()
+        self.assertEqual(result['summary'], {'total': 6, 'success': 6, 'failed': 0})
+        self.assertEqual(result['chunks'], 2)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), sorted(recipients))
+        # Chunks hold whole domains
+        domains = [{r['details']['to'].split('@')[1] for r in result['results'][i:i + 3]} for i in (0, 3)]
+        self.assertEqual(domains, [{'one.com'}, {'two.com'}])
+
+    def test_small_lists_are_sent_by_one_task(self):
+        self.run_tasks_eagerly()
+        task, group_result = dispatch_bulk_email(['a@example.com'], "Subject", "Message", chunk_size=3)
+        self.assertIsNone(group_result)
+        self.assertEqual(task.get()['summary']['success'], 1)
+
+
+class TemplateDirMixin:
+    """Loads templates from a temporary directory through fresh caches"""
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        settings = override_settings(TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'DIRS': [self.dir],
+        }])
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.cache = TemplateCache(check_interval=0)
+        for name, value in (('template_cache', self.cache), ('rendered_cache', LRUCache(maxsize=16))):
+            patcher = mock.patch.object(rendering, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.mtime = 1_000_000_000
+
+    def write(self, name, source):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(source)
+        # Each version gets a later mtime, however fast the test runs
+        self.mtime += 10
+        os.utime(path, (self.mtime, self.mtime))
+        return path
+
+
+class TemplateCacheTests(TemplateDirMixin, SimpleTestCase):
+
+    def test_compiles_each_template_once(self):
+        path = self.write('email.html', "<p>Hi {{ name }}</p>")
+        with mock.patch('email_sender.rendering.get_template', wraps=rendering.get_template) as get:
+            template, version = self.cache.get('email.html')
+            self.assertIs(self.cache.get('email.html')[0], template)
+        get.assert_called_once()
+        self.assertEqual(template.origin.name, path)
+        self.assertEqual(self.cache.stats(), {'size': 1, 'hits': 1, 'misses': 1, 'reloads': 0})
+
+    def test_recompiles_an_edited_template(self):
+        self.write('email.html', "<p>Hi {{ name }}</p>")
+        self.assertEqual(render_email('email.html', {'name': "Ann"})[0], "<p>Hi Ann</p>")
+        self.write('email.html', "<p>Hello {{ name }}</p>")
+        self.assertEqual(render_email('email.html', {'name': "Ann"}), ("<p>Hello Ann</p>", "Hello Ann"))
+        self.assertEqual(self.cache.reloads, 1)
+
+    def test_waits_for_the_check_interval(self):
+        self.cache.check_interval = 60
+        self.write('email.html', "one")
+        self.cache.get('email.html')
+        self.write('email.html', "two")
+        self.assertEqual(self.cache.get('email.html')[0].render({}), "one")
+
+    def test_recompiles_when_a_parent_template_changes(self):
+        self.write('base.html', "<h1>Old</h1>{% block body %}{% endblock %}")
+        self.write('email.html', "{% extends 'base.html' %}{% block body %}Hi {{ name }}{% endblock %}")
+        self.assertEqual(render_email('email.html', {'name': "Ann"})[0], "<h1>Old</h1>Hi Ann")
+        self.write('base.html', "<h1>New</h1>{% block body %}{% endblock %}")
+        self.assertEqual(render_email('email.html', {'name': "Ann"})[0], "<h1>New</h1>Hi Ann")
+
+    def test_recompiles_when_an_included_template_changes(self):
+        self.write('footer.html', "Old footer")
+        self.write('email.html', "Hi {% include 'footer.html' %}")
+        self.assertEqual(render_email('email.html')[0], "Hi Old footer")
+        self.write('footer.html', "New footer")
+        self.assertEqual(render_email('email.html')[0], "Hi New footer")
+
+    def test_rendered_output_is_cached_per_context(self):
+        self.write('email.html', "Hi {{ name }}")
+        with mock.patch('email_sender.rendering._render', wraps=rendering._render) as render:
+            render_email('email.html', {'name': "Ann"})
+            render_email('email.html', {'name': "Ann"})
+            render_email('email.html', {'name': "Bob"})
+            render_email('email.html', {'name': "Bob"}, use_cache=False)
+        self.assertEqual(render.call_count, 3)
+
+
+@override_settings(EMAIL_METRICS=True)
+class MetricsTestCase(FakeRedisTestCase):
+    """Records metrics into a fresh in-memory Redis"""
+
+    def setUp(self):
+        super().setUp()
+        for name, value in (('_client', None), ('_counts', {})):
+            patcher = mock.patch.object(metrics, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class CacheCounterTests(MetricsTestCase):
+
+    def test_counters_of_every_worker_are_exported(self):
+        metrics.count('email_template_cache_total', {'cache': 'templates', 'result': 'hit'}, 2)
+        metrics.count('email_template_cache_total', {'cache': 'rendered', 'result': 'miss'})
+        metrics.record_timings('send_template_email_task', {'total': 0.1})
+        # Another worker
+        metrics.count('email_template_cache_total', {'cache': 'templates', 'result': 'hit'})
+        metrics.record_timings('send_template_email_task', {'total': 0.1})
+
+        text = metrics.metrics_text()
+        self.assertIn('# TYPE email_template_cache_total counter', text)
+        self.assertIn('email_template_cache_total{cache="templates",result="hit"} 3', text)
+        self.assertIn('email_template_cache_total{cache="rendered",result="miss"} 1', text)
+
+    def test_counts_are_kept_when_redis_is_down(self):
+        metrics.count('email_template_cache_total', {'cache': 'templates', 'result': 'miss'})
+        with mock.patch.object(fakeredis.FakeRedis, 'pipeline', side_effect=redis.ConnectionError):
+            metrics.record_timings('send_template_email_task', {'total': 0.1})
+        metrics.record_timings('send_template_email_task', {'total': 0.1})
+        self.assertIn('email_template_cache_total{cache="templates",result="miss"} 1', metrics.metrics_text())
+
+
+class MailMergeTests(TemplateDirMixin, OfflineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write('merge.html', "<p>{{ greeting }} {{ name }}</p>")
+        self.rows = [
+            {'recipient': 'ann@example.com', 'context': {'name': "Ann"}},
+            {'recipient': 'bob@example.com', 'context': {'name': "Bob", 'greeting': "Hey"}},
+            {'recipient': 'cy@example.com'},
+        ]
+
+    def test_renders_each_row_with_its_own_context(self):
+        result = send_mail_merge_task.run('merge.html', "Subject", self.rows, {'greeting': "Hi", 'name': "you"})
+        self.assertEqual(result['summary'], {'total': 3, 'success': 3, 'failed': 0})
+        self.assertEqual(result['connection']['connections_opened'], 1)
+        bodies = {m.to[0]: (m.body, m.alternatives[0][0]) for m in mail.outbox}
+        self.assertEqual(bodies, {
+            'ann@example.com': ("Hi Ann", "<p>Hi Ann</p>"),
+            'bob@example.com': ("Hey Bob", "<p>Hey Bob</p>"),
+            'cy@example.com': ("Hi you", "<p>Hi you</p>"),
+        })
+
+    def test_template_is_compiled_once_per_task(self):
+        with mock.patch('email_sender.rendering.get_template', wraps=rendering.get_template) as get:
+            send_mail_merge_task.run('merge.html', "Subject", self.rows)
+        get.assert_called_once()
+
+    def test_a_row_that_fails_to_render_fails_alone(self):
+        class Broken:
+            @property
+            def name(self):
+                raise ValueError("no name")
+
+        rows = [
+            {'recipient': 'ann@example.com', 'context': {'user': {'name': "Ann"}}},
+            {'recipient': 'bob@example.com', 'context': {'user': Broken()}},
+        ]
+        self.write('merge.html', "Hi {{ user.name }}")
+        result = send_mail_merge_task.run('merge.html', "Subject", rows)
+        self.assertEqual(result['summary'], {'total': 2, 'success': 1, 'failed': 1})
+        failure = result['results'][1]
+        self.assertEqual((failure['status'], failure['error_type']), ('error', 'permanent'))
+        self.assertEqual(failure['details']['template'], 'merge.html')
+        self.assertEqual([m.to[0] for m in mail.outbox], ['ann@example.com'])
+
+    def test_chunks_run_as_a_chord(self):
+        self.run_tasks_eagerly()
+        task, group_result = dispatch_mail_merge('merge.html', "Subject", self.rows, {'greeting': "Hi"}, chunk_size=2)
+        result = task.get()
+        self.assertEqual(result['summary'], {'total': 3, 'success': 3, 'failed': 0})
+        self.assertEqual(result['chunks'], 2)
+        self.assertEqual(len(mail.outbox), 3)
+
+
+class RecordingSMTP:
+    """Stands in for smtplib.SMTP and keeps the bytes of the DATA command"""
+
+    def __init__(self, data_reply=250):
+        self.data_reply = data_reply
+        self.sent = b''
+        self.envelope = []
+        self.resets = 0
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def mail(self, sender):
+        self.envelope.append(sender)
+        return 250, b'OK'
+
+    def rcpt(self, recipient):
+        self.envelope.append(recipient)
+        return 250, b'OK'
+
+    def docmd(self, command):
+        return 354, b'Go ahead'
+
+    def send(self, data):
+        self.sent += data
+
+    def getreply(self):
+        return self.data_reply, b'Done'
+
+    def rset(self):
+        self.resets += 1
+
+
+@override_settings(EMAIL_METRICS=False)
+class StreamedAttachmentTests(SimpleTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.smtp = RecordingSMTP()
+        self.backend = SMTPEmailBackend()
+        self.backend.connection = self.smtp
+
+    def attachment(self, data):
+        path = os.path.join(self.dir, 'report.bin')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def stream(self, data, body="Report attached", chunk_size=1024):
+        message = EmailMessage("Report", body, 'from@example.com', ['to@example.com'])
+        with override_settings(EMAIL_ATTACHMENT_CHUNK_SIZE=chunk_size):
+            sent = stream_email_with_attachment(self.backend, message, self.attachment(data), 'report.bin')
+        self.assertEqual(sent, 1)
+        self.assertTrue(self.smtp.sent.endswith(b'\r\n.\r\n'))
+        # Undo the dot-stuffing the way the receiving server does
+        wire = self.smtp.sent[:-3].replace(b'\r\n..', b'\r\n.')
+        return email.message_from_bytes(wire)
+
+    def test_attachment_arrives_byte_for_byte(self):
+        data = os.urandom(10_000)
+        # A chunk size that is not a multiple of the 57 bytes per base64 line
+        parsed = self.stream(data, chunk_size=1000)
+        body, attachment = parsed.get_payload()
+        self.assertEqual(attachment.get_filename(), 'report.bin')
+        self.assertEqual(attachment.get_payload(decode=True), data)
+        self.assertEqual(body.get_payload(), "Report attached")
+        self.assertEqual(self.smtp.envelope, ['from@example.com', 'to@example.com'])
+
+    def test_base64_lines_match_a_one_shot_encode(self):
+        data = os.urandom(5_000)
+        self.stream(data, chunk_size=100)
+        encoded = base64.encodebytes(data).replace(b'\n', b'\r\n')
+        self.assertIn(encoded, self.smtp.sent)
+
+    def test_empty_attachment(self):
+        parsed = self.stream(b'')
+        self.assertEqual(parsed.get_payload()[1].get_payload(decode=True), b'')
+
+    def test_lines_starting_with_a_period_are_dot_stuffed(self):
+        parsed = self.stream(b'data', body="Totals:\n.hidden\n.\nend")
+        self.assertIn(b'\r\n..hidden\r\n..\r\nend', self.smtp.sent)
+        self.assertEqual(parsed.get_payload()[0].get_payload().splitlines(), ["Totals:", ".hidden", ".", "end"])
+
+    def test_refused_data_resets_the_session(self):
+        self.smtp.data_reply = 554
+        message = EmailMessage("Report", "Body", 'from@example.com', ['to@example.com'])
+        with self.assertRaises(smtplib.SMTPDataError):
+            stream_email_with_attachment(self.backend, message, self.attachment(b'data'), 'report.bin')
+        self.assertEqual(self.smtp.resets, 1)
+
+
+class AttachmentTaskTests(OfflineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+        with open(self.path, 'wb') as f:
+            f.write(b'x' * 2048)
+
+    def test_attaches_the_file(self):
+        result = send_email_with_attachment_task.run('to@example.com', "Report", "Body", self.path, 'report.txt')
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(mail.outbox[0].attachments[0][:2], ('report.txt', 'x' * 2048))
+
+    @override_settings(EMAIL_ATTACHMENT_MAX_SIZE=1024)
+    def test_rejects_files_above_the_maximum_size(self):
+        result = send_email_with_attachment_task.run('to@example.com', "Report", "Body", self.path)
+        self.assertEqual(result['status'], 'rejected')
+        self.assertEqual(mail.outbox, [])
+
+
+class DatabaseStatusTests(TestCase):
+
+    def setUp(self):
+        self.backend = DatabaseBackend(app=app)
+        patcher = mock.patch('email_sender.status.current_app', mock.Mock(backend=self.backend))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backend.store_result('sent', {'status': 'success'}, 'SUCCESS')
+        self.backend.store_result('failed', ValueError("boom"), 'FAILURE')
+
+    def test_reads_many_tasks_in_one_query(self):
+        # One query for the task rows and one for groups among the rest
+        with self.assertNumQueries(2):
+            statuses = task_statuses(['sent', 'failed', 'unknown', 'sent'])
+        self.assertEqual(statuses, {
+            'sent': {'status': 'SUCCESS', 'result': {'status': 'success'}},
+            'failed': {'status': 'FAILURE', 'error': "boom"},
+            'unknown': {'status': 'PENDING'},
+        })
+
+    def test_states_only(self):
+        statuses = task_statuses(['sent', 'failed'], include_results=False)
+        self.assertEqual(statuses, {'sent': {'status': 'SUCCESS'}, 'failed': {'status': 'FAILURE'}})
+
+    def test_groups_report_their_progress(self):
+        summary = {'total': 2, 'success': 2, 'failed': 0}
+        self.backend.store_result('chunk', {'status': 'completed', 'summary': summary, 'results': []}, 'SUCCESS')
+        group = GroupResult('campaign', [AsyncResult('chunk', app=app), AsyncResult('queued', app=app)], app=app)
+        self.backend.save_group('campaign', group)
+        status = task_statuses(['campaign'])['campaign']
+        self.assertEqual((status['status'], status['summary']), ('PROGRESS', summary))
+        self.assertEqual(status['progress'], {'chunks_total': 2, 'chunks_completed': 1, 'chunks_failed': 0})
+
+
+class RedisStatusTests(TestCase):
+
+    def setUp(self):
+        self.backend = RedisBackend(app=app, url='redis://localhost:6379/0')
+        self.backend.client = fakeredis.FakeStrictRedis()
+        for target in ('email_sender.status.current_app', 'email_sender.results.current_app'):
+            patcher = mock.patch(target, mock.Mock(backend=self.backend))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.backend.store_result('sent', {'status': 'success'}, 'SUCCESS')
+        self.backend.store_result('failed', ValueError("boom"), 'FAILURE')
+
+    def test_reads_many_tasks_with_one_mget(self):
+        with mock.patch.object(self.backend, 'mget', wraps=self.backend.mget) as mget, self.assertNumQueries(0):
+            statuses = task_statuses(['sent', 'failed'])
+        mget.assert_called_once()
+        self.assertEqual(statuses, {
+            'sent': {'status': 'SUCCESS', 'result': {'status': 'success'}},
+            'failed': {'status': 'FAILURE', 'error': "boom"},
+        })
+
+    def test_expired_results_are_read_from_the_audit_rows(self):
+        TaskResult.objects.store_result(
+            'application/json', 'utf-8', 'expired', json.dumps({'status': 'success'}), 'SUCCESS'
+        )
+        statuses = task_statuses(['sent', 'expired', 'unknown'])
+        self.assertEqual(statuses['expired'], {'status': 'SUCCESS', 'result': {'status': 'success'}})
+        self.assertEqual(statuses['unknown'], {'status': 'PENDING'})
+
+
+@override_settings(EMAIL_STATUS_STREAM_KEEPALIVE=0.01, EMAIL_STATUS_POLL_INTERVAL=0)
+class StatusEventStreamTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        patcher = mock.patch(
+            'email_sender.events.aioredis.Redis.from_url',
+            side_effect=lambda url: fakeredis.aioredis.FakeRedis(server=self.server),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.statuses = []
+
+    def get_status(self, task_id):
+        return {'task_id': task_id, **self.statuses.pop(0)}
+
+    def publish(self, state):
+        client = fakeredis.FakeRedis(server=self.server)
+        client.publish(status_channel('task'), json.dumps({'task_id': 'task', 'status': state}))
+
+    async def test_ready_task_sends_its_status_and_closes(self):
+        self.statuses = [{'status': 'SUCCESS', 'result': {'status': 'success'}}]
+        events = [event async for event in status_event_stream('task', self.get_status)]
+        self.assertEqual(events, [
+            'event: status\ndata: {"task_id": "task", "status": "SUCCESS", "result": {"status": "success"}}\n\n',
+        ])
+
+    async def test_sends_each_published_transition(self):
+        self.statuses = [{'status': 'PENDING'}, {'status': 'SUCCESS', 'result': {'status': 'success'}}]
+        stream = status_event_stream('task', self.get_status)
+        self.assertIn('"PENDING"', await anext(stream))
+        self.publish('STARTED')
+        self.publish('SUCCESS')
+        events = [event async for event in stream if not event.startswith(':')]
+        self.assertEqual(len(events), 2)
+        self.assertIn('"status": "STARTED"', events[0])
+        # The final event carries the stored result
+        self.assertIn('"result": {"status": "success"}', events[1])
+
+    @override_settings(EMAIL_STATUS_STREAM_MAX_DURATION=0.3)
+    async def test_keepalives_until_the_stream_times_out(self):
+        self.statuses = [{'status': 'PENDING'}]
+        events = [event async for event in status_event_stream('task', self.get_status)]
+        self.assertIn(': keepalive\n\n', events)
+        self.assertEqual(events[-1], 'event: timeout\ndata: {"task_id": "task"}\n\n')
+
+    async def test_groups_have_their_progress_polled(self):
+        progress = {'chunks_total': 2, 'chunks_completed': 0, 'chunks_failed': 0}
+        self.statuses = [
+            {'status': 'PROGRESS', 'progress': progress},
+            {'status': 'PROGRESS', 'progress': progress},
+            {'status': 'PROGRESS', 'progress': {**progress, 'chunks_completed': 1}},
+            {'status': 'SUCCESS', 'progress': {**progress, 'chunks_completed': 2}},
+        ]
+        events = [event async for event in status_event_stream('task', self.get_status)]
+        self.assertEqual(len(events), 4)
+        self.assertEqual(events[1], ': keepalive\n\n')
+        self.assertIn('"SUCCESS"', events[3])
+        self.assertEqual(self.statuses, [])
+
+    def test_wsgi_requests_are_told_to_poll(self):
+        with mock.patch('email_sender.views.task_status', return_value={'task_id': 'task', 'status': 'PENDING'}):
+            response = self.client.get('/api/email-status/task/stream/')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response.content.decode(), poll_events({'task_id': 'task', 'status': 'PENDING'}))
+        self.assertTrue(response.content.decode().endswith('event: poll\ndata: {"interval": 0}\n\n'))
+
+
+class DeliveryRecorderTests(TestCase):
+
+    def success(self, recipient):
+        return {'status': 'success', 'message': f"Email sent to {recipient}"}
+
+    def failure(self, recipient):
+        return {'status': 'error', 'message': "Mailbox unavailable", 'error_type': 'permanent'}
+
+    def test_keeps_every_result_by_default(self):
+        recorder = DeliveryRecorder(task_id='bulk')
+        recorder.record('a@example.com', self.success('a@example.com'))
+        recorder.record('b@example.com', self.failure('b@example.com'))
+        result = recorder.result(total=2)
+        self.assertEqual(result['summary'], {'total': 2, 'success': 1, 'failed': 1})
+        self.assertEqual(len(result['results']), 2)
+        self.assertFalse(DeliveryLog.objects.exists())
+
+    def test_compact_mode_writes_the_log_in_batches(self):
+        recorder = DeliveryRecorder(task_id='bulk', compact=True, batch_size=2)
+        with self.assertNumQueries(1):
+            for recipient in ('a@example.com', 'b@example.com'):
+                recorder.record(recipient, self.success(recipient))
+        recorder.record('c@example.com', self.failure('c@example.com'))
+        result = recorder.result(total=3)
+        self.assertEqual(result['failures'], [{**self.failure('c'), 'recipient': 'c@example.com'}])
+        self.assertEqual(result['delivery_log'], {'task_id': 'bulk', 'entries': 3})
+        self.assertNotIn('results', result)
+        self.assertEqual(DeliveryLog.objects.filter(task_id='bulk').count(), 3)
+
+    def test_resumes_the_counts_of_an_earlier_run(self):
+        first = DeliveryRecorder(task_id='bulk', compact=True)
+        first.record('a@example.com', self.failure('a@example.com'))
+        recorder = DeliveryRecorder(task_id='bulk', compact=True, resume=first.result(total=1))
+        self.assertEqual(recorder.processed, 1)
+        recorder.record('b@example.com', self.success('b@example.com'))
+        result = recorder.result(total=2)
+        self.assertEqual(result['summary'], {'total': 2, 'success': 1, 'failed': 1})
+        self.assertEqual(len(result['failures']), 1)
+        self.assertEqual(result['delivery_log']['entries'], 2)
+
+    def test_pages_through_the_log(self):
+        recorder = DeliveryRecorder(task_id='bulk', compact=True)
+        for i in range(5):
+            recorder.record(f"user{i}@example.com", self.success(''))
+        recorder.result(total=5)
+        page, next_after = delivery_log_page(['bulk'], limit=2)
+        self.assertEqual([e['recipient'] for e in page], ['user0@example.com', 'user1@example.com'])
+        page, next_after = delivery_log_page(['bulk'], after=next_after, limit=3)
+        self.assertEqual(len(page), 3)
+        self.assertIsNone(next_after)
+
+
+@override_settings(
+    EMAIL_RATE_LIMIT_BACKEND='memory', EMAIL_RATE_LIMIT_PER_MINUTE=2, EMAIL_RATE_LIMIT_MAX_WAIT=0,
+)
+class DeferredBulkResumeTests(OfflineTestCase):
+
+    def test_deferred_recipients_resume_where_the_task_stopped(self):
+        recipients = ['a@example.com', 'b@example.com', 'c@example.com']
+        send_bulk_email_task.push_request(id='bulk')
+        self.addCleanup(send_bulk_email_task.pop_request)
+        with mock.patch.object(send_bulk_email_task, 'retry', side_effect=Retry()) as retry:
+            with self.assertRaises(Retry):
+                send_bulk_email_task.run(recipients, "Subject", "Message", compact=True)
+        kwargs = retry.call_args.kwargs
+        self.assertEqual(kwargs['args'][0], ['c@example.com'])
+        self.assertEqual(kwargs['kwargs']['resume']['summary'], {'total': 2, 'success': 2, 'failed': 0})
+
+        # The budget has refilled by the time the retry runs
+        reset_rate_limiter()
+        result = send_bulk_email_task.run(*kwargs['args'], **kwargs['kwargs'])
+        self.assertEqual(result['summary'], {'total': 3, 'success': 3, 'failed': 0})
+        self.assertEqual(result['delivery_log'], {'task_id': 'bulk', 'entries': 3})
+        self.assertEqual(
+            sorted(DeliveryLog.objects.filter(task_id='bulk').values_list('recipient', flat=True)), recipients
+        )
+
+
+class QueueRoutingTests(OfflineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.connection = Connection('memory://')
+        self.addCleanup(self.connection.release)
+        self.queues = {name: queue(self.connection.default_channel) for name, queue in app.amqp.queues.items()}
+        for queue in self.queues.values():
+            queue.declare()
+            queue.purge()
+
+    def queued(self):
+        return {name: queue.queue_declare(passive=True).message_count for name, queue in self.queues.items()}
+
+    def test_every_task_has_a_route(self):
+        tasks = {name for name in app.tasks if not name.startswith('celery.')}
+        self.assertLessEqual(tasks, set(app.conf.task_routes))
+        for name in tasks:
+            self.assertIn(app.amqp.router.route({}, name)['queue'].name, self.queues)
+
+    def test_each_task_lands_in_its_own_queue_only(self):
+        sends = [
+            (send_email_task, ['to@example.com', "Subject", "Message"], 'transactional'),
+            (send_bulk_email_task, [['to@example.com'], "Subject", "Message"], 'bulk'),
+            (send_email_with_attachment_task, ['to@example.com', "Subject", "Message", '/tmp/file'], 'attachments'),
+            (purge_recipient_uploads_task, [], 'maintenance'),
+        ]
+        for task, args, queue in sends:
+            with self.subTest(task=task.name):
+                task.apply_async(args=args, connection=self.connection)
+                self.assertEqual(self.queued(), {name: int(name == queue) for name in self.queues})
+                self.queues[queue].purge()
+
+    def test_request_priority_is_passed_to_the_queue(self):
+        self.assertEqual(app.amqp.router.route({'priority': 0}, 'send_bulk_email_task')['priority'], 0)
+        with mock.patch('email_sender.views.dispatch_bulk_email', return_value=(mock.Mock(id='task'), None)) as dispatch:
+            response = self.client.post('/api/send-bulk-email/', {
+                'recipient_list': ['to@example.com'], 'subject': "Subject", 'message': "Message", 'priority': 'high',
+            }, content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(dispatch.call_args.kwargs['priority'], TASK_PRIORITIES['high'])
+
+
+class FakeAsyncSMTP:
+    """Stands in for aiosmtplib.SMTP, with a short delay per message"""
+
+    sessions = []
+    in_flight = 0
+    max_in_flight = 0
+    disconnects = 0
+    refused = ()
+
+    def __init__(self, **kwargs):
+        self.sent = []
+        self.closed = False
+        FakeAsyncSMTP.sessions.append(self)
+
+    async def connect(self):
+        pass
+
+    async def sendmail(self, sender, recipients, message):
+        FakeAsyncSMTP.in_flight += 1
+        FakeAsyncSMTP.max_in_flight = max(FakeAsyncSMTP.max_in_flight, FakeAsyncSMTP.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            FakeAsyncSMTP.in_flight -= 1
+        if FakeAsyncSMTP.disconnects:
+            FakeAsyncSMTP.disconnects -= 1
+            raise aiosmtplib.SMTPServerDisconnected("Connection lost")
+        self.sent.append(recipients)
+        refused = {
+            address: aiosmtplib.SMTPResponse(550, "No such user")
+            for address in recipients if address in FakeAsyncSMTP.refused
+        }
+        return refused, "OK"
+
+    async def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+@override_settings(EMAIL_ASYNC_CONCURRENCY=3)
+class AsyncSMTPEngineTests(OfflineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name, value in (('sessions', []), ('max_in_flight', 0), ('disconnects', 0), ('refused', ())):
+            patcher = mock.patch.object(FakeAsyncSMTP, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('aiosmtplib.SMTP', FakeAsyncSMTP)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def messages(self, count):
+        return [EmailMessage("Subject", "Message", 'from@example.com', [f"user{i}@example.com"]) for i in range(count)]
+
+    def test_sends_over_concurrent_reused_sessions(self):
+        with AsyncSMTPEngine() as engine:
+            self.assertEqual(engine.send_batch(self.messages(6)), [(1, None)] * 6)
+            engine.send_batch(self.messages(3))
+        self.assertEqual(FakeAsyncSMTP.max_in_flight, 3)
+        self.assertEqual(engine.stats()['connections_opened'], 3)
+        self.assertEqual(engine.stats()['messages_sent'], 9)
+        self.assertTrue(all(session.closed for session in FakeAsyncSMTP.sessions))
+
+    def test_reconnects_a_dropped_session(self):
+        FakeAsyncSMTP.disconnects = 1
+        with AsyncSMTPEngine(concurrency=1) as engine:
+            self.assertEqual(engine.send_batch(self.messages(2)), [(1, None)] * 2)
+        self.assertEqual((engine.connections_opened, engine.reconnects), (2, 1))
+
+    def test_gives_up_after_max_reconnects(self):
+        FakeAsyncSMTP.disconnects = 3
+        with AsyncSMTPEngine(concurrency=1, max_reconnects=2) as engine:
+            (sent, error), = engine.send_batch(self.messages(1))
+        self.assertEqual(sent, 0)
+        self.assertIsInstance(error, aiosmtplib.SMTPServerDisconnected)
+
+    def test_reports_refused_recipients(self):
+        FakeAsyncSMTP.refused = ('b@example.com',)
+        message = EmailMessage("Subject", "Message", 'from@example.com', ['a@example.com', 'b@example.com'])
+        with AsyncSMTPEngine() as engine:
+            (sent, error), = engine.send_batch([message])
+        self.assertEqual(sent, 1)
+        self.assertEqual([r.recipient for r in error.recipients], ['b@example.com'])
+
+    @override_settings(EMAIL_RATE_LIMIT_BACKEND='memory', EMAIL_RATE_LIMIT_PER_MINUTE=2, EMAIL_RATE_LIMIT_MAX_WAIT=0)
+    def test_stops_when_rate_limited(self):
+        with AsyncSMTPEngine(concurrency=1) as engine:
+            outcomes = engine.send_batch(self.messages(4))
+            self.assertEqual(engine.send_batch(self.messages(1)), [None])
+        self.assertEqual(outcomes, [(1, None), (1, None), None, None])
+        self.assertIsInstance(engine.rate_limited, RateLimited)
+
+    @override_settings(EMAIL_ASYNC_ENGINE=True, EMAIL_BACKEND='email_sender.backends.EmailBackend')
+    def test_bulk_task_runs_on_the_engine(self):
+        recipients = [f"user{i}@example.com" for i in range(5)]
+        result = send_bulk_email_task.run(recipients, "Subject", "Message")
+        self.assertEqual(result['summary'], {'total': 5, 'success': 5, 'failed': 0})
+        self.assertEqual(result['connection']['engine'], 'async')
+        self.assertEqual(sorted(r for s in FakeAsyncSMTP.sessions for r, in s.sent), recipients)
+
+
+class TimedTestTask(metrics.TimedTask):
+    """Renders n times, outside the task registry"""
+    name = 'timed_test_task'
+
+    def run(self, n, inner=None):
+        for _ in range(n):
+            with metrics.stage('render'):
+                pass
+        if inner is not None:
+            inner(1)
+        return {'status': 'success'}
+
+
+class StageMetricsTests(MetricsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.task = TimedTestTask()
+        self.task.bind(app)
+
+    def test_stage_outside_a_task_does_nothing(self):
+        with metrics.stage('render'):
+            pass
+        self.assertEqual(self.redis.keys(), [])
+
+    def test_stages_are_summed_per_run(self):
+        with mock.patch('email_sender.metrics.record_timings') as record:
+            self.task(3)
+        task_name, timings = record.call_args.args
+        self.assertEqual(task_name, 'timed_test_task')
+        self.assertEqual(set(timings), {'render', 'total'})
+        self.assertLessEqual(timings['render'], timings['total'])
+
+    def test_a_task_called_inside_another_reports_as_part_of_it(self):
+        inner = TimedTestTask()
+        with mock.patch('email_sender.metrics.record_timings') as record:
+            self.task(1, inner=inner)
+        record.assert_called_once()
+
+    @override_settings(EMAIL_TASK_TIMINGS=True)
+    def test_timings_can_be_attached_to_the_result(self):
+        self.assertEqual(set(self.task(1)['timings']), {'render', 'total'})
+
+    @override_settings(EMAIL_METRICS_BUCKETS=[0.1, 1])
+    def test_histograms_are_exported_cumulatively(self):
+        for seconds in (0.05, 0.5, 5):
+            metrics.record_timings('send_email_task', {'smtp_data': seconds})
+        text = metrics.metrics_text()
+        labels = 'task="send_email_task",stage="smtp_data"'
+        for line in (
+            f'email_task_stage_seconds_bucket{{{labels},le="0.1"}} 1',
+            f'email_task_stage_seconds_bucket{{{labels},le="1"}} 2',
+            f'email_task_stage_seconds_bucket{{{labels},le="+Inf"}} 3',
+            f'email_task_stage_seconds_sum{{{labels}}} 5.55',
+            f'email_task_stage_seconds_count{{{labels}}} 3',
+        ):
+            self.assertIn(line, text.splitlines())
+
+    @override_settings(EMAIL_METRICS=False)
+    def test_can_be_turned_off(self):
+        self.task(1)
+        self.assertEqual(self.redis.keys(), [])
+
+    def test_metrics_endpoint(self):
+        metrics.record_timings('send_email_task', {'total': 0.2})
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'email_task_stage_seconds_count{task="send_email_task",stage="total"} 1', response.content)
+
+        with mock.patch.object(fakeredis.FakeRedis, 'smembers', side_effect=redis.ConnectionError("down")):
+            response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 503)
+
+
+class IdempotencyStoreTests(FakeRedisTestCase):
+
+    def store(self, **kwargs):
+        return IdempotencyStore('redis://localhost:6379/0', **kwargs)
+
+    def test_begin_claims_a_send_once(self):
+        store = self.store()
+        self.assertIsNone(store.begin('key'))
+        self.assertIs(store.begin('key'), PENDING)
+        self.assertGreater(self.redis.ttl('email-idem:send:key'), 0)
+
+    def test_finish_stores_successful_results(self):
+        store = self.store()
+        result = {'status': 'success', 'message': "Email sent to a@example.com"}
+        store.begin('key')
+        store.finish([('key', result)])
+        self.assertEqual(store.begin('key'), result)
+        # Another process, without the cached copy, reads it from Redis
+        self.assertEqual(self.store().begin('key'), result)
+
+    def test_finish_releases_failed_sends(self):
+        store = self.store()
+        store.begin('key')
+        store.finish([('key', {'status': 'error', 'error_type': 'transient'})])
+        self.assertIsNone(store.begin('key'))
+
+    def test_begin_many(self):
+        store = self.store()
+        result = {'status': 'success'}
+        store.begin('sent')
+        store.finish([('sent', result)])
+        store.begin('in-flight')
+        self.assertEqual(store.begin_many(['sent', 'in-flight', 'new']), [result, PENDING, None])
+
+    def test_cached_results_expire_with_the_ttl(self):
+        store = self.store(ttl=60)
+        result = {'status': 'success'}
+        store.begin('key')
+        store.finish([('key', result)])
+        self.redis.delete('email-idem:send:key')
+        self.assertEqual(store.begin('key'), result)
+        with mock.patch('email_sender.idempotency.time.monotonic', return_value=float('inf')):
+            self.assertIsNone(store.begin('key'))
+
+
+@override_settings(**{**OFFLINE, 'EMAIL_IDEMPOTENCY': True})
+class IdempotentSendTests(FakeRedisTestCase):
+
+    def setUp(self):
+        super().setUp()
+        reset_store()
+        self.addCleanup(reset_store)
+        patcher = mock.patch.object(ScriptedEmailBackend, 'opened', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_claim_of_a_send_in_flight(self):
+        self.assertIsNone(claim('key'))
+        with self.assertRaises(SendInProgress):
+            claim('key')
+
+    def test_sends_without_a_key_are_not_claimed(self):
+        self.assertIsNone(claim(None))
+        self.assertIsNone(claim(None))
+        self.assertEqual(claim_many([None, 'key', None]), [None, None, None])
+        self.assertEqual(self.redis.keys(), [b'email-idem:send:key'])
+
+    def test_claim_sends_anyway_without_redis(self):
+        with mock.patch.object(IdempotencyStore, 'begin', side_effect=redis.ConnectionError):
+            self.assertIsNone(claim('key'))
+
+    def test_redelivered_task_returns_the_first_result(self):
+        send_email_task.push_request(id='task')
+        self.addCleanup(send_email_task.pop_request)
+        first = send_email_task.run('to@example.com', "Subject", "Message")
+        self.assertEqual(send_email_task.run('to@example.com', "Subject", "Message"), first)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_same_email_in_another_task_is_sent_again(self):
+        for task_id in ('first', 'second'):
+            send_email_task.push_request(id=task_id)
+            try:
+                send_email_task.run('to@example.com', "Subject", "Message")
+            finally:
+                send_email_task.pop_request()
+        self.assertEqual(len(mail.outbox), 2)
+
+    def post(self, **data):
+        return self.client.post('/api/send-email/', {
+            'recipient_email': 'to@example.com', 'subject': "Subject", 'message': "Message", **data,
+        }, content_type='application/json')
+
+    def test_requests_are_deduplicated_by_their_key_only(self):
+        task_ids = iter(['one', 'two', 'three'])
+        with mock.patch.object(
+            send_email_task, 'apply_async', side_effect=lambda **kwargs: mock.Mock(id=next(task_ids)),
+        ) as apply_async:
+            responses = [self.post(), self.post(), self.post(idempotency_key='k'), self.post(idempotency_key='k')]
+        self.assertEqual(
+            [(r.status_code, r.json()['task_id']) for r in responses],
+            [(202, 'one'), (202, 'two'), (202, 'three'), (200, 'three')],
+        )
+        self.assertEqual(apply_async.call_count, 3)
+
+    def test_batch_queues_every_email_without_a_key(self):
+        self.assertEqual(batch_to_queue([None, 'a', None, 'a', 'b'], [None, None, None, None, 'task']), [0, 1, 2])
+
+
+class ResultAuditTests(TestCase):
+
+    def setUp(self):
+        backend = RedisBackend(app=app, url='redis://localhost:6379/0')
+        backend.client = fakeredis.FakeStrictRedis()
+        for target in ('email_sender.status.current_app', 'email_sender.results.current_app'):
+            patcher = mock.patch(target, mock.Mock(backend=backend))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.result = {
+            'status': 'completed',
+            'summary': {'total': 2, 'success': 1, 'failed': 1},
+            'results': [{'status': 'success'}, {'status': 'error'}],
+            'failures': [{'status': 'error'}],
+            'timings': {'total': 0.1},
+        }
+
+    def audit(self, task_id, retval, state='SUCCESS'):
+        audit_task_result(task_id=task_id, task=send_bulk_email_task, retval=retval, state=state)
+
+    def test_summary_leaves_out_per_recipient_detail(self):
+        self.assertEqual(result_summary(self.result), {
+            'status': 'completed',
+            'summary': {'total': 2, 'success': 1, 'failed': 1},
+            'failures_count': 1,
+        })
+
+    @override_settings(EMAIL_RESULT_AUDIT_SAMPLE_RATE=1)
+    def test_sampled_results_are_audited(self):
+        self.audit('sent', self.result)
+        row = TaskResult.objects.get(task_id='sent')
+        self.assertEqual((row.status, row.task_name), ('SUCCESS', 'send_bulk_email_task'))
+        self.assertEqual(json.loads(row.result), result_summary(self.result))
+
+    @override_settings(EMAIL_RESULT_AUDIT_SAMPLE_RATE=0)
+    def test_every_failure_is_audited(self):
+        self.audit('sent', self.result)
+        self.audit('failed', ValueError("boom"), state='FAILURE')
+        self.assertEqual(list(TaskResult.objects.values_list('task_id', flat=True)), ['failed'])
+        self.assertEqual(task_status('failed'), {'task_id': 'failed', 'status': 'FAILURE', 'error': "boom"})
+
+    @override_settings(EMAIL_RESULT_AUDIT_SAMPLE_RATE=1)
+    def test_unfinished_tasks_are_not_audited(self):
+        self.audit('running', None, state='STARTED')
+        self.assertFalse(TaskResult.objects.exists())
+
+    def test_database_backend_needs_no_audit(self):
+        with mock.patch('email_sender.results.current_app', mock.Mock(backend=DatabaseBackend(app=app))):
+            self.audit('failed', ValueError("boom"), state='FAILURE')
+        self.assertFalse(TaskResult.objects.exists())
+
+
+class RecipientUploadTests(OfflineTestCase):
+
+    def upload(self, name, content, **kwargs):
+        return store_recipient_file(SimpleUploadedFile(name, content.encode('utf-8')), **kwargs)
+
+    def test_csv_reads_the_address_column_and_reports_bad_rows(self):
+        upload = self.upload('list.csv', (
+            "name,Email\n"
+            "Ann,Ann@Example.com\n"
+            "Bob,not-an-address\n"
+            "\n"
+            "Cy\n"
+            "Dee,dee@example.com\n"
+        ), chunk_size=10)
+        self.assertEqual((upload.accepted, upload.rejected, upload.chunks), (2, 2, 1))
+        self.assertEqual(upload.errors, [
+            {'line': 3, 'value': 'not-an-address', 'error': "Enter a valid email address."},
+            {'line': 5, 'value': None, 'error': "Missing address column"},
+        ])
+        self.assertEqual(load_recipient_chunk(upload.chunk_refs()[0]), ['ann@example.com', 'dee@example.com'])
+
+    def test_csv_without_a_header_uses_the_first_column(self):
+        upload = self.upload('list.csv', "a@example.com,Ann\nb@example.com,Bob\n")
+        self.assertEqual(load_recipient_chunk(upload.chunk_refs()[0]), ['a@example.com', 'b@example.com'])
+
+    def test_ndjson_takes_strings_and_objects(self):
+        upload = self.upload('list.ndjson', (
+            '"a@example.com"\n'
+            '{"recipient": "b@example.com", "name": "Bob"}\n'
+            '{not json\n'
+            '{"name": "Cy"}\n'
+            '\n'
+            '{"email": "d@example.com"}\n'
+        ))
+        self.assertEqual((upload.accepted, upload.rejected), (3, 2))
+        self.assertEqual([e['line'] for e in upload.errors], [3, 4])
+
+    def test_splits_the_addresses_into_chunks(self):
+        upload = self.upload('list.csv', "".join(f"user{i}@example.com\n" for i in range(5)), chunk_size=2)
+        self.assertEqual(upload.chunks, 3)
+        self.assertEqual([len(load_recipient_chunk(ref)) for ref in upload.chunk_refs()], [2, 2, 1])
+
+    @override_settings(EMAIL_UPLOAD_MAX_ERRORS=2)
+    def test_keeps_only_the_first_errors(self):
+        upload = self.upload('list.csv', "bad\n" * 5)
+        self.assertEqual((upload.rejected, len(upload.errors)), (5, 2))
+
+    def test_format_comes_from_the_name_or_content_type(self):
+        with self.assertRaises(RecipientFileError):
+            self.upload('list.txt', "a@example.com\n")
+        ndjson = SimpleUploadedFile('list', b'"a@example.com"\n', content_type='application/x-ndjson')
+        self.assertEqual(store_recipient_file(ndjson).accepted, 1)
+
+    def test_undecodable_files_are_rejected_and_nothing_is_kept(self):
+        content = b"".join(f"user{i}@example.com\n".encode() for i in range(3)) + b"\xff\xfe\n"
+        with self.assertRaises(RecipientFileError):
+            store_recipient_file(SimpleUploadedFile('list.csv', content), chunk_size=1)
+        self.assertFalse(RecipientChunk.objects.exists())
+
+    def test_upload_endpoint_sends_to_every_chunk(self):
+        self.run_tasks_eagerly()
+        content = "email\n" + "".join(f"user{i}@example.com\n" for i in range(5)) + "oops\n"
+        response = self.client.post('/api/send-bulk-email/upload/', {
+            'recipients_file': SimpleUploadedFile('list.csv', content.encode()),
+            'subject': "Subject",
+            'message': "Message",
+            'chunk_size': 2,
+        })
+        self.assertEqual(response.status_code, 202)
+        data = response.json()
+        self.assertEqual((data['recipients'], data['rejected'], data['chunks']), (5, 1, 3))
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), [f"user{i}@example.com" for i in range(5)])
+
+    def test_upload_without_valid_addresses_is_refused(self):
+        response = self.client.post('/api/send-bulk-email/upload/', {
+            'recipients_file': SimpleUploadedFile('list.csv', b"oops\n"),
+            'subject': "Subject",
+            'message': "Message",
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['rejected'], 1)
+
+
+
+class ValidationTests(SimpleTestCase):
+    addresses = [
+        'user@example.com',
+        '  User.Name+tag@Example.COM ',
+        'first.last@sub.example.co.uk',
+        "o'brien@example.ie",
+        'user@xn--bcher-kva.example',
+        'user@bücher.example',
+        '"quoted name"@example.com',
+        'user@[127.0.0.1]',
+        'user@localhost',
+        'user@-example.com',
+        'user@example-.com',
+        'user@example',
+        'user@@example.com',
+        '.user@example.com',
+        'user.@example.com',
+        'us..er@example.com',
+        'user example@example.com',
+        'user@example..com',
+        'user@exa_mple.com',
+        'user@example.c',
+        'user@example.123',
+        'a' * 64 + '@example.com',
+        'a' * 65 + '@example.com',
+        'user@' + 'a' * 63 + '.com',
+        'user@' + 'a' * 64 + '.com',
+        '@example.com',
+        'user@',
+        'plainaddress',
+    ]
+
+    def test_agrees_with_drf_email_field(self):
+        field = serializers.EmailField()
+        for address in self.addresses:
+            try:
+                expected = field.run_validation(address).lower()
+            except serializers.ValidationError:
+                expected = None
+            self.assertEqual(normalize_email(address), expected, address)
+
+    def test_error_messages_match_drf(self):
+        field = serializers.EmailField()
+        self.assertEqual(field.error_messages['invalid'], INVALID_EMAIL)
+        self.assertEqual(field.error_messages['blank'], BLANK)
+        self.assertEqual(serializers.CharField().error_messages['invalid'], NOT_A_STRING)
+
+    def test_validate_recipients(self):
+        unique, errors, duplicates = validate_recipients(
+            ['A@example.com', 'b@example.com', ' a@EXAMPLE.com', '', 'nope', None, 'b@example.com']
+        )
+        self.assertEqual(unique, ['a@example.com', 'b@example.com'])
+        self.assertEqual(errors, {3: [BLANK], 4: [INVALID_EMAIL], 5: [NOT_A_STRING]})
+        self.assertEqual(duplicates, 2)
+
+    def test_bulk_endpoint_reports_errors_by_index(self):
+        response = self.client.post('/api/send-bulk-email/', {
+            'recipient_list': ['a@example.com', 'nope', ''], 'subject': "Subject", 'message': "Message",
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'recipient_list': {'1': [INVALID_EMAIL], '2': [BLANK]}})
+
+
+class ClassifyErrorTests(SimpleTestCase):
+
+    def test_smtp_replies(self):
+        self.assertEqual(classify_error(smtplib.SMTPDataError(451, b"Try again later")), TRANSIENT)
+        self.assertEqual(classify_error(smtplib.SMTPSenderRefused(421, b"Busy", 'from@example.com')), TRANSIENT)
+        self.assertEqual(classify_error(smtplib.SMTPDataError(554, b"Rejected")), PERMANENT)
+        self.assertEqual(classify_error(smtplib.SMTPAuthenticationError(535, b"Bad credentials")), PERMANENT)
+
+    def test_refused_recipients(self):
+        transient = smtplib.SMTPRecipientsRefused({'a@example.com': (450, b""), 'b@example.com': (452, b"")})
+        mixed = smtplib.SMTPRecipientsRefused({'a@example.com': (450, b""), 'b@example.com': (550, b"")})
+        self.assertEqual(classify_error(transient), TRANSIENT)
+        self.assertEqual(classify_error(mixed), PERMANENT)
+
+    def test_network_errors(self):
+        for error in (ConnectionResetError(), TimeoutError(), socket.gaierror(), smtplib.SMTPServerDisconnected()):
+            self.assertEqual(classify_error(error), TRANSIENT, error)
+
+    def test_other_errors_are_permanent(self):
+        self.assertEqual(classify_error(ValueError("Bad template")), PERMANENT)
+        self.assertEqual(classify_error(FileNotFoundError()), PERMANENT)
+
+    @override_settings(EMAIL_RETRY_BACKOFF=30, EMAIL_RETRY_BACKOFF_MAX=600, EMAIL_RETRY_MAX_RETRIES=5)
+    def test_backoff(self):
+        self.assertTrue(15 <= backoff_delay(0) <= 30)
+        self.assertTrue(60 <= backoff_delay(2) <= 120)
+        self.assertTrue(300 <= backoff_delay(10) <= 600)
+        self.assertTrue(can_retry(4))
+        self.assertFalse(can_retry(5))
+
+
+@override_settings(EMAIL_RETRY_MAX_RETRIES=5)
+class BulkRetryTests(OfflineTestCase):
+    recipients = ['a@example.com', 'b@example.com', 'c@example.com', 'd@example.com']
+
+    def setUp(self):
+        super().setUp()
+        # b is deferred by the server (4xx), c is rejected (5xx)
+        ScriptedEmailBackend.REFUSED = {'b@example.com': 451, 'c@example.com': 550}
+
+    def send(self, **kwargs):
+        return send_bulk_email_task.run(self.recipients, "Subject", "Message", **kwargs)
+
+    def test_requeues_only_transient_failures(self):
+        with mock.patch.object(send_bulk_email_task, 'retry', side_effect=Retry()) as retry:
+            with self.assertRaises(Retry):
+                self.send()
+
+        self.assertEqual([m.to for m in mail.outbox], [['a@example.com'], ['d@example.com']])
+        kwargs = retry.call_args.kwargs
+        self.assertEqual(kwargs['args'], [['b@example.com'], "Subject", "Message", None])
+        self.assertEqual(kwargs['kwargs']['transient_retries'], 1)
+        self.assertEqual(kwargs['kwargs']['resume']['summary'], {'total': 3, 'success': 2, 'failed': 1})
+
+    def test_permanent_failures_are_not_retried(self):
+        del ScriptedEmailBackend.REFUSED['b@example.com']
+        result = self.send()
+        self.assertEqual(result['summary'], {'total': 4, 'success': 3, 'failed': 1})
+        failed = [r for r in result['results'] if r['status'] == 'error']
+        self.assertEqual(failed[0]['error_type'], PERMANENT)
+
+    def test_gives_up_after_the_last_retry(self):
+        result = self.send(transient_retries=5)
+        self.assertEqual(result['summary'], {'total': 4, 'success': 2, 'failed': 2})
+
+    def test_single_email_retries_with_backoff(self):
+        ScriptedEmailBackend.REFUSED = {'b@example.com': 451}
+        kwargs = {'recipient_email': 'b@example.com', 'subject': "Subject", 'message': "Message"}
+        send_email_task.push_request(id='task', kwargs=kwargs)
+        self.addCleanup(send_email_task.pop_request)
+        with mock.patch.object(send_email_task, 'retry', side_effect=Retry()) as retry:
+            with self.assertRaises(Retry):
+                send_email_task.run(**kwargs)
+        self.assertEqual(retry.call_args.kwargs['kwargs'], {**kwargs, 'transient_retries': 1})
+        self.assertGreater(retry.call_args.kwargs['countdown'], 0)
+
+
+@override_settings(EMAIL_IDEMPOTENCY_TTL=3600, EMAIL_OUTBOX_CLAIM_TIMEOUT=300)
+class OutboxTests(OfflineTestCase):
+
+    def add(self, recipient, **kwargs):
+        kwargs.setdefault('idempotency_key', recipient)
+        return enqueue_email(recipient, "Subject", "Message", **kwargs)[0]
+
+    def test_enqueue_returns_the_email_with_the_same_key(self):
+        first, created = enqueue_email('a@example.com', "Subject", "Message", idempotency_key='key')
+        second, again = enqueue_email('a@example.com', "Subject", "Message", idempotency_key='key')
+        self.assertTrue(created)
+        self.assertFalse(again)
+        self.assertEqual(first.pk, second.pk)
+
+    def test_enqueue_racing_another_request(self):
+        first = self.add('a@example.com', idempotency_key='key')
+        # The other request's email isn't seen by the check, only by the insert
+        with mock.patch.object(QuerySet, 'first', return_value=None):
+            second, created = enqueue_email('a@example.com', "Subject", "Message", idempotency_key='key')
+        self.assertFalse(created)
+        self.assertEqual(second.pk, first.pk)
+        self.assertEqual(OutboxEmail.objects.count(), 1)
+
+    def test_expired_keys_can_be_used_again(self):
+        first = self.add('a@example.com', idempotency_key='key')
+        OutboxEmail.objects.filter(pk=first.pk).update(created_at=timezone.now() - timedelta(hours=2))
+        second, created = enqueue_email('a@example.com', "Subject", "Message", idempotency_key='key')
+        self.assertTrue(created)
+        first.refresh_from_db()
+        self.assertIsNone(first.idempotency_key)
+
+    def test_claims_due_emails_by_priority(self):
+        low = self.add('low@example.com', priority=9)
+        high = self.add('high@example.com', priority=0)
+        normal = self.add('normal@example.com', priority=5)
+        later = self.add('later@example.com', priority=0)
+        OutboxEmail.objects.filter(pk=later.pk).update(available_at=timezone.now() + timedelta(minutes=5))
+
+        token, claimed = claim_batch(2)
+        self.assertEqual(claimed, 2)
+        held = OutboxEmail.objects.filter(claim_token=token).order_by('priority')
+        self.assertEqual([email.pk for email in held], [high.pk, normal.pk])
+        self.assertTrue(all(email.status == OutboxEmail.SENDING and email.attempts == 1 for email in held))
+
+        # A second dispatcher only gets what is left
+        token, claimed = claim_batch(10)
+        self.assertEqual(claimed, 1)
+        self.assertEqual(OutboxEmail.objects.get(claim_token=token).pk, low.pk)
+        self.assertEqual(claim_batch(10)[1], 0)
+
+    def test_claims_skip_locked_rows(self):
+        self.add('a@example.com')
+        with mock.patch.object(
+            QuerySet, 'select_for_update', autospec=True, side_effect=QuerySet.select_for_update,
+        ) as select_for_update:
+            claim_batch(10)
+        self.assertTrue(select_for_update.call_args.kwargs['skip_locked'])
+
+    def test_reclaims_abandoned_claims(self):
+        email = self.add('a@example.com')
+        token, _ = claim_batch(10)
+        self.assertEqual(claim_batch(10)[1], 0)
+        OutboxEmail.objects.filter(pk=email.pk).update(claimed_at=timezone.now() - timedelta(minutes=10))
+        token, claimed = claim_batch(10)
+        self.assertEqual(claimed, 1)
+        email.refresh_from_db()
+        self.assertEqual((email.claim_token, email.attempts), (token, 2))
+
+    def test_emails_without_a_key_are_all_added(self):
+        for _ in range(2):
+            self.assertTrue(enqueue_email('a@example.com', "Subject", "Message")[1])
+        self.assertEqual(OutboxEmail.objects.count(), 2)
+
+    def test_dispatcher_sends_each_batch_over_one_session(self):
+        self.run_tasks_eagerly()
+        for i in range(5):
+            self.add(f"user{i}@example.com")
+        ScriptedEmailBackend.REFUSED = {'user4@example.com': 550}
+        with override_settings(EMAIL_OUTBOX_BATCH_SIZE=2):
+            result = dispatch_outbox_task()
+        self.assertEqual(result['details'], {'batches': 3, 'emails': 5})
+        self.assertEqual(ScriptedEmailBackend.opened, 3)
+        statuses = dict(OutboxEmail.objects.values_list('recipient', 'status'))
+        self.assertEqual(statuses.pop('user4@example.com'), OutboxEmail.FAILED)
+        self.assertEqual(set(statuses.values()), {OutboxEmail.SENT})
+        self.assertEqual(len(mail.outbox), 4)
+
+
+@override_settings(**{**OFFLINE, 'EMAIL_BODY_STORE': 'redis', 'EMAIL_BODY_STORE_THRESHOLD': 100})
+class ClaimCheckTests(FakeRedisTestCase):
+    body = "A newsletter long enough to be stored. " * 10
+
+    def setUp(self):
+        super().setUp()
+        reset_claim_check()
+        self.addCleanup(reset_claim_check)
+
+    def key(self, claim_check):
+        return f"email-body:{claim_check[CLAIM_CHECK]}"
+
+    def test_round_trip(self):
+        self.assertEqual(check_in("Short"), "Short")
+        claim_check = check_in(self.body)
+        self.assertEqual(set(claim_check), {CLAIM_CHECK})
+        # Another process, with nothing cached
+        reset_claim_check()
+        self.assertEqual(check_out(claim_check), self.body)
+
+    def test_checking_in_again_renews_the_expiry(self):
+        claim_check = check_in(self.body)
+        self.redis.expire(self.key(claim_check), 10)
+        check_in(self.body)
+        self.assertGreater(self.redis.ttl(self.key(claim_check)), 10)
+
+    def test_evicted_body_is_uploaded_again(self):
+        claim_check = check_in(self.body)
+        self.redis.flushall()
+        check_in(self.body)
+        reset_claim_check()
+        self.assertEqual(check_out(claim_check), self.body)
+
+    def test_missing_body_fails_permanently(self):
+        claim_check = check_in(self.body)
+        self.redis.flushall()
+        reset_claim_check()
+        send_email_task.push_request(id='task', kwargs={})
+        self.addCleanup(send_email_task.pop_request)
+        result = send_email_task.run('a@example.com', "Subject", claim_check)
+        self.assertEqual((result['status'], result['error_type']), ('error', PERMANENT))
+        self.assertEqual(mail.outbox, [])
+
+    def test_missing_body_fails_every_bulk_recipient(self):
+        claim_check = check_in(self.body)
+        self.redis.flushall()
+        reset_claim_check()
+        send_bulk_email_task.push_request(id='task', kwargs={})
+        self.addCleanup(send_bulk_email_task.pop_request)
+        result = send_bulk_email_task.run(['a@example.com', 'b@example.com'], "Subject", claim_check)
+        self.assertEqual(result['summary'], {'total': 2, 'success': 0, 'failed': 2})
+        self.assertEqual({r['error_type'] for r in result['results']}, {PERMANENT})
+
+    def test_unreachable_store_is_retried(self):
+        claim_check = check_in(self.body)
+        reset_claim_check()
+        get_claim_check().store.client = mock.Mock(get=mock.Mock(side_effect=redis.ConnectionError("down")))
+        send_email_task.push_request(id='task', kwargs={})
+        self.addCleanup(send_email_task.pop_request)
+        with mock.patch.object(send_email_task, 'retry', side_effect=Retry()) as retry:
+            with self.assertRaises(Retry):
+                send_email_task.run('a@example.com', "Subject", claim_check)
+        self.assertIsInstance(retry.call_args.kwargs['exc'], redis.ConnectionError)
+        self.assertGreater(retry.call_args.kwargs['countdown'], 0)
+
+    def test_disk_store_purges_bodies_not_checked_in(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        with override_settings(EMAIL_BODY_STORE='disk', EMAIL_BODY_STORE_PATH=path, EMAIL_BODY_STORE_TTL=60):
+            reset_claim_check()
+            old = check_in(self.body)
+            recent = check_in(self.body.upper())
+            stored = get_claim_check().store._path(old[CLAIM_CHECK])
+            os.utime(stored, (0, 0))
+            self.assertEqual(purge_body_store_task()['details'], {'deleted': 1})
+            self.assertFalse(os.path.exists(stored))
+            reset_claim_check()
+            self.assertEqual(check_out(recent), self.body.upper())
+            # Checked in again: stored again, and kept by the next purge
+            check_in(self.body)
+            self.assertEqual(purge_body_store_task()['details'], {'deleted': 0})
+            reset_claim_check()
+            self.assertEqual(check_out(old), self.body)
+
+
+class PlannerTests(SimpleTestCase):
+
+    def test_envelopes_hold_one_domain(self):
+        recipients = ['a@one.com', 'b@two.com', 'c@one.com', 'd@TWO.com', 'e@three.com']
+        self.assertEqual(
+            plan_envelopes(recipients, max_recipients=50),
+            [['a@one.com', 'c@one.com'], ['b@two.com', 'd@TWO.com'], ['e@three.com']],
+        )
+
+    def test_envelopes_are_split_at_max_recipients(self):
+        recipients = [f"user{i}@example.com" for i in range(7)]
+        self.assertEqual([len(e) for e in plan_envelopes(recipients, max_recipients=3)], [3, 3, 1])
+
+    @override_settings(EMAIL_MULTI_RCPT_MAX=50, EMAIL_RATE_LIMIT_PER_SECOND=10)
+    def test_envelopes_fit_the_smallest_rate_limit_budget(self):
+        recipients = [f"user{i}@example.com" for i in range(30)]
+        self.assertEqual([len(e) for e in plan_envelopes(recipients)], [10, 10, 10])
+
+    def test_group_by_domain_keeps_first_seen_order(self):
+        self.assertEqual(
+            group_by_domain(['a@x.com', 'b@y.com', 'c@x.com', 'd@z.com', 'e@y.com']),
+            ['a@x.com', 'c@x.com', 'b@y.com', 'e@y.com', 'd@z.com'],
+        )
+
+    @override_settings(EMAIL_MULTI_RCPT=True)
+    def test_needs_a_backend_that_reports_refusals(self):
+        for backend, enabled in (
+            ('email_sender.backends.EmailBackend', True),
+            ('email_sender.tests.RelayEmailBackend', True),
+            ('django.core.mail.backends.smtp.EmailBackend', False),
+            ('django.core.mail.backends.locmem.EmailBackend', False),
+        ):
+            with self.subTest(backend=backend), override_settings(EMAIL_BACKEND=backend):
+                self.assertEqual(bool(multi_rcpt_enabled()), enabled)
+
+
+@override_settings(EMAIL_BACKEND='email_sender.tests.RelayEmailBackend', EMAIL_MULTI_RCPT=True)
+class MultiRecipientTests(OfflineTestCase):
+    recipients = ['a@example.com', 'b@other.com', 'c@example.com', 'd@example.com']
+
+    def setUp(self):
+        super().setUp()
+        for name, value in (('REFUSED', {}), ('envelopes', [])):
+            patcher = mock.patch.object(RelayEmailBackend, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        send_bulk_email_task.push_request(id='task', kwargs={})
+        self.addCleanup(send_bulk_email_task.pop_request)
+
+    def test_sends_one_message_per_domain(self):
+        result = send_bulk_email_task.run(self.recipients, "Subject", "Message")
+        self.assertEqual(result['summary'], {'total': 4, 'success': 4, 'failed': 0})
+        self.assertEqual(
+            RelayEmailBackend.envelopes,
+            [['a@example.com', 'c@example.com', 'd@example.com'], ['b@other.com']],
+        )
+
+    def test_refused_recipients_fail_on_their_own(self):
+        RelayEmailBackend.REFUSED = {'c@example.com': 550}
+        result = send_bulk_email_task.run(self.recipients, "Subject", "Message")
+        self.assertEqual(result['summary'], {'total': 4, 'success': 3, 'failed': 1})
+        failed = [r for r in result['results'] if r['status'] == 'error']
+        self.assertEqual(failed[0]['details']['to'], 'c@example.com')
+        self.assertEqual(failed[0]['error_type'], PERMANENT)
+
+    def test_transiently_refused_recipients_are_retried_alone(self):
+        RelayEmailBackend.REFUSED = {'c@example.com': 451}
+        with mock.patch.object(send_bulk_email_task, 'retry', side_effect=Retry()) as retry:
+            with self.assertRaises(Retry):
+                send_bulk_email_task.run(self.recipients, "Subject", "Message")
+        self.assertEqual(retry.call_args.kwargs['args'][0], ['c@example.com'])
+
+
+class WorkerPoolTests(SimpleTestCase):
+
+    def worker(self, pool_cls, queues):
+        """What configure_worker_pool reads from a starting worker"""
+        return SimpleNamespace(
+            pool_cls=pool_cls,
+            app=SimpleNamespace(amqp=SimpleNamespace(queues=SimpleNamespace(consume_from={q: None for q in queues}))),
+            prefetch_multiplier=1,
+        )
+
+    def patched_gevent(self, patched):
+        """sys.modules entries for a gevent whose socket is (not) patched"""
+        monkey = SimpleNamespace(is_module_patched=lambda module: patched)
+        return {'gevent': SimpleNamespace(monkey=monkey), 'gevent.monkey': monkey}
+
+    def test_thread_pool_on_io_queues_prefetches_more(self):
+        from celery.concurrency.thread import TaskPool
+        for pool_cls in (TaskPool, 'threads', 'gevent', 'eventlet'):
+            with self.subTest(pool=pool_cls), mock.patch.dict(sys.modules, self.patched_gevent(True)):
+                worker = self.worker(pool_cls, ['bulk', 'attachments'])
+                configure_worker_pool(sender=worker)
+                self.assertEqual(worker.prefetch_multiplier, IO_POOL_PREFETCH_MULTIPLIER)
+
+    def test_transactional_workers_keep_one_message(self):
+        worker = self.worker('threads', ['bulk', 'transactional'])
+        configure_worker_pool(sender=worker)
+        self.assertEqual(worker.prefetch_multiplier, 1)
+
+    def test_prefork_pool_keeps_one_message(self):
+        from celery.concurrency.prefork import TaskPool
+        worker = self.worker(TaskPool, ['bulk'])
+        configure_worker_pool(sender=worker)
+        self.assertEqual(worker.prefetch_multiplier, 1)
+
+    def test_warns_about_an_unpatched_gevent_pool(self):
+        with mock.patch.dict(sys.modules, self.patched_gevent(False)):
+            with self.assertLogs('config.celery', level='ERROR'):
+                configure_worker_pool(sender=self.worker('gevent', ['bulk']))
+
+
+class WorkerStartupTests(SimpleTestCase):
+
+    def test_skips_mingle(self):
+        worker = SimpleNamespace(options={})
+        configure_worker_startup(sender=worker)
+        self.assertIs(worker.options['without_mingle'], True)
+
+    @override_settings(EMAIL_WORKER_MINGLE=True)
+    def test_mingle_can_be_kept(self):
+        worker = SimpleNamespace(options={})
+        configure_worker_startup(sender=worker)
+        self.assertNotIn('without_mingle', worker.options)
+
+    def test_workers_skip_system_checks(self):
+        from celery.fixups.django import DjangoWorkerFixup
+        fixup = DjangoWorkerFixup(app)
+        with mock.patch('django.core.checks.run_checks') as run_checks:
+            fixup.validate_models()
+            run_checks.assert_not_called()
+            with mock.patch.dict(os.environ, {'CELERY_SKIP_CHECKS': ''}):
+                fixup.validate_models()
+            run_checks.assert_called_once()
+
+    def test_log_file_is_opened_on_the_first_record(self):
+        options = dict(settings.LOGGING['handlers']['file'])
+        handler_class = import_string(options.pop('class'))
+        for name in ('level', 'formatter'):
+            options.pop(name)
+        path = os.path.join(tempfile.mkdtemp(), 'email-tasks.log')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        handler = handler_class(**{**options, 'filename': path})
+        self.addCleanup(handler.close)
+        self.assertFalse(os.path.exists(path))
+        handler.handle(logging.makeLogRecord({'msg': "Sent"}))
+        self.assertTrue(os.path.exists(path))
+
+
+class PublishTests(SimpleTestCase):
+    """publish_many() and apublish_many() over kombu's Redis transport"""
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=self.server)
+        server = self.server
+
+        class FakeConnection(fakeredis.FakeRedisConnection):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, server=server, **kwargs)
+
+        patcher = mock.patch.object(RedisChannel, 'connection_class', FakeConnection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.app = Celery('publish-tests', broker='redis://broker.test:6379/0', set_as_current=False)
+        self.app.conf.broker_transport_options = {
+            'priority_steps': list(range(10)),
+            'sep': ':',
+            'queue_order_strategy': 'priority',
+        }
+        # Producer pools are process-wide, per broker URL
+        self.addCleanup(pools.reset)
+        self.addCleanup(self.app.close)
+
+        @self.app.task(name='publish_tests.echo')
+        def echo(value):
+            return value
+
+        self.task = echo
+        self.calls = [({'value': i}, {'priority': 5}) for i in range(3)]
+
+    def queued_ids(self, key='celery:5'):
+        """Task ids in a queue's list, oldest first"""
+        return [json.loads(payload)['headers']['id'] for payload in reversed(self.redis.lrange(key, 0, -1))]
+
+    def test_publishes_every_call_in_one_pipeline(self):
+        # Declares the queue, which takes round trips of its own
+        warmup = publish.publish_many(self.task, self.calls[:1])
+        with mock.patch.object(
+            redis.client.Pipeline, 'execute', autospec=True, side_effect=redis.client.Pipeline.execute,
+        ) as execute:
+            results = publish.publish_many(self.task, self.calls)
+        self.assertEqual(execute.call_count, 1)
+        self.assertEqual(self.queued_ids(), [result.id for result in warmup + results])
+
+    def test_keeps_priorities(self):
+        results = publish.publish_many(self.task, [({'value': 1}, {'priority': 0}), ({'value': 2}, {'priority': 9})])
+        self.assertEqual(self.queued_ids('celery'), [results[0].id])
+        self.assertEqual(self.queued_ids('celery:9'), [results[1].id])
+
+    def test_unchecked_kombu_publishes_one_message_at_a_time(self):
+        with mock.patch.object(publish, 'BUFFERED_KOMBU_VERSIONS', ((4, 0), (4, 6))):
+            with mock.patch.object(publish, '_buffered') as buffered:
+                results = publish.publish_many(self.task, self.calls)
+        buffered.assert_not_called()
+        self.assertEqual(self.queued_ids(), [result.id for result in results])
+
+    def test_async_publish(self):
+        async def publish_twice():
+            return await asyncio.gather(
+                publish.apublish_many(self.task, self.calls[:2]),
+                publish.apublish_many(self.task, self.calls[2:]),
+            )
+
+        self.addCleanup(async_redis._pipelines.clear)
+        with mock.patch.object(
+            async_redis.aioredis.Redis, 'from_url',
+            side_effect=lambda url, **kwargs: fakeredis.aioredis.FakeRedis(server=self.server),
+        ):
+            first, second = asyncio.run(publish_twice())
+        self.assertEqual(sorted(self.queued_ids()), sorted(result.id for result in first + second))
+
+
+class OneAMinuteThrottle(AnonRateThrottle):
+    rate = '1/min'
+
+
+@override_settings(**OFFLINE)
+class AsyncAPIViewTests(TestCase):
+    """The async views refuse the same requests as DRF's APIView"""
+
+    def post(self, headers=None):
+        request = RequestFactory().post('/api/send-email/', data={}, content_type='application/json', headers=headers)
+        return SendEmailView.as_view()(request)
+
+    def apost(self, headers=None):
+        request = AsyncRequestFactory().post(
+            '/api/send-email/', data={}, content_type='application/json', headers=headers,
+        )
+        return async_to_sync(AsyncSendEmailView.as_view())(request)
+
+    def basic_auth(self, password):
+        return {'Authorization': f"Basic {base64.b64encode(f'api:{password}'.encode()).decode()}"}
+
+    def patch_views(self, name, value):
+        for view_class in (SendEmailView, AsyncSendEmailView):
+            patcher = mock.patch.object(view_class, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_anonymous_requests_reach_the_handler_by_default(self):
+        self.assertEqual(self.apost().status_code, 400)
+
+    def test_refuses_unauthenticated_requests_like_apiview(self):
+        self.patch_views('permission_classes', [IsAuthenticated])
+        # Session authentication first (the default) gives a 403, Basic a 401
+        for authentication_classes in (None, [BasicAuthentication]):
+            with self.subTest(authentication_classes=authentication_classes):
+                if authentication_classes:
+                    self.patch_views('authentication_classes', authentication_classes)
+                expected = self.post()
+                response = self.apost()
+                self.assertEqual(response.status_code, expected.status_code)
+                self.assertEqual(response.get('WWW-Authenticate'), expected.get('WWW-Authenticate'))
+                self.assertEqual(json.loads(response.content), {'detail': str(expected.data['detail'])})
+
+    def test_authenticates_with_the_same_classes(self):
+        self.patch_views('permission_classes', [IsAuthenticated])
+        User.objects.create_user('api', password='secret')
+        self.assertEqual(self.apost(self.basic_auth('secret')).status_code, 400)
+        self.assertEqual(self.apost(self.basic_auth('wrong')).status_code, self.post(self.basic_auth('wrong')).status_code)
+
+    def test_throttles(self):
+        self.patch_views('throttle_classes', [OneAMinuteThrottle])
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.assertEqual(self.apost().status_code, 400)
+        response = self.apost()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
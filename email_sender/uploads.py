@@ -0,0 +1,239 @@
+import codecs
+import csv
+import json
+import logging
+import os
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import RecipientChunk
+from .validation import INVALID_EMAIL, normalize_email
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+UPLOAD_FORMATS = ('csv', 'ndjson')
+
+# Column (CSV header) or key (NDJSON object) holding the address
+ADDRESS_FIELDS = ('recipient', 'recipient_email', 'email')
+
+FORMAT_EXTENSIONS = {
+    '.csv': 'csv',
+    '.ndjson': 'ndjson',
+    '.jsonl': 'ndjson',
+}
+
+
+class RecipientFileError(Exception):
+    """Raised when an uploaded recipient file can't be read"""
+
+
+def guess_format(uploaded_file):
+    """
+    Format of an uploaded recipient file from its name or content type
+
+    Raises:
+        RecipientFileError: If neither tells the format
+    """
+    extension = os.path.splitext(uploaded_file.name or '')[1].lower()
+    if extension in FORMAT_EXTENSIONS:
+        return FORMAT_EXTENSIONS[extension]
+    content_type = (getattr(uploaded_file, 'content_type', None) or '').lower()
+    if 'csv' in content_type:
+        return 'csv'
+    if 'ndjson' in content_type or 'jsonl' in content_type or 'json-seq' in content_type:
+        return 'ndjson'
+    raise RecipientFileError("Unknown file format, upload a .csv or .ndjson file or set file_format")
+
+
+def iter_csv_addresses(lines):
+    """
+    Addresses of a CSV recipient file
+
+    The address is read from the "recipient", "recipient_email" or "email"
+    column when the first row is a header naming one of them, otherwise
+    from the first column.
+
+    Yields:
+        tuple: (line number, address, error or None)
+    """
+    reader = csv.reader(lines)
+    column = 0
+    first = True
+    for row in reader:
+        if first:
+            first = False
+            names = [cell.strip().lower() for cell in row]
+            header = next((name for name in ADDRESS_FIELDS if name in names), None)
+            if header is not None:
+                column = names.index(header)
+                continue
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        if column >= len(row):
+            yield reader.line_num, None, "Missing address column"
+            continue
+        yield reader.line_num, row[column].strip(), None
+
+
+def iter_ndjson_addresses(lines):
+    """
+    Addresses of an NDJSON recipient file: one JSON string, or one object
+    with a "recipient", "recipient_email" or "email" key, per line
+
+    Yields:
+        tuple: (line number, address, error or None)
+    """
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            value = json.loads(line)
+        except ValueError:
+            yield line_number, None, "Not valid JSON"
+            continue
+        if isinstance(value, dict):
+            value = next((value[name] for name in ADDRESS_FIELDS if name in value), None)
+        if not isinstance(value, str):
+            yield line_number, None, "No address on this line"
+            continue
+        yield line_number, value.strip(), None
+
+
+READERS = {
+    'csv': iter_csv_addresses,
+    'ndjson': iter_ndjson_addresses,
+}
+
+
+class RecipientUpload:
+    """
+    Writes a recipient list to the database in chunks as it is read.
+
+    Only the chunk being filled is held in memory: every
+    EMAIL_UPLOAD_CHUNK_SIZE valid addresses become one RecipientChunk row,
+    which a single bulk task later sends to. Invalid rows are counted and
+    the first EMAIL_UPLOAD_MAX_ERRORS of them are kept for the response.
+    """
+
+    def __init__(self, upload_id=None, chunk_size=None, max_errors=None):
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'EMAIL_UPLOAD_CHUNK_SIZE', 1000)
+        if max_errors is None:
+            max_errors = getattr(settings, 'EMAIL_UPLOAD_MAX_ERRORS', 100)
+        self.upload_id = upload_id or uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.accepted = 0
+        self.rejected = 0
+        self.chunks = 0
+        self.errors = []
+        self._pending = []
+
+    def add(self, address):
+        self.accepted += 1
+        self._pending.append(address)
+        if len(self._pending) >= self.chunk_size:
+            self.flush()
+
+    def reject(self, line_number, value, error):
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"line": line_number, "value": value, "error": error})
+
+    def flush(self):
+        """Write the addresses read since the last chunk as a new chunk"""
+        if self._pending:
+            RecipientChunk.objects.create(
+                upload_id=self.upload_id,
+                index=self.chunks,
+                recipients="\n".join(self._pending),
+                count=len(self._pending),
+            )
+            self.chunks += 1
+            self._pending = []
+
+    def chunk_refs(self):
+        """References to the stored chunks, to queue instead of the addresses"""
+        return [{"upload_id": self.upload_id, "index": index} for index in range(self.chunks)]
+
+    def delete(self):
+        """Remove the stored chunks, e.g. when the upload is not sent"""
+        RecipientChunk.objects.filter(upload_id=self.upload_id).delete()
+
+
+def store_recipient_file(uploaded_file, file_format=None, chunk_size=None):
+    """
+    Validate an uploaded CSV or NDJSON recipient file in a single streaming
+    pass and store its valid addresses in chunks
+
+    The file is read line by line from Django's upload (a temporary file
+    once it is above FILE_UPLOAD_MAX_MEMORY_SIZE), so memory use doesn't
+    grow with the number of recipients.
+
+    Args:
+        uploaded_file (UploadedFile): The uploaded recipient file
+        file_format (str, optional): "csv" or "ndjson", guessed from the
+            file name or content type when not given
+        chunk_size (int, optional): Addresses per chunk, defaults to
+            EMAIL_UPLOAD_CHUNK_SIZE
+
+    Returns:
+        RecipientUpload: Counters, rejected rows and chunk references
+
+    Raises:
+        RecipientFileError: If the file can't be decoded or parsed
+    """
+    read_addresses = READERS[file_format or guess_format(uploaded_file)]
+    upload = RecipientUpload(chunk_size=chunk_size)
+    # Django splits the upload into lines across its read chunks
+    lines = codecs.iterdecode(uploaded_file, 'utf-8-sig')
+
+    try:
+        for line_number, address, error in read_addresses(lines):
+            if error is None:
+                normalized = normalize_email(address)
+                if normalized is None:
+                    error = INVALID_EMAIL
+            if error is None:
+                upload.add(normalized)
+            else:
+                upload.reject(line_number, address, error)
+        upload.flush()
+    except (UnicodeDecodeError, csv.Error) as e:
+        upload.delete()
+        raise RecipientFileError(f"Could not read recipient file: {str(e)}")
+
+    logger.info(
+        f"Stored recipient upload {upload.upload_id}: {upload.accepted} addresses in "
+        f"{upload.chunks} chunks, {upload.rejected} rejected"
+    )
+    return upload
+
+
+def load_recipient_chunk(ref):
+    """
+    Addresses of a stored chunk
+
+    Args:
+        ref (dict): {"upload_id", "index"} as queued by the dispatcher
+    """
+    chunk = RecipientChunk.objects.only('recipients').get(upload_id=ref["upload_id"], index=ref["index"])
+    return chunk.recipients.split("\n")
+
+
+def purge_recipient_chunks(older_than=None):
+    """
+    Delete stored chunks of uploads older than EMAIL_UPLOAD_RETENTION_DAYS
+
+    Returns:
+        int: Number of chunks deleted
+    """
+    if older_than is None:
+        older_than = timedelta(days=getattr(settings, 'EMAIL_UPLOAD_RETENTION_DAYS', 7))
+    deleted, _ = RecipientChunk.objects.filter(created_at__lt=timezone.now() - older_than).delete()
+    return deleted
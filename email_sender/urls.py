@@ -1,15 +1,38 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
 app_name = 'email_sender'
 
+# Under ASGI the endpoints most hit by clients are served by async views
+if getattr(settings, 'EMAIL_ASYNC_VIEWS', False):
+    SendEmailView = views.AsyncSendEmailView
+    SendEmailBatchView = views.AsyncSendEmailBatchView
+    EmailTaskStatusView = views.AsyncEmailTaskStatusView
+    EmailTaskStatusBatchView = views.AsyncEmailTaskStatusBatchView
+else:
+    SendEmailView = views.SendEmailView
+    SendEmailBatchView = views.SendEmailBatchView
+    EmailTaskStatusView = views.EmailTaskStatusView
+    EmailTaskStatusBatchView = views.EmailTaskStatusBatchView
+
 urlpatterns = [
     # Email sending endpoints
-    path('send-email/', views.SendEmailView.as_view(), name='send_email'),
+    path('send-email/', SendEmailView.as_view(), name='send_email'),
+    path('send-email/batch/', SendEmailBatchView.as_view(), name='send_email_batch'),
     path('send-bulk-email/', views.SendBulkEmailView.as_view(), name='send_bulk_email'),
+    path('send-bulk-email/upload/', views.SendBulkEmailUploadView.as_view(), name='send_bulk_email_upload'),
     path('send-template-email/', views.SendTemplateEmailView.as_view(), name='send_template_email'),
+    path('send-mail-merge/', views.SendMailMergeView.as_view(), name='send_mail_merge'),
     path('send-email-with-attachment/', views.SendEmailWithAttachmentView.as_view(), name='send_email_with_attachment'),
 
-    # Email status endpoint
-    path('email-status/<str:task_id>/', views.EmailTaskStatusView.as_view(), name='email_status'),
+    # Email status endpoints
+    path('email-status/batch/', EmailTaskStatusBatchView.as_view(), name='email_status_batch'),
+    path('email-status/<str:task_id>/', EmailTaskStatusView.as_view(), name='email_status'),
+    path('email-status/<str:task_id>/stream/', views.EmailTaskStatusStreamView.as_view(), name='email_status_stream'),
+    path('email-status/<str:task_id>/deliveries/', views.DeliveryLogView.as_view(), name='email_deliveries'),
+    path('outbox/<int:outbox_id>/', views.OutboxEmailStatusView.as_view(), name='outbox_status'),
+
+    # Monitoring
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
 ]
@@ -0,0 +1,84 @@
+import re
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+
+INVALID_EMAIL = "Enter a valid email address."
+BLANK = "This field may not be blank."
+NOT_A_STRING = "Not a valid string."
+
+# Django's EmailValidator limit (RFC 3696)
+MAX_EMAIL_LENGTH = 320
+
+# Lowercase ASCII dot-atom addresses on a DNS domain: what nearly every
+# recipient looks like. Everything this accepts Django's EmailValidator
+# accepts too; anything else (quoted local parts, IDN domains, address
+# literals, "localhost") is passed to the EmailValidator itself.
+FAST_EMAIL_RE = re.compile(
+    r"[-!#$%&'*+/=?^_`{}|~0-9a-z]+(?:\.[-!#$%&'*+/=?^_`{}|~0-9a-z]+)*"
+    r"@[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?"
+    r"(?:\.(?!-)[a-z0-9-]{1,63}(?<!-))*"
+    r"\.(?!-)(?:[a-z-]{2,63}|xn--[a-z0-9]{1,59})(?<!-)"
+)
+
+
+def normalize_email(value):
+    """
+    Stripped, lowercased address if it is valid, otherwise None
+
+    Args:
+        value (str): Address as sent by the client
+    """
+    address = value.strip().lower()
+    if len(address) <= MAX_EMAIL_LENGTH and FAST_EMAIL_RE.fullmatch(address):
+        return address
+    try:
+        validate_email(address)
+    except ValidationError:
+        return None
+    return address
+
+
+def validate_recipients(values):
+    """
+    Validate, lowercase and deduplicate a recipient list in one pass
+
+    The common case is checked against a single precompiled pattern, so a
+    long list costs one regex match per address instead of a DRF EmailField
+    (with its validators and error machinery) per address.
+
+    Args:
+        values (list): Addresses as sent by the client
+
+    Returns:
+        tuple: (unique valid addresses in first-seen order,
+                errors as {index: [message]} in the shape of a DRF ListField,
+                number of duplicates dropped)
+    """
+    fast_match = FAST_EMAIL_RE.fullmatch
+    unique = {}
+    errors = {}
+    valid = 0
+
+    for index, value in enumerate(values):
+        if isinstance(value, str):
+            address = value.strip().lower()
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            address = str(value)
+        else:
+            errors[index] = [NOT_A_STRING]
+            continue
+
+        if len(address) > MAX_EMAIL_LENGTH or not fast_match(address):
+            if not address:
+                errors[index] = [BLANK]
+                continue
+            address = normalize_email(address)
+            if address is None:
+                errors[index] = [INVALID_EMAIL]
+                continue
+
+        valid += 1
+        unique[address] = None
+
+    return list(unique), errors, valid - len(unique)
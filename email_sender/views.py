@@ -1,20 +1,181 @@
-from django.shortcuts import render
+import json
+
+import redis
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework import status
+from rest_framework.exceptions import APIException, AuthenticationFailed, NotAuthenticated, ParseError
+from rest_framework.parsers import MultiPartParser
+from rest_framework.request import Request
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from celery.result import AsyncResult
+from rest_framework.settings import api_settings
+from config.celery import TASK_PRIORITIES
 from .tasks import (
     send_email_task,
-    send_bulk_email_task,
+    dispatch_emails,
+    adispatch_emails,
+    dispatch_bulk_email,
+    dispatch_recipient_upload,
+    dispatch_mail_merge,
     send_template_email_task,
     send_email_with_attachment_task,
 )
 from .serializers import (
     EmailSerializer,
+    EmailBatchSerializer,
     BulkEmailSerializer,
+    BulkEmailUploadSerializer,
     TemplateEmailSerializer,
+    MailMergeSerializer,
     EmailWithAttachmentSerializer,
+    TaskStatusBatchSerializer,
+    DeliveryLogQuerySerializer,
+)
+from .bodies import check_in
+from .delivery_log import delivery_log_page
+from .events import poll_events, status_event_stream
+from .idempotency import (
+    queued_task,
+    queued_tasks,
+    remember_task,
+    remember_tasks,
+    aqueued_tasks,
+    aremember_tasks,
 )
+from .metrics import metrics_text
+from .models import OutboxEmail
+from .outbox import enqueue_email, outbox_enabled, outbox_status
+from .uploads import RecipientFileError, store_recipient_file
+from .status import task_status, task_statuses, group_task_ids, atask_status, atask_statuses
+
+
+def request_key(validated_data):
+    """
+    Idempotency key of a send request: the client's key, or None. Requests
+    without one are always queued, as an email may legitimately be sent
+    twice with the same content.
+    """
+    return validated_data.get('idempotency_key') or None
+
+
+def duplicate_response(task_id, message):
+    """Response to a repeated request, pointing at the task queued the first time"""
+    return Response({
+        'task_id': task_id,
+        'status': 'duplicate',
+        'message': message,
+    }, status=status.HTTP_200_OK)
+
+
+def with_task_priorities(emails):
+    """Validated emails with their priority names replaced by task priorities"""
+    return [dict(email, priority=TASK_PRIORITIES[email['priority']]) for email in emails]
+
+
+def add_email_to_outbox(data):
+    """
+    Write an email to the outbox, to be sent in a batch by the dispatcher
+
+    Returns:
+        tuple: (response data, status code)
+    """
+    email, created = enqueue_email(
+        recipient_email=data['recipient_email'],
+        subject=data['subject'],
+        message=data['message'],
+        html_message=data.get('html_message'),
+        idempotency_key=request_key(data),
+        priority=TASK_PRIORITIES[data['priority']],
+    )
+    if not created:
+        return {
+            'outbox_id': email.id,
+            'status': 'duplicate',
+            'message': 'Email was already added to the outbox',
+        }, status.HTTP_200_OK
+    return {
+        'outbox_id': email.id,
+        'status': 'pending',
+        'message': 'Email has been added to the outbox',
+    }, status.HTTP_202_ACCEPTED
+
+
+def add_emails_to_outbox(emails):
+    """
+    Write every email of a batch to the outbox in one transaction
+
+    Returns:
+        tuple: (response data, status code)
+    """
+    with transaction.atomic():
+        added = [
+            enqueue_email(
+                recipient_email=email['recipient_email'],
+                subject=email['subject'],
+                message=email['message'],
+                html_message=email.get('html_message'),
+                idempotency_key=request_key(email),
+                priority=TASK_PRIORITIES[email['priority']],
+            )
+            for email in emails
+        ]
+    duplicates = [index for index, (_, created) in enumerate(added) if not created]
+    return {
+        'outbox_ids': [email.id for email, _ in added],
+        'duplicates': duplicates,
+        'status': 'pending',
+        'message': f'{len(added) - len(duplicates)} of {len(emails)} emails have been added to the outbox',
+    }, status.HTTP_202_ACCEPTED
+
+
+def batch_to_queue(keys, task_ids):
+    """
+    Indexes of the emails of a batch to queue: every email without a key,
+    and the first email with each key, unless a task was already queued
+    for it
+
+    Args:
+        keys (list): Idempotency key per email, or None
+        task_ids (list): Task id already queued per email, or None
+    """
+    to_queue, seen = [], set()
+    for index, key in enumerate(keys):
+        if task_ids[index] is not None or key in seen:
+            continue
+        if key is not None:
+            seen.add(key)
+        to_queue.append(index)
+    return to_queue
+
+
+def batch_queued(keys, task_ids, to_queue, tasks):
+    """
+    Response to a batch whose new emails were queued, every other email
+    getting the id of the task queued before or earlier in the batch
+
+    Returns:
+        tuple: (response data, status code)
+    """
+    queued = {}
+    for index, task in zip(to_queue, tasks):
+        task_ids[index] = queued[keys[index]] = task.id
+    queued_indexes = set(to_queue)
+    duplicates = [index for index in range(len(keys)) if index not in queued_indexes]
+    for index in duplicates:
+        if task_ids[index] is None:
+            task_ids[index] = queued[keys[index]]
+    return {
+        'task_ids': task_ids,
+        'duplicates': duplicates,
+        'status': 'pending',
+        'message': f'Email tasks have been queued for {len(tasks)} of {len(keys)} emails',
+    }, status.HTTP_202_ACCEPTED
 
 
 class SendEmailView(APIView):
@@ -23,12 +184,25 @@ class SendEmailView(APIView):
     def post(self, request, *args, **kwargs):
         serializer = EmailSerializer(data=request.data)
         if serializer.is_valid():
-            task = send_email_task.delay(
-                recipient_email=serializer.validated_data['recipient_email'],
-                subject=serializer.validated_data['subject'],
-                message=serializer.validated_data['message'],
-                html_message=serializer.validated_data.get('html_message'),
+            if outbox_enabled():
+                return Response(*add_email_to_outbox(serializer.validated_data))
+
+            key = request_key(serializer.validated_data)
+            task_id = queued_task(key)
+            if task_id:
+                return duplicate_response(task_id, 'Email task was already queued')
+
+            task = send_email_task.apply_async(
+                kwargs=dict(
+                    recipient_email=serializer.validated_data['recipient_email'],
+                    subject=serializer.validated_data['subject'],
+                    message=check_in(serializer.validated_data['message']),
+                    html_message=check_in(serializer.validated_data.get('html_message')),
+                    idempotency_key=serializer.validated_data.get('idempotency_key'),
+                ),
+                priority=TASK_PRIORITIES[serializer.validated_data['priority']],
             )
+            remember_task(key, task.id)
             return Response({
                 'task_id': task.id,
                 'status': 'pending',
@@ -37,38 +211,143 @@ class SendEmailView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class SendEmailBatchView(APIView):
+    """
+    API view for queueing many independent single emails in one request
+
+    The emails are validated together and their tasks published over one
+    broker connection. Each email is deduplicated like a request to
+    SendEmailView: one whose idempotency_key was already queued, or repeats
+    the key of an earlier email of the batch, gets the task id of the first
+    instead of a new task.
+    """
+
+    def post(self, request, *args, **kwargs):
+        serializer = EmailBatchSerializer(data=request.data)
+        if serializer.is_valid():
+            emails = serializer.validated_data['emails']
+            if outbox_enabled():
+                return Response(*add_emails_to_outbox(emails))
+
+            keys = [request_key(email) for email in emails]
+            task_ids = queued_tasks(keys)
+            to_queue = batch_to_queue(keys, task_ids)
+            tasks = dispatch_emails(with_task_priorities(emails[index] for index in to_queue))
+            remember_tasks([(keys[index], task.id) for index, task in zip(to_queue, tasks)])
+            return Response(*batch_queued(keys, task_ids, to_queue, tasks))
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
 class SendBulkEmailView(APIView):
     """API view for sending bulk emails"""
 
     def post(self, request, *args, **kwargs):
         serializer = BulkEmailSerializer(data=request.data)
         if serializer.is_valid():
-            task = send_bulk_email_task.delay(
+            key = request_key(serializer.validated_data)
+            task_id = queued_task(key)
+            if task_id:
+                return duplicate_response(task_id, 'Bulk email task was already queued')
+
+            chunk_size = serializer.validated_data.get('chunk_size')
+            task, group_result = dispatch_bulk_email(
                 recipient_list=serializer.validated_data['recipient_list'],
                 subject=serializer.validated_data['subject'],
                 message=serializer.validated_data['message'],
                 html_message=serializer.validated_data.get('html_message'),
+                chunk_size=chunk_size,
+                compact=serializer.validated_data['compact'],
+                priority=TASK_PRIORITIES[serializer.validated_data['priority']],
+                idempotency_key=serializer.validated_data.get('idempotency_key'),
             )
-            return Response({
+            remember_task(key, task.id)
+            response = {
                 'task_id': task.id,
                 'status': 'pending',
                 'message': f'Bulk email task has been queued for {len(serializer.validated_data["recipient_list"])} recipients'
-            }, status=status.HTTP_202_ACCEPTED)
+            }
+            if group_result is not None:
+                response['group_id'] = group_result.id
+                response['chunk_size'] = chunk_size
+                response['chunks'] = len(group_result.results)
+            return Response(response, status=status.HTTP_202_ACCEPTED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class SendBulkEmailUploadView(APIView):
+    """API view for bulk sends whose recipient list is uploaded as a file"""
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, *args, **kwargs):
+        serializer = BulkEmailUploadSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
+
+        # Checked before the file is read and stored
+        key = request_key(data)
+        task_id = queued_task(key)
+        if task_id:
+            return duplicate_response(task_id, 'Bulk email task was already queued')
+
+        try:
+            upload = store_recipient_file(data['recipients_file'], data.get('file_format'), data.get('chunk_size'))
+        except RecipientFileError as e:
+            return Response({'recipients_file': [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+        if not upload.accepted:
+            return Response({
+                'recipients_file': ['No valid recipient addresses in the file'],
+                'rejected': upload.rejected,
+                'errors': upload.errors,
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        task, group_result = dispatch_recipient_upload(
+            upload,
+            subject=data['subject'],
+            message=data['message'],
+            html_message=data.get('html_message'),
+            compact=data['compact'],
+            priority=TASK_PRIORITIES[data['priority']],
+            idempotency_key=data.get('idempotency_key'),
+        )
+        remember_task(key, task.id)
+        response = {
+            'task_id': task.id,
+            'status': 'pending',
+            'message': f'Bulk email task has been queued for {upload.accepted} recipients',
+            'upload_id': upload.upload_id,
+            'recipients': upload.accepted,
+            'rejected': upload.rejected,
+            'errors': upload.errors,
+            'chunks': upload.chunks,
+        }
+        if group_result is not None:
+            response['group_id'] = group_result.id
+        return Response(response, status=status.HTTP_202_ACCEPTED)
+
+
 class SendTemplateEmailView(APIView):
     """API view for sending emails using templates"""
 
     def post(self, request, *args, **kwargs):
         serializer = TemplateEmailSerializer(data=request.data)
         if serializer.is_valid():
-            task = send_template_email_task.delay(
-                recipient_email=serializer.validated_data['recipient_email'],
-                subject=serializer.validated_data['subject'],
-                template_name=serializer.validated_data['template_name'],
-                context=serializer.validated_data.get('context', {}),
+            key = request_key(serializer.validated_data)
+            task_id = queued_task(key)
+            if task_id:
+                return duplicate_response(task_id, 'Template email task was already queued')
+
+            task = send_template_email_task.apply_async(
+                kwargs=dict(
+                    recipient_email=serializer.validated_data['recipient_email'],
+                    subject=serializer.validated_data['subject'],
+                    template_name=serializer.validated_data['template_name'],
+                    context=serializer.validated_data.get('context', {}),
+                    idempotency_key=serializer.validated_data.get('idempotency_key'),
+                ),
+                priority=TASK_PRIORITIES[serializer.validated_data['priority']],
             )
+            remember_task(key, task.id)
             return Response({
                 'task_id': task.id,
                 'status': 'pending',
@@ -77,20 +356,65 @@ class SendTemplateEmailView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class SendMailMergeView(APIView):
+    """API view for sending one template to many recipients with per-recipient contexts"""
+
+    def post(self, request, *args, **kwargs):
+        serializer = MailMergeSerializer(data=request.data)
+        if serializer.is_valid():
+            key = request_key(serializer.validated_data)
+            task_id = queued_task(key)
+            if task_id:
+                return duplicate_response(task_id, 'Mail merge task was already queued')
+
+            rows = serializer.validated_data['rows']
+            task, group_result = dispatch_mail_merge(
+                template_name=serializer.validated_data['template_name'],
+                subject=serializer.validated_data['subject'],
+                rows=rows,
+                base_context=serializer.validated_data.get('base_context', {}),
+                chunk_size=serializer.validated_data.get('chunk_size'),
+                compact=serializer.validated_data['compact'],
+                priority=TASK_PRIORITIES[serializer.validated_data['priority']],
+                idempotency_key=serializer.validated_data.get('idempotency_key'),
+            )
+            remember_task(key, task.id)
+            response = {
+                'task_id': task.id,
+                'status': 'pending',
+                'message': f'Mail merge task has been queued for {len(rows)} recipients'
+            }
+            if group_result is not None:
+                response['group_id'] = group_result.id
+                response['chunks'] = len(group_result.results)
+            return Response(response, status=status.HTTP_202_ACCEPTED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
 class SendEmailWithAttachmentView(APIView):
     """API view for sending emails with attachments"""
 
     def post(self, request, *args, **kwargs):
         serializer = EmailWithAttachmentSerializer(data=request.data)
         if serializer.is_valid():
-            task = send_email_with_attachment_task.delay(
-                recipient_email=serializer.validated_data['recipient_email'],
-                subject=serializer.validated_data['subject'],
-                message=serializer.validated_data['message'],
-                attachment_path=serializer.validated_data['attachment_path'],
-                filename=serializer.validated_data.get('filename'),
-                html_message=serializer.validated_data.get('html_message'),
+            key = request_key(serializer.validated_data)
+            task_id = queued_task(key)
+            if task_id:
+                return duplicate_response(task_id, 'Email with attachment task was already queued')
+
+            task = send_email_with_attachment_task.apply_async(
+                kwargs=dict(
+                    recipient_email=serializer.validated_data['recipient_email'],
+                    subject=serializer.validated_data['subject'],
+                    message=check_in(serializer.validated_data['message']),
+                    attachment_path=serializer.validated_data['attachment_path'],
+                    filename=serializer.validated_data.get('filename'),
+                    html_message=check_in(serializer.validated_data.get('html_message')),
+                    idempotency_key=serializer.validated_data.get('idempotency_key'),
+                ),
+                priority=TASK_PRIORITIES[serializer.validated_data['priority']],
             )
+            remember_task(key, task.id)
             return Response({
                 'task_id': task.id,
                 'status': 'pending',
@@ -103,17 +427,249 @@ class EmailTaskStatusView(APIView):
     """API view for checking the status of an email task"""
 
     def get(self, request, task_id, *args, **kwargs):
-        task_result = AsyncResult(task_id)
+        return Response(task_status(task_id), status=status.HTTP_200_OK)
+
+
+class OutboxEmailStatusView(APIView):
+    """API view for checking an email written to the outbox"""
+
+    def get(self, request, outbox_id, *args, **kwargs):
+        email = get_object_or_404(OutboxEmail, id=outbox_id)
+        return Response(outbox_status(email), status=status.HTTP_200_OK)
+
+
+class DeliveryLogView(APIView):
+    """API view for paging through the per-recipient outcomes of a compact bulk task"""
+
+    def get(self, request, task_id, *args, **kwargs):
+        serializer = DeliveryLogQuerySerializer(data=request.query_params)
+        if serializer.is_valid():
+            entries, next_after = delivery_log_page(
+                group_task_ids(task_id) or [task_id],
+                status=serializer.validated_data.get('status'),
+                after=serializer.validated_data.get('after'),
+                limit=serializer.validated_data['limit'],
+            )
+            return Response({
+                'task_id': task_id,
+                'deliveries': entries,
+                'next_after': next_after,
+            }, status=status.HTTP_200_OK)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class EmailTaskStatusStreamView(View):
+    """
+    Server-Sent Events stream of an email task's state transitions
+
+    Served without blocking a worker thread when the project runs under
+    ASGI (config.asgi). Under WSGI an open stream would hold a thread and
+    its events would only be sent once it ended, so the response is the
+    current status and a "poll" event telling the dashboard to poll
+    EmailTaskStatusView instead.
+    """
+
+    async def get(self, request, task_id, *args, **kwargs):
+        if not isinstance(request, ASGIRequest):
+            status_data = await sync_to_async(task_status)(task_id)
+            response = HttpResponse(poll_events(status_data), content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            return response
+
+        response = StreamingHttpResponse(
+            status_event_stream(task_id, task_status),
+            content_type='text/event-stream',
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class EmailTaskStatusBatchView(APIView):
+    """API view for checking the status of many email tasks at once"""
+
+    def post(self, request, *args, **kwargs):
+        serializer = TaskStatusBatchSerializer(data=request.data)
+        if serializer.is_valid():
+            statuses = task_statuses(
+                serializer.validated_data['task_ids'],
+                include_results=serializer.validated_data['include_results'],
+            )
+            return Response({'tasks': statuses}, status=status.HTTP_200_OK)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class MetricsView(View):
+    """Per-stage timing histograms of the email tasks for Prometheus to scrape"""
+
+    def get(self, request, *args, **kwargs):
+        try:
+            body = metrics_text()
+        except redis.RedisError as e:
+            return HttpResponse(f"Metrics unavailable: {str(e)}\n", status=503, content_type='text/plain')
+        return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class AsyncAPIView(View):
+    """
+    Base of the async counterparts of the API views, served instead of them
+    when the project runs under ASGI (EMAIL_ASYNC_VIEWS, see config.asgi)
+
+    DRF's APIView only runs synchronous handlers, which under ASGI each hold
+    a thread while waiting on Redis. These wait on the event loop instead.
+    They take the same JSON (or, for flat payloads, form data) and answer
+    with the same JSON. Like APIView they are exempt from Django's CSRF
+    middleware, and run the same authentication, permission and throttle
+    classes (REST_FRAMEWORK's defaults unless a view sets its own) before
+    the handler.
+    """
+    authentication_classes = api_settings.DEFAULT_AUTHENTICATION_CLASSES
+    permission_classes = api_settings.DEFAULT_PERMISSION_CLASSES
+    throttle_classes = api_settings.DEFAULT_THROTTLE_CLASSES
+
+    # APIView's checks, run on this view so that permissions and throttles
+    # see its attributes (throttle_scope...)
+    get_authenticators = APIView.get_authenticators
+    get_permissions = APIView.get_permissions
+    get_throttles = APIView.get_throttles
+    get_authenticate_header = APIView.get_authenticate_header
+    perform_authentication = APIView.perform_authentication
+    check_permissions = APIView.check_permissions
+    check_throttles = APIView.check_throttles
+    permission_denied = APIView.permission_denied
+    throttled = APIView.throttled
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        # Authentication may read the session and the users table
+        denied = await sync_to_async(self.check_access)(request)
+        if denied is not None:
+            return denied
+        try:
+            return await super().dispatch(request, *args, **kwargs)
+        except ParseError as e:
+            return self.respond({'detail': e.detail}, e.status_code)
+
+    def check_access(self, request):
+        """
+        Authenticate the request, then check permissions and throttles, as
+        APIView.initial() does
+
+        Returns:
+            JsonResponse: The error response APIView would give if the
+                request is refused, otherwise None (request.user and
+                request.auth are then set)
+        """
+        drf_request = Request(request, authenticators=self.get_authenticators())
+        try:
+            self.perform_authentication(drf_request)
+            self.check_permissions(drf_request)
+            self.check_throttles(drf_request)
+        except APIException as e:
+            # 401 needs a WWW-Authenticate header, without one it is a 403
+            if isinstance(e, (NotAuthenticated, AuthenticationFailed)):
+                auth_header = self.get_authenticate_header(drf_request)
+                if auth_header:
+                    e.auth_header = auth_header
+                else:
+                    e.status_code = status.HTTP_403_FORBIDDEN
+            response = api_settings.EXCEPTION_HANDLER(e, {'view': self, 'request': drf_request})
+            headers = {
+                name: response[name] for name in ('WWW-Authenticate', 'Retry-After') if response.has_header(name)
+            }
+            return self.respond(response.data, response.status_code, headers=headers)
+        return None
+
+    @staticmethod
+    def parse(request):
+        """
+        Data of the request, as DRF's JSON and form parsers read it
+
+        Raises:
+            ParseError: If the body is not valid JSON
+        """
+        if request.content_type != 'application/json':
+            return request.POST
+        if not request.body:
+            return {}
+        try:
+            return json.loads(request.body)
+        except ValueError as e:
+            raise ParseError(f'JSON parse error - {str(e)}')
+
+    @staticmethod
+    def respond(data, status_code, headers=None):
+        """JSON response, in place of DRF's Response"""
+        return JsonResponse(data, status=status_code, headers=headers)
+
+
+class AsyncSendEmailView(AsyncAPIView):
+    """SendEmailView for ASGI, queueing the task without blocking the event loop"""
+
+    async def post(self, request, *args, **kwargs):
+        serializer = EmailSerializer(data=self.parse(request))
+        if not serializer.is_valid():
+            return self.respond(serializer.errors, status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
+        if outbox_enabled():
+            return self.respond(*await sync_to_async(add_email_to_outbox)(data))
+
+        key = request_key(data)
+        task_id, = await aqueued_tasks([key])
+        if task_id:
+            return self.respond({
+                'task_id': task_id,
+                'status': 'duplicate',
+                'message': 'Email task was already queued',
+            }, status.HTTP_200_OK)
+
+        task, = await adispatch_emails(with_task_priorities([data]))
+        await aremember_tasks([(key, task.id)])
+        return self.respond({
+            'task_id': task.id,
+            'status': 'pending',
+            'message': 'Email task has been queued'
+        }, status.HTTP_202_ACCEPTED)
+
+
+class AsyncSendEmailBatchView(AsyncAPIView):
+    """SendEmailBatchView for ASGI, queueing the tasks without blocking the event loop"""
+
+    async def post(self, request, *args, **kwargs):
+        serializer = EmailBatchSerializer(data=self.parse(request))
+        if not serializer.is_valid():
+            return self.respond(serializer.errors, status.HTTP_400_BAD_REQUEST)
+        emails = serializer.validated_data['emails']
+        if outbox_enabled():
+            return self.respond(*await sync_to_async(add_emails_to_outbox)(emails))
+
+        keys = [request_key(email) for email in emails]
+        task_ids = await aqueued_tasks(keys)
+        to_queue = batch_to_queue(keys, task_ids)
+        tasks = await adispatch_emails(with_task_priorities(emails[index] for index in to_queue))
+        await aremember_tasks([(keys[index], task.id) for index, task in zip(to_queue, tasks)])
+        return self.respond(*batch_queued(keys, task_ids, to_queue, tasks))
+
+
+class AsyncEmailTaskStatusView(AsyncAPIView):
+    """EmailTaskStatusView for ASGI, reading Redis results without blocking the event loop"""
+
+    async def get(self, request, task_id, *args, **kwargs):
+        return self.respond(await atask_status(task_id), status.HTTP_200_OK)
 
-        result = {
-            'task_id': task_id,
-            'status': task_result.status,
-        }
 
-        if task_result.ready():
-            if task_result.successful():
-                result['result'] = task_result.get()
-            else:
-                result['error'] = str(task_result.result)
+class AsyncEmailTaskStatusBatchView(AsyncAPIView):
+    """EmailTaskStatusBatchView for ASGI, reading Redis results without blocking the event loop"""
 
-        return Response(result, status=status.HTTP_200_OK)
+    async def post(self, request, *args, **kwargs):
+        serializer = TaskStatusBatchSerializer(data=self.parse(request))
+        if not serializer.is_valid():
+            return self.respond(serializer.errors, status.HTTP_400_BAD_REQUEST)
+        statuses = await atask_statuses(
+            serializer.validated_data['task_ids'],
+            include_results=serializer.validated_data['include_results'],
+        )
+        return self.respond({'tasks': statuses}, status.HTTP_200_OK)